@@ -5,21 +5,23 @@ from __future__ import annotations
 
 import argparse
 import logging
+import sys
 from pathlib import Path
 
-from depixlib.helpers import check_file, check_color
-from depixlib.functions_numpy import findRectangleMatches
-from depixlib.functions import (
-    dropEmptyRectangleMatches,
-    findRectangleSizeOccurences,
-    findSameColorSubRectangles,
-    removeMootColorRectangles,
-    splitSingleMatchAndMultipleMatches,
-    writeAverageMatchToImage,
-    writeFirstMatchToImage
-)
+from PIL import Image
+
+from depixlib.batch import main as batchMain
+from depixlib.colorspace import AVERAGE_TYPES
+from depixlib.benchmark import main as benchmarkMain
+from depixlib.helpers import check_file, check_color, check_positive_int
+from depixlib.functions_numpy import MATCHERS
+from depixlib.IndexCache import IndexCache
 from depixlib.LoadedImage import LoadedImage
-from depixlib.Rectangle import Rectangle
+from depixlib.metrics import DISABLED, Metrics
+from depixlib.pipeline import depixelize
+from depixlib.sequence import main as decodeMain
+from depixlib.service import main as serviceMain
+from depixlib.tiling import depixelizeTiled
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -38,6 +40,16 @@ Example usage:
   python3 depix.py -p pixelated.png -s search.png -o output.png
   python3 depix.py -p image.png -s search.png --averagetype linear
   python3 depix.py -p image.png -s search.png --backgroundcolor 40,41,35
+  python3 depix.py -p image.png -s search.png --matcher index
+  python3 depix.py -p image.png -s search.png --workers 8
+  python3 depix.py -p image.png -s search.png --matcher sqdiff --topk 5
+  python3 depix.py -p tall.png -s search.png --matcher sqdiff --memorybudget 256
+  python3 depix.py -p image.png -s search.png --matcher sqdiff --cachedir ~/.cache/depix
+  python3 depix.py -p image.png -s search.png --metrics-json metrics.json
+  python3 depix.py batch -s search.png -o outdir/ screenshots/
+  python3 depix.py serve -s search.png --port 8765
+  python3 depix.py benchmark -o report.json
+  python3 depix.py decode -p line.png -s search.png --sequence search.txt
         """
     )
     parser.add_argument(
@@ -57,7 +69,7 @@ Example usage:
     parser.add_argument(
         "-a", "--averagetype",
         default="gammacorrected",
-        choices=["gammacorrected", "linear"],
+        choices=AVERAGE_TYPES,
         help="Type of RGB averaging (default: gammacorrected)"
     )
     parser.add_argument(
@@ -67,6 +79,105 @@ Example usage:
         metavar="R,G,B",
         help="Background color to ignore (format: r,g,b)"
     )
+    parser.add_argument(
+        "-m", "--matcher",
+        default="template",
+        choices=MATCHERS,
+        help="Block matching strategy (default: template)"
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=1.0,
+        type=float,
+        metavar="N",
+        help="Per-channel colour tolerance for the index matcher (default: 1.0)"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        default=1,
+        type=check_positive_int,
+        metavar="N",
+        help="Worker processes for the template matcher (default: 1)"
+    )
+    parser.add_argument(
+        "-k", "--topk",
+        default=1,
+        type=check_positive_int,
+        metavar="N",
+        help="Candidate matches kept per block (all matchers except index, default: 1)"
+    )
+    parser.add_argument(
+        "--scorethreshold",
+        default=None,
+        type=float,
+        metavar="F",
+        help="Maximum match score of a candidate (all matchers except index)"
+    )
+    parser.add_argument(
+        "--grid",
+        action="store_true",
+        help="Detect the block grid instead of following exact colour runs (noisy input)"
+    )
+    parser.add_argument(
+        "--textbands",
+        action="store_true",
+        help=(
+            "Only match windows overlapping a line of text in the search image, "
+            "and after the fullest row of blocks only those at its offset in the line"
+        )
+    )
+    parser.add_argument(
+        "--noneighbourpass",
+        action="store_true",
+        help="Do not resolve multiple matches from neighbouring blocks"
+    )
+    parser.add_argument(
+        "--nomatchmemo",
+        action="store_true",
+        help="Search every block instead of once per block size and colour"
+    )
+    parser.add_argument(
+        "--weightedaverage",
+        action="store_true",
+        help="Weight ambiguous matches by match score when averaging them"
+    )
+    parser.add_argument(
+        "--cachedir",
+        default=None,
+        metavar="PATH",
+        help="Directory for cached decoded search images and indexes"
+    )
+    parser.add_argument(
+        "--cachesize",
+        default=2048,
+        type=int,
+        metavar="MB",
+        help="Size cap of the index cache in megabytes (default: 2048)"
+    )
+    parser.add_argument(
+        "--memorybudget",
+        default=None,
+        type=check_positive_int,
+        metavar="MB",
+        help=(
+            "Process the image in tiles using about this much working memory; "
+            "the budget excludes the search image and its index, and the "
+            "decoded input unless --cachedir memory-maps it"
+        )
+    )
+    parser.add_argument(
+        "--tilerows",
+        default=None,
+        type=check_positive_int,
+        metavar="N",
+        help="Process the image in tiles of at most N rows"
+    )
+    parser.add_argument(
+        "--metricsjson", "--metrics-json",
+        default=None,
+        metavar="PATH",
+        help="Write stage times and block/match counters as JSON"
+    )
     parser.add_argument(
         "-o", "--outputimage",
         default="output.png",
@@ -78,98 +189,76 @@ Example usage:
 
 def main() -> None:
     """Main depixelization function."""
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batchMain(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serviceMain(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmarkMain(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "decode":
+        decodeMain(sys.argv[2:])
+        return
+
     args = parse_args()
 
+    metrics = Metrics() if args.metricsjson else DISABLED
     try:
-        # Load images
-        logger.info("Loading pixelated image from %s", args.pixelimage)
-        pixelatedImage = LoadedImage(args.pixelimage)
-        unpixelatedOutputImage = pixelatedImage.getCopyOfLoadedPILImage()
-
-        logger.info("Loading search image from %s", args.searchimage)
-        searchImage = LoadedImage(args.searchimage)
-
-        # Find rectangles
-        logger.info("Finding color rectangles from pixelated space")
-        pixelatedRectangle = Rectangle(
-            (0, 0),
-            (pixelatedImage.width - 1, pixelatedImage.height - 1)
-        )
-        pixelatedSubRectangles = findSameColorSubRectangles(
-            pixelatedImage, pixelatedRectangle
-        )
-        logger.info("Found %d same color rectangles", len(pixelatedSubRectangles))
-
-        # Filter rectangles
-        pixelatedSubRectangles = removeMootColorRectangles(
-            pixelatedSubRectangles, args.backgroundcolor
-        )
-        logger.info(
-            "%d rectangles left after moot filter",
-            len(pixelatedSubRectangles)
-        )
-
-        # Find rectangle sizes
-        rectangleSizeOccurrences = findRectangleSizeOccurences(
-            pixelatedSubRectangles
-        )
-        logger.info(
-            "Found %d different rectangle sizes",
-            len(rectangleSizeOccurrences)
-        )
+        with metrics.stage("load"):
+            cache = None
+            if args.cachedir:
+                cache = IndexCache(args.cachedir, args.cachesize * 1024 * 1024)
 
-        # Find matches
-        logger.info("Finding matches in search image")
-        rectangleMatches = findRectangleMatches(
-            rectangleSizeOccurrences,
-            pixelatedSubRectangles,
-            searchImage,
-            pixelatedImage,
-            args.averagetype
-        )
+            # Load images; tiled runs memory-map the decoded input from the
+            # cache so tiles page in rows instead of holding the whole image
+            logger.info("Loading pixelated image from %s", args.pixelimage)
+            tiled = bool(args.memorybudget or args.tilerows)
+            pixelatedImage = LoadedImage(args.pixelimage, cache if tiled else None)
 
-        # Drop empty matches
-        logger.info("Removing blocks with no matches")
-        pixelatedSubRectangles = dropEmptyRectangleMatches(
-            rectangleMatches,
-            pixelatedSubRectangles
-        )
+            logger.info("Loading search image from %s", args.searchimage)
+            searchImage = LoadedImage(args.searchimage, cache)
 
-        # Split matches
-        logger.info("Splitting single matches and multiple matches")
-        singleResults, pixelatedSubRectangles = splitSingleMatchAndMultipleMatches(
-            pixelatedSubRectangles,
-            rectangleMatches
-        )
-        logger.info(
-            "[%d straight matches | %d multiple matches]",
-            len(singleResults),
-            len(pixelatedSubRectangles)
+        options = dict(
+            averageType=args.averagetype,
+            backgroundColor=args.backgroundcolor,
+            matcher=args.matcher,
+            tolerance=args.tolerance,
+            cache=cache,
+            workers=args.workers,
+            topK=args.topk,
+            scoreThreshold=args.scorethreshold,
+            neighbourPass=not args.noneighbourpass,
+            blockGrid=args.grid,
+            textBands=args.textbands,
+            matchMemo=not args.nomatchmemo,
+            weightedAverage=args.weightedaverage,
+            metrics=metrics
         )
-
-        # Write results
-        logger.info("Writing single match results to output")
-        writeFirstMatchToImage(
-            singleResults,
-            rectangleMatches,
-            searchImage,
-            unpixelatedOutputImage
-        )
-
-        logger.info("Writing average results for multiple matches to output")
-        writeAverageMatchToImage(
-            pixelatedSubRectangles,
-            rectangleMatches,
-            searchImage,
-            unpixelatedOutputImage
-        )
-
-        # Save output
         output_path = Path(args.outputimage)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        unpixelatedOutputImage.save(str(output_path))
+
+        if tiled:
+            # Output rows are streamed to disk tile by tile
+            depixelizeTiled(
+                pixelatedImage,
+                searchImage,
+                str(output_path),
+                (args.memorybudget or 0) * 1024 * 1024,
+                tileRows=args.tilerows,
+                **options
+            )
+        else:
+            outputCanvas, _ = depixelize(pixelatedImage, searchImage, **options)
+            with metrics.stage("save"):
+                Image.fromarray(outputCanvas).save(str(output_path))
         logger.info("Successfully saved output image to: %s", args.outputimage)
 
+        if args.metricsjson:
+            metrics.writeJson(args.metricsjson)
+            logger.info("Saved metrics to: %s", args.metricsjson)
+
     except Exception as e:
         logger.error("Error during depixelization: %s", str(e), exc_info=True)
         raise
@@ -0,0 +1,268 @@
+"""
+Struct-of-arrays table of pixelated blocks.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union, overload
+import numpy as np
+
+from depixlib.Rectangle import ColorRectangle
+
+BLOCK_DTYPE = np.dtype([
+    ("x", np.int32),
+    ("y", np.int32),
+    ("w", np.int32),
+    ("h", np.int32),
+    ("r", np.uint8),
+    ("g", np.uint8),
+    ("b", np.uint8),
+    ("flags", np.uint8),
+])
+
+# Bits of the flags field
+BLOCK_MATCHED = 1
+BLOCK_SINGLE_MATCH = 2
+
+
+class BlockTable:
+    """
+    Blocks of a pixelated image stored in one NumPy structured array.
+
+    Filtering, grouping and lookups are array operations over the whole
+    table. Indexing with an integer returns a ColorRectangle for code that
+    works on single blocks; indexing with a mask, slice or index array
+    returns another BlockTable.
+    """
+
+    def __init__(self, records: np.ndarray | None = None) -> None:
+        """
+        Initialize a table.
+
+        Args:
+            records: Structured array of BLOCK_DTYPE, empty table if None
+        """
+        if records is None:
+            records = np.empty(0, dtype=BLOCK_DTYPE)
+        self.records = records
+        self._coordinateIndex: Tuple[np.ndarray, np.ndarray] | None = None
+
+    @classmethod
+    def fromArrays(
+        cls,
+        x: np.ndarray,
+        y: np.ndarray,
+        width: np.ndarray,
+        height: np.ndarray,
+        colors: np.ndarray
+    ) -> BlockTable:
+        """
+        Build a table from per-field arrays.
+
+        Args:
+            x: Block x coordinates
+            y: Block y coordinates
+            width: Block widths
+            height: Block heights
+            colors: (N, 3) block RGB colours
+
+        Returns:
+            New BlockTable
+        """
+        records = np.zeros(len(x), dtype=BLOCK_DTYPE)
+        records["x"] = x
+        records["y"] = y
+        records["w"] = width
+        records["h"] = height
+        colors = np.asarray(colors).reshape(-1, 3)
+        records["r"] = colors[:, 0]
+        records["g"] = colors[:, 1]
+        records["b"] = colors[:, 2]
+        return cls(records)
+
+    @classmethod
+    def fromRectangles(cls, rects: Iterable[ColorRectangle]) -> BlockTable:
+        """Build a table from ColorRectangle objects."""
+        rects = list(rects)
+        return cls.fromArrays(
+            np.array([r.x for r in rects], dtype=np.int32),
+            np.array([r.y for r in rects], dtype=np.int32),
+            np.array([r.width for r in rects], dtype=np.int32),
+            np.array([r.height for r in rects], dtype=np.int32),
+            np.array([r.color[:3] for r in rects], dtype=np.uint8).reshape(-1, 3)
+        )
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.records["x"]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.records["y"]
+
+    @property
+    def width(self) -> np.ndarray:
+        return self.records["w"]
+
+    @property
+    def height(self) -> np.ndarray:
+        return self.records["h"]
+
+    @property
+    def flags(self) -> np.ndarray:
+        return self.records["flags"]
+
+    @property
+    def colors(self) -> np.ndarray:
+        """(N, 3) uint8 array of block colours."""
+        return np.stack(
+            [self.records["r"], self.records["g"], self.records["b"]], axis=1
+        )
+
+    def packedColors(self) -> np.ndarray:
+        """Block colours packed into one integer each as 0xRRGGBB."""
+        return (
+            (self.records["r"].astype(np.uint32) << 16)
+            | (self.records["g"].astype(np.uint32) << 8)
+            | self.records["b"].astype(np.uint32)
+        )
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @overload
+    def __getitem__(self, key: int) -> ColorRectangle: ...
+
+    @overload
+    def __getitem__(self, key: Union[slice, np.ndarray, Sequence[int]]) -> BlockTable: ...
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            x, y, w, h, r, g, b, _ = self.records[key].tolist()
+            return ColorRectangle((r, g, b), (x, y), (x + w, y + h))
+        return BlockTable(self.records[key])
+
+    def __iter__(self) -> Iterator[ColorRectangle]:
+        for x, y, w, h, r, g, b, _ in self.records.tolist():
+            yield ColorRectangle((r, g, b), (x, y), (x + w, y + h))
+
+    def __repr__(self) -> str:
+        return f"BlockTable(n={len(self)})"
+
+    def filter(self, mask: np.ndarray) -> BlockTable:
+        """Return the blocks where mask is True."""
+        return BlockTable(self.records[mask])
+
+    def withoutColors(self, colors: Iterable[Tuple[int, int, int]]) -> BlockTable:
+        """Return the blocks whose colour is not in colors."""
+        packed = np.array(
+            [(r << 16) | (g << 8) | b for r, g, b in colors], dtype=np.uint32
+        )
+        return self.filter(~np.isin(self.packedColors(), packed))
+
+    def sizeCounts(self) -> Dict[Tuple[int, int], int]:
+        """Number of blocks of every (width, height)."""
+        sizes, counts = np.unique(
+            np.stack([self.width, self.height], axis=1), axis=0, return_counts=True
+        )
+        return {
+            (int(w), int(h)): int(c) for (w, h), c in zip(sizes.tolist(), counts)
+        }
+
+    def groupBySize(self) -> Dict[Tuple[int, int], BlockTable]:
+        """Split the table into one table per (width, height), in table order."""
+        if len(self) == 0:
+            return {}
+        order = np.lexsort((self.height, self.width))
+        sizes = np.stack([self.width[order], self.height[order]], axis=1)
+        starts = np.flatnonzero(np.any(np.diff(sizes, axis=0) != 0, axis=1)) + 1
+        groups = {}
+        for indices in np.split(order, starts):
+            first = self.records[indices[0]]
+            groups[(int(first["w"]), int(first["h"]))] = BlockTable(
+                self.records[np.sort(indices)]
+            )
+        return groups
+
+    def lookup(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Find the blocks starting at the given coordinates.
+
+        Args:
+            x: X coordinates to look up
+            y: Y coordinates to look up
+
+        Returns:
+            Array of table indices, -1 where no block starts there
+        """
+        if self._coordinateIndex is None:
+            keys = self._coordinateKeys(self.x, self.y)
+            order = np.argsort(keys, kind="stable")
+            self._coordinateIndex = (keys[order], order)
+        sortedKeys, order = self._coordinateIndex
+
+        keys = self._coordinateKeys(np.asarray(x), np.asarray(y))
+        if len(sortedKeys) == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sortedKeys, keys), len(sortedKeys) - 1)
+        found = sortedKeys[positions] == keys
+        return np.where(found, order[positions], -1)
+
+    def neighbours(self) -> List[np.ndarray]:
+        """
+        Find the blocks touching each block, edges or corners.
+
+        Blocks are bucketed in a uniform grid with cells about one block in
+        size, so each block is only compared with the few blocks sharing its
+        cells instead of with the whole table.
+
+        Returns:
+            For every block, an array of the table indices of its neighbours
+        """
+        if len(self) == 0:
+            return []
+        cell = max(int(np.median(self.width)), int(np.median(self.height)), 1)
+        x0 = self.x.astype(np.int64)
+        y0 = self.y.astype(np.int64)
+        x1 = x0 + self.width
+        y1 = y0 + self.height
+
+        grid: Dict[Tuple[int, int], List[int]] = {}
+        for i, (left, top, right, bottom) in enumerate(zip(
+            (x0 // cell).tolist(), (y0 // cell).tolist(),
+            ((x1 - 1) // cell).tolist(), ((y1 - 1) // cell).tolist()
+        )):
+            for cy in range(top, bottom + 1):
+                for cx in range(left, right + 1):
+                    grid.setdefault((cx, cy), []).append(i)
+
+        result = []
+        for i, (left, top, right, bottom) in enumerate(zip(
+            ((x0 - 1) // cell).tolist(), ((y0 - 1) // cell).tolist(),
+            (x1 // cell).tolist(), (y1 // cell).tolist()
+        )):
+            nearby = {
+                j
+                for cy in range(top, bottom + 1)
+                for cx in range(left, right + 1)
+                for j in grid.get((cx, cy), ())
+            }
+            nearby.discard(i)
+            candidates = np.fromiter(nearby, dtype=np.int64, count=len(nearby))
+            touching = (
+                (x0[candidates] <= x1[i]) & (x1[candidates] >= x0[i])
+                & (y0[candidates] <= y1[i]) & (y1[candidates] >= y0[i])
+            )
+            result.append(np.sort(candidates[touching]))
+        return result
+
+    @staticmethod
+    def _coordinateKeys(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return (y.astype(np.int64) << 32) | (x.astype(np.int64) & 0xFFFFFFFF)
+
+
+def asBlockTable(rects: BlockTable | Iterable[ColorRectangle]) -> BlockTable:
+    """Return rects as a BlockTable, converting lists of ColorRectangle."""
+    if isinstance(rects, BlockTable):
+        return rects
+    return BlockTable.fromRectangles(rects)
+
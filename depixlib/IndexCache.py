@@ -0,0 +1,139 @@
+"""
+Persistent on-disk cache of per-block-size search image structures.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+class IndexCache:
+    """
+    Directory of NumPy arrays grouped into entries, evicted least recently used.
+
+    An entry holds everything precomputed for one (search image, block size,
+    average type) combination. Arrays are opened memory-mapped, so loading an
+    entry costs page faults on the parts actually read and concurrent
+    processes share the pages through the OS cache.
+    """
+
+    def __init__(self, directory: str, maxBytes: int = DEFAULT_MAX_BYTES) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            directory: Cache directory, created if missing
+            maxBytes: Total size above which old entries are evicted
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hashFile(path: str) -> str:
+        """Content hash of a file, used to key entries of a search image."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def entryKey(imageHash: str, width: int, height: int, averageType: str) -> str:
+        """Name of the entry for one search image, block size and average type."""
+        return f"{imageHash[:32]}-{width}x{height}-{averageType}"
+
+    @staticmethod
+    def decodedKey(imageHash: str) -> str:
+        """Name of the entry holding the decoded pixels of an image file."""
+        return f"{imageHash[:32]}-decoded"
+
+    def load(self, key: str, name: str) -> np.ndarray | None:
+        """
+        Open a cached array read-only and memory-mapped.
+
+        Args:
+            key: Entry key from entryKey()
+            name: Array name within the entry
+
+        Returns:
+            The array, or None if it is not cached
+        """
+        entry = self.directory / key
+        try:
+            array = np.load(entry / f"{name}.npy", mmap_mode="r")
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return array
+
+    def store(self, key: str, name: str, array: np.ndarray) -> None:
+        """
+        Write an array into an entry, then evict entries over the size cap.
+
+        Args:
+            key: Entry key from entryKey()
+            name: Array name within the entry
+            array: Array to store
+        """
+        entry = self.directory / key
+        entry.mkdir(exist_ok=True)
+        target = entry / f"{name}.npy"
+        try:
+            # A fresh file per writer, so concurrent threads and processes
+            # storing the same array never write into one temporary file
+            handle, temporary = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=entry)
+        except OSError as e:
+            logger.warning("Could not write cache entry %s/%s: %s", key, name, e)
+            return
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(temporary, target)
+        except OSError as e:
+            logger.warning("Could not write cache entry %s/%s: %s", key, name, e)
+            Path(temporary).unlink(missing_ok=True)
+            return
+        self.evict(keep=key)
+
+    def evict(self, keep: str | None = None) -> None:
+        """
+        Remove least recently used entries until the cache fits maxBytes.
+
+        Args:
+            keep: Entry that must not be evicted (the one being written)
+        """
+        entries = []
+        total = 0
+        for entry in self.directory.iterdir():
+            if not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+            entries.append((entry.stat().st_mtime, size, entry))
+            total += size
+
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.maxBytes:
+                break
+            if entry.name == keep:
+                continue
+            logger.debug("Evicting cache entry %s (%d bytes)", entry.name, size)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
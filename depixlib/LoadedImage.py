@@ -1,31 +1,129 @@
 from __future__ import annotations
 
-from typing import cast
+from typing import TYPE_CHECKING, Dict, Tuple
+import numpy as np
 from PIL import Image
 
+from depixlib.colorspace import toWorkingSpace
+
+if TYPE_CHECKING:
+    from depixlib.IndexCache import IndexCache
+
+
+class _ImageColumn:
+    """One column of an image, indexed by y, yielding RGB tuples."""
+
+    def __init__(self, column: np.ndarray) -> None:
+        self._column = column
+
+    def __len__(self) -> int:
+        return len(self._column)
+
+    def __getitem__(self, y: int) -> Tuple[int, int, int]:
+        r, g, b = self._column[y].tolist()
+        return (r, g, b)
+
+
+class ImageDataView:
+    """
+    Read-only legacy `imageData[x][y]` access on top of an (H, W, 3) array.
+
+    Nothing is copied: columns are array views and pixels are converted to
+    tuples only when they are read.
+    """
+
+    def __init__(self, array: np.ndarray) -> None:
+        self._array = array
+
+    def __len__(self) -> int:
+        return self._array.shape[1]
+
+    def __getitem__(self, x: int) -> _ImageColumn:
+        return _ImageColumn(self._array[:, x])
+
 
 class LoadedImage:
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, cache: IndexCache | None = None) -> None:
+        """
+        Load an image file.
+
+        Args:
+            path: Image file path
+            cache: Optional cache of decoded pixels; the array is then
+                memory-mapped from a raw .npy file keyed by the file's
+                content hash, so the PNG is decoded once per content and
+                concurrent processes share the pages
+        """
         self.path = path
-        self.loadedImage = Image.open(self.path)
-        self.width = self.loadedImage.size[0]
-        self.height = self.loadedImage.size[1]
-        self.imageData = self.__loadImageData()
+        self.contentHash: str | None = None
+        if cache is not None:
+            self.contentHash = cache.hashFile(path)
+            self.array = self.__loadCachedArray(cache, self.contentHash)
+        else:
+            with Image.open(self.path) as image:
+                self.array = self.__loadArray(image)
+        self.height, self.width = self.array.shape[:2]
+        self._imageData: ImageDataView | None = None
+        self._working: Dict[str, np.ndarray] = {}
 
-    def getCopyOfLoadedPILImage(self) -> Image.Image:
-        return self.loadedImage.copy()
+    @classmethod
+    def fromArray(cls, array: np.ndarray, path: str = "<array>") -> LoadedImage:
+        """Wrap an existing (H, W, 3) uint8 RGB array without decoding a file."""
+        loaded = cls.__new__(cls)
+        loaded.path = path
+        loaded.contentHash = None
+        loaded.array = np.ascontiguousarray(array[:, :, :3], dtype=np.uint8)
+        loaded.array.flags.writeable = False
+        loaded.height, loaded.width = loaded.array.shape[:2]
+        loaded._imageData = None
+        loaded._working = {}
+        return loaded
 
-    def __loadImageData(self) -> list[list[tuple[int, int, int]]]:
-        """Load data from image with getdata() because of the speed increase over consecutive calls to getpixel"""
-        _imageData = [[y for y in range(self.height)] for x in range(self.width)]
+    @property
+    def imageData(self) -> ImageDataView:
+        """Pixel access as imageData[x][y] -> (r, g, b), for legacy callers."""
+        if self._imageData is None:
+            self._imageData = ImageDataView(self.array)
+        return self._imageData
 
-        rawData = self.loadedImage.getdata()
-        rawDataCount = 0
+    def working(self, averageType: str) -> np.ndarray:
+        """
+        The image in the colour space blocks are averaged in, converted once.
+
+        Args:
+            averageType: One of depixlib.colorspace.AVERAGE_TYPES
+
+        Returns:
+            Read-only (H, W, 3) float32 array normalized to 0-1
+        """
+        working = self._working.get(averageType)
+        if working is None:
+            working = toWorkingSpace(self.array, averageType)
+            working.flags.writeable = False
+            self._working[averageType] = working
+        return working
+
+    def getCopyOfLoadedPILImage(self) -> Image.Image:
+        return Image.fromarray(self.array)
 
-        # because getdata returns the image as one big list
-        for y in range(self.height):
-            for x in range(self.width):
+    def __loadCachedArray(self, cache: IndexCache, contentHash: str) -> np.ndarray:
+        key = cache.decodedKey(contentHash)
+        array = cache.load(key, "rgb")
+        if array is None:
+            with Image.open(self.path) as image:
+                cache.store(key, "rgb", self.__loadArray(image))
+            array = cache.load(key, "rgb")
+        if array is None:
+            # Cache not writable; fall back to an in-memory decode
+            with Image.open(self.path) as image:
+                return self.__loadArray(image)
+        return array
 
-                _imageData[x][y] = rawData[rawDataCount][0:3]
-                rawDataCount += 1
-        return cast(list[list[tuple[int, int, int]]], _imageData)
+    @staticmethod
+    def __loadArray(image: Image.Image) -> np.ndarray:
+        """Decode the image once into a contiguous read-only (H, W, 3) uint8 array"""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        array = np.asarray(image)
+        array.flags.writeable = False
+        return array
@@ -2,7 +2,10 @@
 Rectangle data structures for Depix.
 """
 from __future__ import annotations
-from typing import List, Tuple
+
+import hashlib
+from typing import Iterator, List, Sequence, Tuple
+import numpy as np
 
 
 class Rectangle:
@@ -73,18 +76,118 @@ class ColorRectangle(Rectangle):
 class RectangleMatch:
     """Match information for a rectangle."""
     
-    def __init__(self, x: int, y: int, data: List) -> None:
+    def __init__(self, x: int, y: int, score: float | None = None) -> None:
         """
         Initialize a rectangle match.
         
         Args:
             x: X coordinate in search image
             y: Y coordinate in search image
-            data: Pixel data of the matched region
+            score: Matcher distance of the match (lower is better)
         """
         self.x = x
         self.y = y
-        self.data = data
+        self.score = score
+    
+    def __repr__(self) -> str:
+        return f"RectangleMatch(x={self.x}, y={self.y}, score={self.score})"
+    
+    def window(self, searchArray: np.ndarray, width: int, height: int) -> np.ndarray:
+        """View of the matched pixels in an (H, W, 3) search array."""
+        return searchArray[self.y:self.y + height, self.x:self.x + width]
+
+
+class MatchSet:
+    """
+    All candidate matches of one block, as search image coordinates.
+    
+    Pixel data is never copied into the set; it is read from the search
+    array on demand.
+    """
+    
+    def __init__(
+        self,
+        xs: Sequence[int] | np.ndarray,
+        ys: Sequence[int] | np.ndarray,
+        scores: Sequence[float] | np.ndarray | None,
+        width: int,
+        height: int
+    ) -> None:
+        """
+        Initialize a match set.
+        
+        Args:
+            xs: X coordinates of the matches in the search image
+            ys: Y coordinates of the matches in the search image
+            scores: Matcher distance per match (lower is better), or None
+            width: Block width
+            height: Block height
+        """
+        self.xs = np.asarray(xs, dtype=np.int32)
+        self.ys = np.asarray(ys, dtype=np.int32)
+        if scores is None:
+            self.scores = np.full(len(self.xs), np.nan, dtype=np.float32)
+        else:
+            self.scores = np.asarray(scores, dtype=np.float32)
+        self.width = width
+        self.height = height
+    
+    @classmethod
+    def single(
+        cls,
+        x: int,
+        y: int,
+        score: float | None,
+        width: int,
+        height: int
+    ) -> MatchSet:
+        """Create a set holding one match."""
+        return cls([x], [y], None if score is None else [score], width, height)
+    
+    def __len__(self) -> int:
+        return len(self.xs)
+    
+    def __getitem__(self, i: int) -> RectangleMatch:
+        score = float(self.scores[i])
+        return RectangleMatch(
+            int(self.xs[i]), int(self.ys[i]), None if np.isnan(score) else score
+        )
+    
+    def __iter__(self) -> Iterator[RectangleMatch]:
+        return (self[i] for i in range(len(self)))
     
     def __repr__(self) -> str:
-        return f"RectangleMatch(x={self.x}, y={self.y}, data_len={len(self.data)})"
+        return f"MatchSet(n={len(self)}, w={self.width}, h={self.height})"
+    
+    def windows(self, searchArray: np.ndarray) -> np.ndarray:
+        """
+        Gather all matched windows for reduction.
+        
+        Args:
+            searchArray: (H, W, 3) search image array
+            
+        Returns:
+            (k, height, width, 3) array
+        """
+        view = np.lib.stride_tricks.sliding_window_view(
+            searchArray, (self.height, self.width), axis=(0, 1)
+        )
+        return view[self.ys, self.xs].transpose(0, 2, 3, 1)
+    
+    def windowDigests(self, searchArray: np.ndarray) -> List[bytes]:
+        """Content hash of every matched window."""
+        digests = []
+        for x, y in zip(self.xs.tolist(), self.ys.tolist()):
+            window = searchArray[y:y + self.height, x:x + self.width]
+            digests.append(hashlib.blake2b(
+                np.ascontiguousarray(window), digest_size=16
+            ).digest())
+        return digests
+    
+    def allIdentical(self, searchArray: np.ndarray) -> bool:
+        """Whether every match covers the same pixel content."""
+        if len(self) <= 1:
+            return True
+        if (self.xs == self.xs[0]).all() and (self.ys == self.ys[0]).all():
+            return True
+        return len(set(self.windowDigests(searchArray))) == 1
@@ -0,0 +1,772 @@
+"""
+Search index over the window average colours of a search image.
+"""
+from __future__ import annotations
+
+import itertools
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple, cast
+import numpy as np
+
+from depixlib.colorspace import fromWorkingSpace, integerLevels, toWorkingSpace
+from depixlib.IndexCache import IndexCache
+from depixlib.Rectangle import MatchSet
+
+logger = logging.getLogger(__name__)
+
+# Search image rows summed at once by the integer matcher's box sums
+INTEGER_BAND_ROWS = 256
+
+
+def _packRgb(array: np.ndarray) -> np.ndarray:
+    rgb = array[..., :3].astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def backgroundColor(searchArray: np.ndarray) -> Tuple[int, int, int]:
+    """
+    Most common colour of a rendered search image.
+
+    Args:
+        searchArray: (H, W, 3) uint8 RGB search image
+
+    Returns:
+        RGB colour
+    """
+    colors, counts = np.unique(_packRgb(searchArray), return_counts=True)
+    packed = int(colors[np.argmax(counts)])
+    return (packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF)
+
+
+def _encodeMemo(items: List[Tuple[int, MatchSet]]) -> np.ndarray:
+    """(M, 4) float64 rows of (colour, x, y, score), x = -1 for no match."""
+    rows = []
+    for color, matches in items:
+        if len(matches) == 0:
+            rows.append(np.array([[color, -1, -1, np.nan]]))
+            continue
+        block = np.empty((len(matches), 4))
+        block[:, 0] = color
+        block[:, 1] = matches.xs
+        block[:, 2] = matches.ys
+        block[:, 3] = matches.scores
+        rows.append(block)
+    return np.concatenate(rows) if rows else np.empty((0, 4))
+
+
+def _decodeMemo(rows: np.ndarray, width: int, height: int) -> Dict[int, MatchSet]:
+    """Inverse of _encodeMemo()."""
+    memo: Dict[int, MatchSet] = {}
+    starts = np.flatnonzero(np.diff(rows[:, 0], prepend=-1.0))
+    for block in np.split(rows, starts[1:]):
+        valid = block[block[:, 1] >= 0]
+        memo[int(block[0, 0])] = MatchSet(
+            valid[:, 1].astype(np.int32), valid[:, 2].astype(np.int32),
+            valid[:, 3], width, height
+        )
+    return memo
+
+
+def detectTextBands(searchArray: np.ndarray) -> np.ndarray:
+    """
+    Find the lines of text in a rendered search image.
+
+    The backgroundColor() is the background. Rows holding any other colour
+    are text rows, and each run of them is a band spanning the columns its
+    text covers.
+
+    Args:
+        searchArray: (H, W, 3) uint8 RGB search image
+
+    Returns:
+        (K, 4) int64 array of (top, bottom, left, right) per band, ends
+        exclusive, top to bottom
+    """
+    text = _packRgb(searchArray) != _packRgb(np.array(backgroundColor(searchArray)))
+
+    edges = np.flatnonzero(np.diff(text.any(axis=1), prepend=False, append=False))
+    bands = []
+    for top, bottom in edges.reshape(-1, 2).tolist():
+        columns = np.flatnonzero(text[top:bottom].any(axis=0))
+        bands.append((top, bottom, int(columns[0]), int(columns[-1]) + 1))
+    return np.array(bands, dtype=np.int64).reshape(-1, 4)
+
+
+class ColorBuckets:
+    """Window positions sorted by quantized average colour."""
+
+    def __init__(
+        self,
+        order: np.ndarray,
+        sortedKeys: np.ndarray,
+        sortedMeans: np.ndarray,
+        cellSize: float,
+        windowWidth: int
+    ) -> None:
+        """
+        Initialize from prebuilt arrays (see build()).
+
+        Args:
+            order: Flat window indices sorted by bucket key
+            sortedKeys: Bucket key of each window in that order
+            sortedMeans: (N, 3) average colour of each window in that order
+            cellSize: Edge length of a quantization cell in sRGB units
+            windowWidth: Number of window positions per row
+        """
+        self.order = order
+        self.sortedKeys = sortedKeys
+        self.sortedMeans = sortedMeans
+        self.cellSize = cellSize
+        self.windowWidth = windowWidth
+        self.cellsPerChannel = int(256 // cellSize) + 2
+
+    @classmethod
+    def build(cls, means: np.ndarray, cellSize: float) -> ColorBuckets:
+        """
+        Build the buckets for one block size.
+
+        Args:
+            means: (H', W', 3) average sRGB colour of every window
+            cellSize: Edge length of a quantization cell in sRGB units
+        """
+        buckets = cls(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty((0, 3), dtype=np.float32),
+            cellSize,
+            means.shape[1]
+        )
+        flatMeans = means.reshape(-1, 3)
+        keys = buckets._keys(np.floor(flatMeans / cellSize).astype(np.int64))
+        buckets.order = np.argsort(keys, kind="stable")
+        buckets.sortedKeys = keys[buckets.order]
+        buckets.sortedMeans = flatMeans[buckets.order]
+        return buckets
+
+    def _keys(self, cells: np.ndarray) -> np.ndarray:
+        cells = np.clip(cells, 0, self.cellsPerChannel - 1)
+        n = self.cellsPerChannel
+        return (cells[..., 0] * n + cells[..., 1]) * n + cells[..., 2]
+
+    def query(
+        self,
+        color: Tuple[int, int, int],
+        tolerance: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find all windows whose average colour is within tolerance.
+
+        Args:
+            color: RGB colour to look up
+            tolerance: Maximum per-channel difference in sRGB units
+
+        Returns:
+            Tuple of (flat window indices, Chebyshev distances)
+        """
+        target = np.asarray(color, dtype=np.float32)
+        low = np.floor((target - tolerance) / self.cellSize).astype(np.int64)
+        high = np.floor((target + tolerance) / self.cellSize).astype(np.int64)
+
+        slices = []
+        for cell in itertools.product(*(range(l, h + 1) for l, h in zip(low, high))):
+            key = self._keys(np.asarray(cell, dtype=np.int64))
+            start = np.searchsorted(self.sortedKeys, key, side="left")
+            end = np.searchsorted(self.sortedKeys, key, side="right")
+            if end > start:
+                slices.append(np.arange(start, end))
+
+        if not slices:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        positions = np.concatenate(slices)
+        distances = np.abs(self.sortedMeans[positions] - target).max(axis=1)
+        keep = distances <= tolerance
+        return self.order[positions[keep]], distances[keep]
+
+
+class SearchIndex:
+    """
+    Per-block-size lookup of search image windows by average colour.
+
+    Window sums are derived from integral images of the search image, so
+    every block size costs one pass over the image regardless of how many
+    blocks of that size are matched afterwards. With an IndexCache the
+    per-size arrays are persisted, and a warm index never builds the
+    integral images at all.
+    """
+
+    def __init__(
+        self,
+        searchArray: np.ndarray,
+        averageType: str,
+        tolerance: float = 1.0,
+        cache: IndexCache | None = None,
+        imageHash: str | None = None
+    ) -> None:
+        """
+        Initialize the index.
+
+        Args:
+            searchArray: (H, W, 3) uint8 RGB search image
+            averageType: Type of averaging ('gammacorrected', 'linear' or 'srgb')
+            tolerance: Default per-channel match tolerance in sRGB units
+            cache: Optional persistent cache for per-size arrays
+            imageHash: Content hash of the search image, required with cache
+        """
+        if cache is not None and imageHash is None:
+            raise ValueError("imageHash is required when a cache is given")
+        self.searchArray = searchArray
+        self.averageType = averageType
+        self.tolerance = tolerance
+        self.cache = cache
+        self.imageHash = imageHash
+        self.height, self.width = searchArray.shape[:2]
+
+        self._workingArray: np.ndarray | None = None
+        self._integral: np.ndarray | None = None
+        self._integralSquared: np.ndarray | None = None
+        self._arrays: Dict[Tuple[int, int, str], np.ndarray] = {}
+        self._buckets: Dict[Tuple[int, int], ColorBuckets] = {}
+        self._memos: Dict[Tuple[int, int, str], Dict[int, MatchSet]] = {}
+        self._memoStored: Dict[Tuple[int, int, str], int] = {}
+        # Batch and service threads share an index; one memo store at a time
+        self._memoLock = threading.Lock()
+
+    @property
+    def workingArray(self) -> np.ndarray:
+        """(H, W, 3) float32 search image in the working colour space."""
+        if self._workingArray is None:
+            # Whole-image arrays are cached under block size 0x0
+            working = self._cached(
+                0, 0, "working",
+                lambda: toWorkingSpace(self.searchArray[:, :, :3], self.averageType)
+            )
+            if working.flags.writeable:
+                working.flags.writeable = False
+            self._workingArray = working
+        return self._workingArray
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the arrays built so far.
+
+        Arrays memory-mapped from an IndexCache are not counted, as the OS
+        page cache holds them and reclaims them under pressure.
+        """
+        arrays = {
+            id(a): a
+            for a in (self._workingArray, self._integral, self._integralSquared,
+                      *self._arrays.values())
+            if a is not None and not isinstance(a, np.memmap)
+        }
+        # Three 4-byte fields per memoized candidate
+        memoBytes = sum(
+            12 * len(matches) for memo in self._memos.values() for matches in memo.values()
+        )
+        return sum(a.nbytes for a in arrays.values()) + memoBytes
+
+    def _buildIntegrals(self) -> None:
+        # Filled in locals and published at the end, so an index shared
+        # between threads never exposes a half-built integral image
+        logger.debug("Building integral images of the search image")
+        working = self.workingArray
+        integral = np.zeros((self.height + 1, self.width + 1, 3), dtype=np.float64)
+        np.cumsum(working, axis=0, dtype=np.float64, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+
+        # Squared values summed over channels, as TM_SQDIFF_NORMED uses them
+        integralSquared = np.zeros((self.height + 1, self.width + 1), dtype=np.float64)
+        np.cumsum(
+            np.square(working, dtype=np.float64).sum(axis=2),
+            axis=0,
+            out=integralSquared[1:, 1:]
+        )
+        np.cumsum(integralSquared[1:, 1:], axis=1, out=integralSquared[1:, 1:])
+
+        self._integral = integral
+        self._integralSquared = integralSquared
+
+    @property
+    def integral(self) -> np.ndarray:
+        """(H + 1, W + 1, 3) integral image of working space values."""
+        if self._integral is None:
+            self._buildIntegrals()
+        return cast(np.ndarray, self._integral)
+
+    @property
+    def integralSquared(self) -> np.ndarray:
+        """(H + 1, W + 1) integral image of squared values summed over channels."""
+        if self._integralSquared is None:
+            self._buildIntegrals()
+        return cast(np.ndarray, self._integralSquared)
+
+    @property
+    def textBands(self) -> np.ndarray:
+        """(K, 4) text line bands of the search image, see detectTextBands()."""
+        return self._cached(0, 0, "textBands", lambda: detectTextBands(self.searchArray))
+
+    def bandMask(self, width: int, height: int) -> np.ndarray:
+        """
+        Windows of the given size that overlap a text band.
+
+        A window off every band holds background only, or lies between
+        lines where no rendered text sits. An image without bands
+        restricts nothing.
+
+        Args:
+            width: Window width
+            height: Window height
+
+        Returns:
+            (H - height + 1, W - width + 1) bool array
+        """
+        def compute() -> np.ndarray:
+            shape = (self.height - height + 1, self.width - width + 1)
+            if len(self.textBands) == 0:
+                return np.ones(shape, dtype=bool)
+            mask = np.zeros(shape, dtype=bool)
+            for top, bottom, left, right in self.textBands.tolist():
+                mask[max(top - height + 1, 0):bottom, max(left - width + 1, 0):right] = True
+            logger.debug(
+                "Text bands keep %d of %d %dx%d windows", mask.sum(), mask.size, width, height
+            )
+            return mask
+
+        return self._cached(width, height, "bandMask", compute)
+
+    @property
+    def lineHeight(self) -> int:
+        """Most common distance between the tops of text bands, 0 for fewer than two."""
+        tops = self.textBands[:, 0]
+        if len(tops) < 2:
+            return 0
+        distances, counts = np.unique(np.diff(tops), return_counts=True)
+        return int(distances[np.argmax(counts)])
+
+    def _lineTops(self) -> np.ndarray:
+        # One more line above the first band, for windows starting above it
+        tops = self.textBands[:, 0]
+        return np.concatenate(([tops[0] - self.lineHeight], tops))
+
+    def linePhase(self, ys: np.ndarray) -> np.ndarray:
+        """
+        Offset of window rows from the top of the text line they start in.
+
+        Every window of one pixelated row lies at the same offset within
+        its line, so one match fixes the rows to search for the others.
+        Requires lineHeight.
+
+        Args:
+            ys: Window top rows
+
+        Returns:
+            Offsets in [0, lineHeight)
+        """
+        tops = self._lineTops()
+        line = np.maximum(np.searchsorted(tops, ys, side="right") - 1, 0)
+        return (np.asarray(ys) - tops[line]) % self.lineHeight
+
+    def phaseMask(self, width: int, height: int, phase: int) -> np.ndarray:
+        """
+        bandMask() windows at one linePhase().
+
+        Args:
+            width: Window width
+            height: Window height
+            phase: Offset of the window top from its line top
+
+        Returns:
+            (H - height + 1, W - width + 1) bool array
+        """
+        mask = self.bandMask(width, height)
+        rows = self._lineTops() + phase
+        keep = np.zeros(mask.shape[0], dtype=bool)
+        keep[rows[(rows >= 0) & (rows < mask.shape[0])]] = True
+        return mask & keep[:, None]
+
+    def _cached(
+        self,
+        width: int,
+        height: int,
+        name: str,
+        compute: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        """Return a per-size array from memory, the cache, or compute()."""
+        key = (width, height, name)
+        if key in self._arrays:
+            return self._arrays[key]
+
+        array = None
+        if self.cache is not None:
+            entry = self.cache.entryKey(
+                cast(str, self.imageHash), width, height, self.averageType
+            )
+            array = self.cache.load(entry, name)
+            if array is None:
+                array = compute()
+                self.cache.store(entry, name, array)
+        else:
+            array = compute()
+
+        self._arrays[key] = array
+        return array
+
+    def matchMemo(self, width: int, height: int, setting: str) -> Dict[int, MatchSet]:
+        """
+        Memoized match sets of one block size and matcher setting.
+
+        Blocks of one colour and size match the same windows, so matchers
+        store each result here under the packed 0xRRGGBB block colour and
+        later blocks, also of later images, look it up. With a cache, the
+        memo starts from the one saved by storeMatchMemo() in earlier runs.
+
+        Args:
+            width: Block width
+            height: Block height
+            setting: Matcher name and every option its result depends on
+
+        Returns:
+            Mutable dict from packed colour to MatchSet
+        """
+        key = (width, height, setting)
+        memo = self._memos.get(key)
+        if memo is None:
+            memo = {}
+            if self.cache is not None:
+                entry = self.cache.entryKey(
+                    cast(str, self.imageHash), width, height, self.averageType
+                )
+                rows = self.cache.load(entry, f"memo-{setting}")
+                if rows is not None:
+                    memo = _decodeMemo(np.asarray(rows), width, height)
+            self._memoStored.setdefault(key, len(memo))
+            memo = self._memos.setdefault(key, memo)
+        return memo
+
+    def storeMatchMemo(self, width: int, height: int, setting: str) -> None:
+        """
+        Save a matchMemo() to the cache if it gained entries since loading.
+
+        Args:
+            width: Block width
+            height: Block height
+            setting: Matcher setting passed to matchMemo()
+        """
+        key = (width, height, setting)
+        memo = self._memos.get(key)
+        if self.cache is None or memo is None:
+            return
+        with self._memoLock:
+            if len(memo) == self._memoStored.get(key):
+                return
+            items = list(memo.items())
+            self._memoStored[key] = len(items)
+            entry = self.cache.entryKey(
+                cast(str, self.imageHash), width, height, self.averageType
+            )
+            self.cache.store(entry, f"memo-{setting}", _encodeMemo(items))
+
+    @staticmethod
+    def _boxSums(s: np.ndarray, width: int, height: int) -> np.ndarray:
+        return (
+            s[height:, width:] - s[:-height, width:]
+            - s[height:, :-width] + s[:-height, :-width]
+        )
+
+    def windowSums(self, width: int, height: int) -> np.ndarray:
+        """
+        Sum of working space values for every window of the given size.
+
+        Args:
+            width: Window width
+            height: Window height
+
+        Returns:
+            (H - height + 1, W - width + 1, 3) float64 array
+        """
+        return self._cached(
+            width, height, "sums",
+            lambda: self._boxSums(self.integral, width, height)
+        )
+
+    def windowSquaredSums(self, width: int, height: int) -> np.ndarray:
+        """
+        Sum of squared working space values (over all channels) per window.
+
+        Args:
+            width: Window width
+            height: Window height
+
+        Returns:
+            (H - height + 1, W - width + 1) float64 array
+        """
+        return self._cached(
+            width, height, "squaredSums",
+            lambda: self._boxSums(self.integralSquared, width, height)
+        )
+
+    @staticmethod
+    def _wrappingIntegral(values: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        """Integral image of values accumulated in dtype, wrapping around."""
+        integral = np.zeros(
+            (values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:], dtype=dtype
+        )
+        np.cumsum(values, axis=0, dtype=dtype, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+        return integral
+
+    def _integerWindowSums(self, width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Each output band is summed from the rows it covers, so no
+        # whole-image integral is kept. Band integrals wrap around in the
+        # output dtype; their box sums are still exact as the window sums fit
+        levels = integerLevels(self.averageType)
+        top = int(levels[-1])
+        sumType = np.min_scalar_type(top * width * height)
+        squaredType = np.min_scalar_type(3 * top * top * width * height)
+        rows, columns = self.height - height + 1, self.width - width + 1
+        sums = np.empty((rows, columns, 3), dtype=sumType)
+        squaredSums = np.empty((rows, columns), dtype=squaredType)
+        for start in range(0, rows, INTEGER_BAND_ROWS):
+            stop = min(start + INTEGER_BAND_ROWS, rows)
+            band = self.searchArray[start:stop + height - 1, :, :3]
+            # 'gammacorrected' levels are the stored values, so read the uint8 image
+            values = band if self.averageType == "gammacorrected" else levels[band]
+            sums[start:stop] = self._boxSums(
+                self._wrappingIntegral(values, sumType), width, height
+            )
+            squared = np.square(values, dtype=squaredType).sum(axis=2, dtype=squaredType)
+            squaredSums[start:stop] = self._boxSums(
+                self._wrappingIntegral(squared, squaredType), width, height
+            )
+        return sums, squaredSums
+
+    def _integerCached(self, width: int, height: int, field: int) -> np.ndarray:
+        built: List[Tuple[np.ndarray, np.ndarray]] = []
+
+        def compute() -> np.ndarray:
+            if not built:
+                built.append(self._integerWindowSums(width, height))
+            return built[0][field]
+
+        # Named for the 16-bit levels, apart from caches of other precisions
+        name = ("levelSums", "levelSquaredSums")[field]
+        return self._cached(width, height, name, compute)
+
+    def windowIntegerSums(self, width: int, height: int) -> np.ndarray:
+        """
+        Exact sum of integerLevels() values for every window of the given size.
+
+        Args:
+            width: Window width
+            height: Window height
+
+        Returns:
+            (H - height + 1, W - width + 1, 3) array of the smallest unsigned
+            dtype holding the largest possible sum: uint16 for
+            'gammacorrected' windows of up to 257 pixels, uint32 for the
+            linear types up to 65537
+        """
+        return self._integerCached(width, height, 0)
+
+    def windowIntegerSquaredSums(self, width: int, height: int) -> np.ndarray:
+        """
+        Exact sum of squared integerLevels() values (over all channels) per window.
+
+        Args:
+            width: Window width
+            height: Window height
+
+        Returns:
+            (H - height + 1, W - width + 1) array of the smallest unsigned
+            dtype holding three times the largest squared level per pixel:
+            uint32 for 'gammacorrected' windows of up to 22017 pixels,
+            uint64 otherwise
+        """
+        return self._integerCached(width, height, 1)
+
+    @staticmethod
+    def _groupRows(sums: np.ndarray, squaredSums: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """First occurrence and row number of every distinct (sums, squaredSums) row."""
+        # Sort one 64-bit hash of the row instead of the rows themselves,
+        # then check the groups, falling back to exact rows on a collision
+        keys = squaredSums.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        for channel, factor in enumerate(
+            (0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+        ):
+            keys ^= sums[:, channel].astype(np.uint64) * np.uint64(factor)
+            keys = (keys << np.uint64(29)) | (keys >> np.uint64(35))
+        _, first, rows = np.unique(keys, return_index=True, return_inverse=True)
+        if not (np.array_equal(sums[first][rows], sums)
+                and np.array_equal(squaredSums[first][rows], squaredSums)):
+            logger.debug("Window statistics hash collision, grouping exact rows")
+            _, first, rows = np.unique(
+                np.column_stack((sums, squaredSums)),
+                axis=0, return_index=True, return_inverse=True
+            )
+        return first, rows.ravel()
+
+    def distinctWindows(
+        self,
+        width: int,
+        height: int,
+        textBands: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Group the windows of a size by their exact integer statistics.
+
+        Windows with equal windowIntegerSums() and windowIntegerSquaredSums()
+        score equal against any single-colour template, so a matcher can
+        score each group once. Rendered text repeats a handful of glyphs,
+        so the number of groups grows with the text rather than the image.
+
+        Args:
+            width: Window width
+            height: Window height
+            textBands: Group only the windows in bandMask()
+
+        Returns:
+            Tuple of (ascending flat index of the first window of every
+            group, group number of every grouped window in raster order);
+            groups are numbered in order of their first window
+        """
+        built: List[Tuple[np.ndarray, np.ndarray]] = []
+
+        def group() -> Tuple[np.ndarray, np.ndarray]:
+            if not built:
+                sums = self.windowIntegerSums(width, height).reshape(-1, 3)
+                squaredSums = self.windowIntegerSquaredSums(width, height).ravel()
+                windows = None
+                if textBands:
+                    windows = np.flatnonzero(self.bandMask(width, height))
+                    sums, squaredSums = sums[windows], squaredSums[windows]
+                first, rows = self._groupRows(sums, squaredSums)
+                # Renumber groups in order of their first window
+                order = np.argsort(first)
+                rank = np.empty_like(order)
+                rank[order] = np.arange(len(order))
+                first = first[order] if windows is None else windows[first[order]]
+                built.append((first, rank[rows].astype(np.int32)))
+            return built[0]
+
+        prefix = "levelBandDistinct" if textBands else "levelDistinct"
+        return (
+            self._cached(width, height, f"{prefix}First", lambda: group()[0]),
+            self._cached(width, height, f"{prefix}Groups", lambda: group()[1]),
+        )
+
+    def distinctWindowOrder(
+        self,
+        width: int,
+        height: int,
+        textBands: bool = False
+    ) -> np.ndarray:
+        """
+        Flat window indices sorted by distinctWindows() group.
+
+        Args:
+            width: Window width
+            height: Window height
+            textBands: Order only the windows in bandMask()
+
+        Returns:
+            Window indices, raster order within a group
+        """
+        def compute() -> np.ndarray:
+            order = np.argsort(
+                self.distinctWindows(width, height, textBands)[1], kind="stable"
+            )
+            if textBands:
+                return np.flatnonzero(self.bandMask(width, height))[order]
+            return order
+
+        prefix = "levelBandDistinct" if textBands else "levelDistinct"
+        return self._cached(width, height, f"{prefix}Order", compute)
+
+    def windowMeans(self, width: int, height: int) -> np.ndarray:
+        """
+        Average sRGB colour (0-255) of every window of the given size.
+
+        Args:
+            width: Window width
+            height: Window height
+
+        Returns:
+            (H - height + 1, W - width + 1, 3) float32 array
+        """
+        means = self.windowSums(width, height) / (width * height)
+        return fromWorkingSpace(means, self.averageType).astype(np.float32)
+
+    def buckets(self, width: int, height: int) -> ColorBuckets:
+        """Return (building on first use) the colour buckets for a block size."""
+        key = (width, height)
+        if key in self._buckets:
+            return self._buckets[key]
+
+        logger.debug("Building search index for block size %dx%d", width, height)
+        cellSize = max(2.0 * self.tolerance, 1.0)
+        prefix = f"buckets{cellSize:g}"
+        built: List[ColorBuckets] = []
+
+        def bucketArray(field: str) -> Callable[[], np.ndarray]:
+            def compute() -> np.ndarray:
+                if not built:
+                    built.append(
+                        ColorBuckets.build(self.windowMeans(width, height), cellSize)
+                    )
+                return cast(np.ndarray, getattr(built[0], field))
+            return compute
+
+        self._buckets[key] = ColorBuckets(
+            self._cached(width, height, f"{prefix}-order", bucketArray("order")),
+            self._cached(width, height, f"{prefix}-keys", bucketArray("sortedKeys")),
+            self._cached(width, height, f"{prefix}-means", bucketArray("sortedMeans")),
+            cellSize,
+            self.width - width + 1
+        )
+        return self._buckets[key]
+
+    def findCandidates(
+        self,
+        color: Tuple[int, int, int],
+        width: int,
+        height: int,
+        limit: int | None = None,
+        textBands: bool = False,
+        phase: int | None = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find all windows whose average colour matches a block colour.
+
+        Args:
+            color: RGB colour of the pixelated block
+            width: Block width
+            height: Block height
+            limit: Optional maximum number of candidates to return
+            textBands: Only return windows in bandMask()
+            phase: With textBands, only return windows in phaseMask()
+
+        Returns:
+            Tuple of (x coordinates, y coordinates, distances), closest first
+        """
+        if width > self.width or height > self.height:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0, dtype=np.float32)
+
+        buckets = self.buckets(width, height)
+        indices, distances = buckets.query(color, self.tolerance)
+        if textBands:
+            mask = (
+                self.bandMask(width, height) if phase is None
+                else self.phaseMask(width, height, phase)
+            )
+            keep = mask.ravel()[indices]
+            indices, distances = indices[keep], distances[keep]
+
+        order = np.argsort(distances, kind="stable")
+        if limit is not None:
+            order = order[:limit]
+        indices = indices[order]
+        ys, xs = np.divmod(indices, buckets.windowWidth)
+        return xs, ys, distances[order]
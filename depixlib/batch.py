@@ -0,0 +1,554 @@
+"""
+Batch depixelization of many pixelated images against warm search images.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+from depixlib.colorspace import AVERAGE_TYPES
+from depixlib.functions_numpy import MATCHERS
+from depixlib.helpers import check_color, check_positive_int
+from depixlib.IndexCache import IndexCache
+from depixlib.LoadedImage import LoadedImage
+from depixlib.metrics import DISABLED, Metrics
+from depixlib.pipeline import depixelize
+from depixlib.SearchIndex import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = (".png", ".bmp", ".gif", ".jpg", ".jpeg", ".tif", ".tiff", ".webp")
+
+
+def _parseFlag(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def _parseColor(value: Any) -> Tuple[int, int, int] | None:
+    if value is None or isinstance(value, str):
+        return check_color(value)
+    r, g, b = (int(c) for c in value)
+    return (r, g, b)
+
+
+def _parseScoreThreshold(value: Any) -> float | None:
+    return None if value is None else float(value)
+
+
+# Per-image options a manifest may set, with the converter for each value.
+# Names match the long options of depix.py.
+JOB_OPTIONS: Dict[str, Callable[[Any], Any]] = {
+    "searchimage": str,
+    "outputimage": str,
+    "averagetype": str,
+    "backgroundcolor": _parseColor,
+    "matcher": str,
+    "tolerance": float,
+    "topk": int,
+    "scorethreshold": _parseScoreThreshold,
+    "noneighbourpass": _parseFlag,
+    "grid": _parseFlag,
+    "textbands": _parseFlag,
+    "nomatchmemo": _parseFlag,
+    "weightedaverage": _parseFlag,
+}
+
+
+class SearchImagePool:
+    """
+    Search images loaded once and shared by every job of a batch.
+
+    Each (path, average type, tolerance) gets one LoadedImage and one
+    SearchIndex. The index keeps its per-block-size arrays in memory, so only
+    the first job using a block size pays for building them. With maxBytes
+    set, trim() drops least recently used indexes once they hold more.
+    """
+
+    def __init__(
+        self,
+        cache: IndexCache | None = None,
+        maxBytes: int | None = None
+    ) -> None:
+        """
+        Initialize the pool.
+
+        Args:
+            cache: Optional on-disk cache backing every SearchIndex
+            maxBytes: Memory held by search images and indexes above which
+                trim() evicts them, unbounded if None
+        """
+        self.cache = cache
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._images: Dict[str, LoadedImage] = {}
+        self._indexes: OrderedDict[Tuple[str, str, float], SearchIndex] = OrderedDict()
+
+    def get(
+        self,
+        path: str,
+        averageType: str,
+        tolerance: float
+    ) -> Tuple[LoadedImage, SearchIndex]:
+        """
+        Return the warm search image and index, loading them on first use.
+
+        Args:
+            path: Search image path
+            averageType: Type of averaging ('gammacorrected', 'linear' or 'srgb')
+            tolerance: Per-channel colour tolerance for the 'index' matcher
+
+        Returns:
+            Tuple of (search image, search index)
+        """
+        path = os.path.abspath(path)
+        key = (path, averageType, tolerance)
+        with self._lock:
+            if key not in self._indexes:
+                if path not in self._images:
+                    logger.info("Loading search image from %s", path)
+                    self._images[path] = LoadedImage(path, self.cache)
+                image = self._images[path]
+                self._indexes[key] = SearchIndex(
+                    image.array, averageType, tolerance, self.cache, image.contentHash
+                )
+            self._indexes.move_to_end(key)
+            return self._images[path], self._indexes[key]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the pooled search images and their indexes."""
+        with self._lock:
+            return self._nbytes()
+
+    def _nbytes(self) -> int:
+        return (
+            sum(image.array.nbytes for image in self._images.values())
+            + sum(index.nbytes for index in self._indexes.values())
+        )
+
+    def trim(self) -> int:
+        """
+        Evict least recently used indexes until the pool fits maxBytes.
+
+        The most recently used index is always kept. Jobs still holding an
+        evicted index finish with it; later jobs rebuild it.
+
+        Returns:
+            Number of evicted indexes
+        """
+        if self.maxBytes is None:
+            return 0
+        evicted = 0
+        with self._lock:
+            while len(self._indexes) > 1 and self._nbytes() > self.maxBytes:
+                (path, averageType, tolerance), _ = self._indexes.popitem(last=False)
+                if all(key[0] != path for key in self._indexes):
+                    del self._images[path]
+                logger.info(
+                    "Evicted search index of %s (%s, tolerance %g)",
+                    path, averageType, tolerance
+                )
+                evicted += 1
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+
+def collectJobs(
+    source: str,
+    defaults: Dict[str, Any],
+    outputDirectory: str
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield one job per pixelated image of a directory or manifest.
+
+    A directory yields every image file in it, with the default options. A
+    manifest is a JSON Lines file with one object per image: "pixelimage" is
+    required and any key of JOB_OPTIONS overrides the default for that
+    image. Relative paths in a manifest are relative to the manifest.
+
+    Args:
+        source: Directory of pixelated images or manifest file
+        defaults: Option values for keys a job does not set
+        outputDirectory: Where outputs go unless a job sets "outputimage"
+
+    Returns:
+        Iterator of job dictionaries with "pixelimage" and all JOB_OPTIONS
+    """
+    sourcePath = Path(source)
+    if sourcePath.is_dir():
+        entries: Iterable[Tuple[int, Dict[str, Any]]] = (
+            (0, {"pixelimage": p.name})
+            for p in sorted(sourcePath.iterdir())
+            if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES
+        )
+        base = sourcePath
+    else:
+        entries = _readManifest(sourcePath)
+        base = sourcePath.parent
+
+    for lineNumber, entry in entries:
+        if "pixelimage" not in entry:
+            raise ValueError(f"{source}:{lineNumber}: missing 'pixelimage'")
+        unknown = set(entry) - set(JOB_OPTIONS) - {"pixelimage"}
+        if unknown:
+            raise ValueError(
+                f"{source}:{lineNumber}: unknown options {sorted(unknown)}"
+            )
+
+        job = dict(defaults)
+        for name, value in entry.items():
+            if name in ("pixelimage", "searchimage", "outputimage"):
+                job[name] = str(base / value)
+            else:
+                job[name] = JOB_OPTIONS[name](value)
+        if job.get("outputimage") is None:
+            job["outputimage"] = str(
+                Path(outputDirectory) / (Path(job["pixelimage"]).stem + ".png")
+            )
+        if job.get("searchimage") is None:
+            raise ValueError(f"No search image given for {job['pixelimage']}")
+        if job["matcher"] not in MATCHERS:
+            raise ValueError(f"Unknown matcher {job['matcher']!r} for {job['pixelimage']}")
+        yield job
+
+
+def _readManifest(path: Path) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    with open(path, encoding="utf-8") as f:
+        for lineNumber, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict):
+                raise ValueError(f"{path}:{lineNumber}: expected a JSON object")
+            yield lineNumber, entry
+
+
+def depixelizeJob(
+    pixelatedImage: LoadedImage,
+    job: Dict[str, Any],
+    pool: SearchImagePool,
+    metrics: Metrics | None = None
+) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Depixelize one image with the options of a job and a warm search image.
+
+    Args:
+        pixelatedImage: Pixelated input image
+        job: Dictionary with all JOB_OPTIONS except "outputimage"
+        pool: Warm search images
+        metrics: Optional Metrics of this job
+
+    Returns:
+        Tuple of (output (H, W, 3) uint8 array, block counts per stage)
+    """
+    searchImage, searchIndex = pool.get(
+        job["searchimage"], job["averagetype"], job["tolerance"]
+    )
+    return depixelize(
+        pixelatedImage,
+        searchImage,
+        job["averagetype"],
+        backgroundColor=job["backgroundcolor"],
+        matcher=job["matcher"],
+        tolerance=job["tolerance"],
+        topK=job["topk"],
+        scoreThreshold=job["scorethreshold"],
+        neighbourPass=not job["noneighbourpass"],
+        blockGrid=job["grid"],
+        textBands=job["textbands"],
+        matchMemo=not job["nomatchmemo"],
+        weightedAverage=job["weightedaverage"],
+        searchIndex=searchIndex,
+        metrics=metrics
+    )
+
+
+def runJob(
+    job: Dict[str, Any],
+    pool: SearchImagePool,
+    metrics: Metrics | None = None
+) -> Dict[str, Any]:
+    """
+    Depixelize one image and save the output.
+
+    Args:
+        job: Job dictionary from collectJobs()
+        pool: Warm search images
+        metrics: Optional Metrics shared by all jobs; the job's own stage
+            times are also added to its record
+
+    Returns:
+        Result record for the JSONL log
+    """
+    record = {
+        "pixelimage": job["pixelimage"],
+        "searchimage": job["searchimage"],
+        "outputimage": job["outputimage"],
+    }
+    jobMetrics = Metrics() if metrics is not None else DISABLED
+    start = time.perf_counter()
+    try:
+        with jobMetrics.stage("load"):
+            pixelatedImage = LoadedImage(job["pixelimage"])
+        outputCanvas, stats = depixelizeJob(pixelatedImage, job, pool, jobMetrics)
+        output_path = Path(job["outputimage"])
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with jobMetrics.stage("save"):
+            Image.fromarray(outputCanvas).save(str(output_path))
+        record.update(status="ok", **stats)
+    except Exception as e:
+        logger.error("Failed to depixelize %s: %s", job["pixelimage"], e)
+        record.update(status="error", error=str(e))
+    record["seconds"] = round(time.perf_counter() - start, 4)
+    if metrics is not None:
+        jobMetrics.count(f"jobs.{record['status']}")
+        record["stages"] = jobMetrics.toDict()["stages"]
+        metrics.merge(jobMetrics)
+    return record
+
+
+def runBatch(
+    jobs: Iterable[Dict[str, Any]],
+    pool: SearchImagePool,
+    resultLog: str,
+    concurrency: int = 1,
+    metrics: Metrics | None = None
+) -> Tuple[int, int]:
+    """
+    Run jobs with at most `concurrency` in flight and log every result.
+
+    Jobs are pulled from the iterator only as slots free up, so a large
+    manifest is streamed rather than loaded up front. Result records are
+    appended to the JSONL log in completion order.
+
+    Args:
+        jobs: Job dictionaries from collectJobs()
+        pool: Warm search images shared by all jobs
+        resultLog: Path of the JSONL result log
+        concurrency: Number of images processed at the same time
+        metrics: Optional Metrics receiving the totals of all jobs
+
+    Returns:
+        Tuple of (succeeded, failed) job counts
+    """
+    succeeded = failed = 0
+    start = time.perf_counter()
+    Path(resultLog).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(resultLog, "a", encoding="utf-8") as log, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending: Set[Future] = set()
+        jobIterator = iter(jobs)
+        exhausted = False
+
+        while pending or not exhausted:
+            while not exhausted and len(pending) < concurrency:
+                job = next(jobIterator, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    pending.add(executor.submit(runJob, job, pool, metrics))
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                log.write(json.dumps(record) + "\n")
+                log.flush()
+                if record["status"] == "ok":
+                    succeeded += 1
+                else:
+                    failed += 1
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Batch done: %d succeeded, %d failed in %.1fs (%.1f images/min)",
+        succeeded,
+        failed,
+        elapsed,
+        60.0 * (succeeded + failed) / elapsed if elapsed > 0 else 0.0
+    )
+    return succeeded, failed
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    """Parse `depix batch` command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="depix batch",
+        description="Depixelize many images, loading each search image once.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+SOURCE is a directory of pixelated images or a JSON Lines manifest with one
+object per image, e.g.
+  {"pixelimage": "a.png", "searchimage": "search.png", "averagetype": "linear"}
+Manifest entries may set any of: """ + ", ".join(JOB_OPTIONS) + """
+
+Example usage:
+  python3 depix.py batch -s search.png -o outdir/ screenshots/
+  python3 depix.py batch -o outdir/ --jobs 4 manifest.jsonl
+        """
+    )
+    parser.add_argument(
+        "source",
+        metavar="SOURCE",
+        help="Directory of pixelated images or JSONL manifest"
+    )
+    parser.add_argument(
+        "-s", "--searchimage",
+        default=None,
+        metavar="PATH",
+        help="Default search image for jobs that do not set one"
+    )
+    parser.add_argument(
+        "-o", "--outputdir",
+        default="output",
+        metavar="PATH",
+        help="Directory for output images (default: output)"
+    )
+    parser.add_argument(
+        "--log",
+        default=None,
+        metavar="PATH",
+        help="JSONL result log (default: OUTPUTDIR/results.jsonl)"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        default=os.cpu_count() or 1,
+        type=check_positive_int,
+        metavar="N",
+        help="Images processed concurrently (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "-a", "--averagetype",
+        default="gammacorrected",
+        choices=AVERAGE_TYPES,
+        help="Type of RGB averaging (default: gammacorrected)"
+    )
+    parser.add_argument(
+        "-b", "--backgroundcolor",
+        default=None,
+        type=check_color,
+        metavar="R,G,B",
+        help="Background color to ignore (format: r,g,b)"
+    )
+    parser.add_argument(
+        "-m", "--matcher",
+        default="template",
+        choices=MATCHERS,
+        help="Block matching strategy (default: template)"
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=1.0,
+        type=float,
+        metavar="N",
+        help="Per-channel colour tolerance for the index matcher (default: 1.0)"
+    )
+    parser.add_argument(
+        "-k", "--topk",
+        default=1,
+        type=check_positive_int,
+        metavar="N",
+        help="Candidate matches kept per block (all matchers except index, default: 1)"
+    )
+    parser.add_argument(
+        "--scorethreshold",
+        default=None,
+        type=float,
+        metavar="F",
+        help="Maximum match score of a candidate (all matchers except index)"
+    )
+    parser.add_argument(
+        "--grid",
+        action="store_true",
+        help="Detect the block grid instead of following exact colour runs"
+    )
+    parser.add_argument(
+        "--textbands",
+        action="store_true",
+        help=(
+            "Only match windows overlapping a line of text in the search image, "
+            "and after the fullest row of blocks only those at its offset in the line"
+        )
+    )
+    parser.add_argument(
+        "--noneighbourpass",
+        action="store_true",
+        help="Do not resolve multiple matches from neighbouring blocks"
+    )
+    parser.add_argument(
+        "--nomatchmemo",
+        action="store_true",
+        help="Search every block instead of once per block size and colour"
+    )
+    parser.add_argument(
+        "--weightedaverage",
+        action="store_true",
+        help="Weight ambiguous matches by match score when averaging them"
+    )
+    parser.add_argument(
+        "--cachedir",
+        default=None,
+        metavar="PATH",
+        help="Directory for cached decoded search images and indexes"
+    )
+    parser.add_argument(
+        "--cachesize",
+        default=2048,
+        type=int,
+        metavar="MB",
+        help="Size cap of the index cache in megabytes (default: 2048)"
+    )
+    parser.add_argument(
+        "--metricsjson", "--metrics-json",
+        default=None,
+        metavar="PATH",
+        help="Write stage times and counters summed over all images as JSON"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Log every pipeline stage of every image"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    """Entry point of `depix batch`."""
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.getLogger("depixlib").setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+
+    cache = None
+    if args.cachedir:
+        cache = IndexCache(args.cachedir, args.cachesize * 1024 * 1024)
+
+    defaults = {name: getattr(args, name) for name in JOB_OPTIONS if hasattr(args, name)}
+    defaults["outputimage"] = None
+    jobs = collectJobs(args.source, defaults, args.outputdir)
+    resultLog = args.log or str(Path(args.outputdir) / "results.jsonl")
+
+    metrics = Metrics() if args.metricsjson else None
+    _, failed = runBatch(jobs, SearchImagePool(cache), resultLog, args.jobs, metrics)
+    if metrics is not None:
+        metrics.writeJson(args.metricsjson)
+    if failed:
+        raise SystemExit(1)
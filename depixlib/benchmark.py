@@ -0,0 +1,516 @@
+"""
+Reproducible benchmark of the whole pipeline over the bundled images.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from depixlib.batch import IMAGE_SUFFIXES
+from depixlib.colorspace import AVERAGE_TYPES, toWorkingSpace
+from depixlib.functions import findSameColorSubRectangles
+from depixlib.functions_numpy import MATCHERS
+from depixlib.helpers import check_positive_int
+from depixlib.LoadedImage import LoadedImage
+from depixlib.metrics import Metrics
+from depixlib.pipeline import depixelize
+from depixlib.Rectangle import Rectangle
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Version of the report layout, bumped when fields change meaning
+REPORT_VERSION = 1
+
+# Stage times below this many seconds are too noisy to flag as regressions
+TIME_NOISE_FLOOR = 0.1
+
+# Largest accepted drop in pixel accuracy before a case counts as regressed
+ACCURACY_SLACK = 0.005
+
+
+def referenceFor(pixelatedPath: Path) -> Path | None:
+    """
+    Unpixelated original of a bundled pixelated image, if there is one.
+
+    `name_pixels.png` and `name_pixels_gimp.png` both map to `name.png`.
+
+    Args:
+        pixelatedPath: Path of a pixelated test image
+
+    Returns:
+        Path of the original image, or None
+    """
+    stem = pixelatedPath.stem.split("_pixels")[0]
+    for suffix in (pixelatedPath.suffix,) + IMAGE_SUFFIXES:
+        candidate = pixelatedPath.with_name(stem + suffix)
+        if candidate != pixelatedPath and candidate.is_file():
+            return candidate
+    return None
+
+
+def _images(directory: Path) -> List[Path]:
+    return sorted(
+        path for path in directory.iterdir()
+        if path.suffix.lower() in IMAGE_SUFFIXES
+    )
+
+
+def collectCases(testDirectory: str, searchDirectory: str) -> List[Dict[str, Any]]:
+    """
+    Every pairing of a pixelated test image with a search image.
+
+    Pixelated images are the files with `_pixels` in their name.
+
+    Args:
+        testDirectory: Directory of pixelated images and their originals
+        searchDirectory: Directory of search images
+
+    Returns:
+        Case dicts with pixelimage, searchimage and reference paths
+    """
+    pixelated = [path for path in _images(Path(testDirectory)) if "_pixels" in path.stem]
+    searchImages = _images(Path(searchDirectory))
+    cases = []
+    for pixelPath in pixelated:
+        reference = referenceFor(pixelPath)
+        for searchPath in searchImages:
+            cases.append({
+                "pixelimage": str(pixelPath),
+                "searchimage": str(searchPath),
+                "reference": str(reference) if reference else None,
+            })
+    return cases
+
+
+def registerReference(
+    pixelatedImage: LoadedImage,
+    reference: np.ndarray,
+    averageType: str
+) -> Tuple[int, int] | None:
+    """
+    Locate a pixelated crop inside its unpixelated original.
+
+    Every offset is scored by how well the original's block averages, in
+    the averaging space of the run, reproduce the pixelated block colours.
+
+    Args:
+        pixelatedImage: Pixelated image
+        reference: (H, W, 3) uint8 original, at least as large
+        averageType: Type of averaging ('gammacorrected', 'linear' or 'srgb')
+
+    Returns:
+        (x, y) of the crop in the original, or None if it cannot fit
+    """
+    height, width = pixelatedImage.height, pixelatedImage.width
+    rangeY = reference.shape[0] - height + 1
+    rangeX = reference.shape[1] - width + 1
+    if rangeY < 1 or rangeX < 1:
+        return None
+
+    blocks = findSameColorSubRectangles(
+        pixelatedImage, Rectangle((0, 0), (width - 1, height - 1))
+    )
+    integral = cv2.integral(toWorkingSpace(reference, averageType), sdepth=cv2.CV_64F)
+    colors = toWorkingSpace(blocks.colors, averageType).astype(np.float64)
+
+    error = np.zeros((rangeY, rangeX))
+    for x, y, w, h, color in zip(blocks.x, blocks.y, blocks.width, blocks.height, colors):
+        sums = (
+            integral[y + h:y + h + rangeY, x + w:x + w + rangeX]
+            - integral[y:y + rangeY, x + w:x + w + rangeX]
+            - integral[y + h:y + h + rangeY, x:x + rangeX]
+            + integral[y:y + rangeY, x:x + rangeX]
+        )
+        error += np.square(sums / (w * h) - color).sum(axis=2) * (w * h)
+    offsetY, offsetX = np.unravel_index(int(np.argmin(error)), error.shape)
+    return int(offsetX), int(offsetY)
+
+
+def pixelAccuracy(output: np.ndarray, target: np.ndarray, tolerance: int) -> Dict[str, float]:
+    """
+    Compare an image with its ground truth.
+
+    Args:
+        output: (H, W, 3) uint8 image
+        target: (H, W, 3) uint8 ground truth of the same shape
+        tolerance: Largest per-channel difference of a correct pixel
+
+    Returns:
+        Dict with the fraction of correct pixels and the mean absolute error
+    """
+    difference = np.abs(output.astype(np.int16) - target.astype(np.int16))
+    return {
+        "accuracy": float(np.mean(difference.max(axis=2) <= tolerance)),
+        "meanAbsError": float(difference.mean()),
+    }
+
+
+def _peakRssMB() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def runCase(case: Dict[str, Any], options: Dict[str, Any], tolerance: int = 16) -> Dict[str, Any]:
+    """
+    Run the pipeline on one case and measure it.
+
+    Args:
+        case: Case dict from collectCases()
+        options: Keyword arguments of depixelize()
+        tolerance: Per-channel tolerance of pixelAccuracy()
+
+    Returns:
+        Result dict with stage times, block counts, peak memory and accuracy
+    """
+    metrics = Metrics()
+    with metrics.stage("load"):
+        pixelatedImage = LoadedImage(case["pixelimage"])
+        searchImage = LoadedImage(case["searchimage"])
+
+    output, stats = depixelize(pixelatedImage, searchImage, metrics=metrics, **options)
+    total = sum(metrics.stages.values())
+
+    result: Dict[str, Any] = dict(case)
+    result.update(
+        stages={name: round(seconds, 6) for name, seconds in metrics.stages.items()},
+        total=round(total, 6),
+        blocks=stats,
+        matcherCalls=metrics.counters.get("matcherCalls", 0),
+        blocksPerSecond=round(stats["blocks"] / total, 1) if total > 0 else None,
+        peakRssMB=_peakRssMB(),
+        accuracy=None,
+        meanAbsError=None,
+        inputAccuracy=None,
+        referenceStatus=None,
+    )
+
+    if case.get("reference"):
+        reference = LoadedImage(case["reference"]).array
+        offset = registerReference(
+            pixelatedImage, reference, options.get("averageType", "gammacorrected")
+        )
+        if offset is None:
+            result["referenceStatus"] = "too small"
+            return result
+        x, y = offset
+        target = reference[y:y + pixelatedImage.height, x:x + pixelatedImage.width]
+        result["referenceOffset"] = [x, y]
+        if np.array_equal(target, pixelatedImage.array):
+            # The "original" holds the pixelated text itself
+            result["referenceStatus"] = "pixelated"
+            return result
+        result["referenceStatus"] = "ok"
+        scores = pixelAccuracy(output, target, tolerance)
+        result.update(scores)
+        result["inputAccuracy"] = pixelAccuracy(pixelatedImage.array, target, tolerance)["accuracy"]
+    return result
+
+
+def _bestRun(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    best = dict(min(runs, key=lambda run: run["total"]))
+    peaks = [run["peakRssMB"] for run in runs if run["peakRssMB"] is not None]
+    best["peakRssMB"] = round(max(peaks), 1) if peaks else None
+    best["runs"] = len(runs)
+    return best
+
+
+def _quietWorker() -> None:
+    logging.getLogger("depixlib").setLevel(logging.WARNING)
+
+
+def runCases(
+    cases: List[Dict[str, Any]],
+    options: Dict[str, Any],
+    repeat: int = 1,
+    isolate: bool = True,
+    tolerance: int = 16
+) -> List[Dict[str, Any]]:
+    """
+    Run every case, keeping the fastest of several runs.
+
+    Args:
+        cases: Case dicts from collectCases()
+        options: Keyword arguments of depixelize()
+        repeat: Runs per case
+        isolate: Run each case in a fresh process, so peak memory is its own
+            and no state is shared between cases
+        tolerance: Per-channel tolerance of pixelAccuracy()
+
+    Returns:
+        One result dict per case
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for number, case in enumerate(cases, 1):
+        runs = []
+        for _ in range(repeat):
+            if isolate:
+                with ProcessPoolExecutor(
+                    1, mp_context=context, initializer=_quietWorker
+                ) as executor:
+                    runs.append(executor.submit(runCase, case, options, tolerance).result())
+            else:
+                runs.append(runCase(case, options, tolerance))
+        result = _bestRun(runs)
+        logger.info(
+            "[%d/%d] %s x %s: %.3fs, %s blocks/s, accuracy %s",
+            number, len(cases),
+            Path(case["pixelimage"]).name, Path(case["searchimage"]).name,
+            result["total"], result["blocksPerSecond"],
+            "n/a" if result["accuracy"] is None else f"{result['accuracy']:.3f}"
+        )
+        results.append(result)
+    return results
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Totals over all cases.
+
+    Args:
+        results: Result dicts from runCases()
+
+    Returns:
+        Dict with summed stage times, block throughput and mean accuracy
+    """
+    stages: Dict[str, float] = {}
+    for result in results:
+        for name, seconds in result["stages"].items():
+            stages[name] = round(stages.get(name, 0.0) + seconds, 6)
+    total = sum(result["total"] for result in results)
+    blocks = sum(result["blocks"]["blocks"] for result in results)
+    accuracies = [result["accuracy"] for result in results if result["accuracy"] is not None]
+    peaks = [result["peakRssMB"] for result in results if result["peakRssMB"] is not None]
+    return {
+        "cases": len(results),
+        "stages": stages,
+        "total": round(total, 6),
+        "blocksPerSecond": round(blocks / total, 1) if total > 0 else None,
+        "peakRssMB": max(peaks) if peaks else None,
+        "meanAccuracy": float(np.mean(accuracies)) if accuracies else None,
+    }
+
+
+def compareReports(
+    report: Dict[str, Any],
+    baseline: Dict[str, Any],
+    threshold: float
+) -> List[str]:
+    """
+    Find cases that got slower, larger or less accurate than a baseline.
+
+    Args:
+        report: Current report
+        baseline: Earlier report of the same cases
+        threshold: Allowed relative increase of time and peak memory
+
+    Returns:
+        One message per regression, empty if there is none
+    """
+    def key(result: Dict[str, Any]) -> Tuple[str, str]:
+        return Path(result["pixelimage"]).name, Path(result["searchimage"]).name
+
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        name = " x ".join(key(result))
+        if (result["total"] > old["total"] * (1 + threshold)
+                and result["total"] - old["total"] > TIME_NOISE_FLOOR):
+            regressions.append(f"{name}: total {old['total']:.3f}s -> {result['total']:.3f}s")
+        if (result["peakRssMB"] is not None and old["peakRssMB"] is not None
+                and result["peakRssMB"] > old["peakRssMB"] * (1 + threshold)):
+            regressions.append(
+                f"{name}: peak memory {old['peakRssMB']:.1f} MB -> {result['peakRssMB']:.1f} MB"
+            )
+        if (result["accuracy"] is not None and old["accuracy"] is not None
+                and result["accuracy"] < old["accuracy"] - ACCURACY_SLACK):
+            regressions.append(
+                f"{name}: accuracy {old['accuracy']:.4f} -> {result['accuracy']:.4f}"
+            )
+    return regressions
+
+
+def _environment() -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    """Parse `depix benchmark` command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="depix benchmark",
+        description="Time the pipeline on every test image x search image pair.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Example usage:
+  python3 depix.py benchmark -o before.json
+  python3 depix.py benchmark -m sqdiff --repeat 3 -o after.json --baseline before.json
+        """
+    )
+    parser.add_argument(
+        "--testimages",
+        default="images/testimages",
+        metavar="DIR",
+        help="Pixelated images (*_pixels*) and originals (default: images/testimages)"
+    )
+    parser.add_argument(
+        "--searchimages",
+        default="images/searchimages",
+        metavar="DIR",
+        help="Search images (default: images/searchimages)"
+    )
+    parser.add_argument(
+        "-a", "--averagetype",
+        default="gammacorrected",
+        choices=AVERAGE_TYPES,
+        help="Type of RGB averaging (default: gammacorrected)"
+    )
+    parser.add_argument(
+        "-m", "--matcher",
+        default="template",
+        choices=MATCHERS,
+        help="Block matching strategy (default: template)"
+    )
+    parser.add_argument(
+        "-k", "--topk",
+        default=1,
+        type=check_positive_int,
+        metavar="N",
+        help="Candidate matches kept per block (all matchers except index, default: 1)"
+    )
+    parser.add_argument(
+        "--grid",
+        action="store_true",
+        help="Detect the block grid instead of following exact colour runs"
+    )
+    parser.add_argument(
+        "--textbands",
+        action="store_true",
+        help=(
+            "Only match windows overlapping a line of text in the search image, "
+            "and after the fullest row of blocks only those at its offset in the line"
+        )
+    )
+    parser.add_argument(
+        "--noneighbourpass",
+        action="store_true",
+        help="Do not resolve multiple matches from neighbouring blocks"
+    )
+    parser.add_argument(
+        "--nomatchmemo",
+        action="store_true",
+        help="Search every block instead of once per block size and colour"
+    )
+    parser.add_argument(
+        "--repeat",
+        default=1,
+        type=check_positive_int,
+        metavar="N",
+        help="Runs per case; the fastest is reported (default: 1)"
+    )
+    parser.add_argument(
+        "--inprocess",
+        action="store_true",
+        help="Run cases in this process instead of one fresh process per run"
+    )
+    parser.add_argument(
+        "--pixeltolerance",
+        default=16,
+        type=int,
+        metavar="N",
+        help="Largest per-channel difference of a correct pixel (default: 16)"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default=None,
+        metavar="PATH",
+        help="Write the JSON report here instead of to stdout"
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        metavar="PATH",
+        help="Earlier report; exit with status 1 if any case regressed"
+    )
+    parser.add_argument(
+        "--threshold",
+        default=0.10,
+        type=float,
+        metavar="F",
+        help="Allowed relative increase of time and memory (default: 0.10)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    """Entry point of `depix benchmark`."""
+    args = parse_args(argv)
+    _quietWorker()
+    logger.setLevel(logging.INFO)
+
+    options = dict(
+        averageType=args.averagetype,
+        matcher=args.matcher,
+        topK=args.topk,
+        blockGrid=args.grid,
+        textBands=args.textbands,
+        neighbourPass=not args.noneighbourpass,
+        matchMemo=not args.nomatchmemo,
+    )
+    cases = collectCases(args.testimages, args.searchimages)
+    if not cases:
+        raise SystemExit(f"No *_pixels images in {args.testimages}")
+
+    results = runCases(
+        cases, options, args.repeat, not args.inprocess, args.pixeltolerance
+    )
+    report = {
+        "version": REPORT_VERSION,
+        "environment": _environment(),
+        "options": dict(options, repeat=args.repeat, pixelTolerance=args.pixeltolerance),
+        "summary": summarize(results),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+        logger.info("Wrote report to %s", args.output)
+    else:
+        print(text)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compareReports(report, baseline, args.threshold)
+        for message in regressions:
+            logger.warning("Regression: %s", message)
+        if regressions:
+            raise SystemExit(1)
+        logger.info("No regressions against %s", args.baseline)
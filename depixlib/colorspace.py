@@ -0,0 +1,167 @@
+"""
+Colour spaces blocks are averaged in, as 256-entry lookup tables.
+"""
+from __future__ import annotations
+
+from typing import Dict
+import numpy as np
+import cv2
+
+GAMMA = 2.2
+
+# 'gammacorrected' averages the stored sRGB values as they are; 'linear'
+# averages light with the 2.2 power approximation, 'srgb' with the exact
+# piecewise sRGB transfer curve
+AVERAGE_TYPES = ("gammacorrected", "linear", "srgb")
+
+# Scale of fixed-point linear light, fine enough that all 256 levels differ
+LINEAR_FIXED_SCALE = 1 << 24
+
+# Largest integerLevels() value of the linear types
+INTEGER_LEVEL_SCALE = 65535
+
+
+def _srgbToLinear(values: np.ndarray) -> np.ndarray:
+    return np.where(
+        values <= 0.04045, values / 12.92, np.power((values + 0.055) / 1.055, 2.4)
+    )
+
+
+def _linearToSrgb(values: np.ndarray) -> np.ndarray:
+    return np.where(
+        values <= 0.0031308,
+        values * 12.92,
+        1.055 * np.power(values, 1.0 / 2.4) - 0.055
+    )
+
+
+def _buildTables() -> Dict[str, np.ndarray]:
+    # float32 throughout, so a lookup equals converting the pixels directly
+    levels = np.arange(256, dtype=np.float32) / 255.0
+    tables = {
+        "gammacorrected": levels,
+        "linear": np.power(levels, GAMMA),
+        "srgb": _srgbToLinear(levels.astype(np.float64)).astype(np.float32),
+    }
+    for table in tables.values():
+        table.flags.writeable = False
+    return tables
+
+
+# averageType -> (256,) float32 working-space value of every 8-bit level
+WORKING_TABLES = _buildTables()
+
+
+def _table(averageType: str) -> np.ndarray:
+    try:
+        return WORKING_TABLES[averageType]
+    except KeyError:
+        raise ValueError(
+            f"Unknown average type {averageType!r}, expected one of {AVERAGE_TYPES}"
+        ) from None
+
+
+def toWorkingSpace(array: np.ndarray, averageType: str) -> np.ndarray:
+    """
+    Convert uint8 RGB data to the float space blocks are averaged in.
+
+    A table lookup per value (cv2.LUT) rather than a division and a power
+    per value; the result is bit-identical to computing them in float32.
+
+    Args:
+        array: uint8 RGB array of any shape, typically (H, W, 3)
+        averageType: One of AVERAGE_TYPES
+
+    Returns:
+        float32 array of the same shape normalized to 0-1
+    """
+    table = _table(averageType)
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    if array.size == 0:
+        return np.zeros(array.shape, dtype=np.float32)
+    # One channel of N x 1, so any input shape works
+    return cv2.LUT(array.reshape(-1, 1), table).reshape(array.shape)
+
+
+def fromWorkingSpace(values: np.ndarray, averageType: str) -> np.ndarray:
+    """
+    Convert working space values back to sRGB in the 0-255 range.
+
+    Args:
+        values: Float array normalized to 0-1
+        averageType: One of AVERAGE_TYPES
+
+    Returns:
+        Float array of sRGB values in the 0-255 range
+    """
+    _table(averageType)
+    if averageType == "linear":
+        values = np.power(np.clip(values, 0.0, 1.0), 1.0 / GAMMA)
+    elif averageType == "srgb":
+        values = _linearToSrgb(np.clip(values, 0.0, 1.0))
+    return values * 255.0
+
+
+def fixedPointTable(averageType: str) -> np.ndarray:
+    """
+    Working-space value of every 8-bit level as int64 fixed point.
+
+    Sums of these are exact, so block means can be compared with the table
+    without rounding error.
+
+    Args:
+        averageType: One of AVERAGE_TYPES
+
+    Returns:
+        (256,) strictly increasing int64 array, LINEAR_FIXED_SCALE = 1.0
+    """
+    return np.round(_exactLevels(averageType) * LINEAR_FIXED_SCALE).astype(np.int64)
+
+
+def _exactLevels(averageType: str) -> np.ndarray:
+    """float64 working-space value of every 8-bit level."""
+    levels = np.arange(256) / 255.0
+    if averageType == "linear":
+        levels = np.power(levels, GAMMA)
+    elif averageType == "srgb":
+        levels = _srgbToLinear(levels)
+    else:
+        _table(averageType)
+    return levels
+
+
+def integerLevels(averageType: str) -> np.ndarray:
+    """
+    Working-space value of every 8-bit level as a 16-bit integer.
+
+    'gammacorrected' works on the stored levels themselves; the linear
+    types scale the working value to 0-INTEGER_LEVEL_SCALE and round. The
+    values are proportional to WORKING_TABLES up to that rounding, so
+    scale-invariant scores such as TM_SQDIFF_NORMED agree between the
+    domains; only levels 0 and 1 of 'linear' share a value.
+
+    Args:
+        averageType: One of AVERAGE_TYPES
+
+    Returns:
+        (256,) uint16 array
+    """
+    if averageType == "gammacorrected":
+        return np.arange(256, dtype=np.uint16)
+    return np.round(_exactLevels(averageType) * INTEGER_LEVEL_SCALE).astype(np.uint16)
+
+
+def fixedPointToSrgb8(values: np.ndarray, table: np.ndarray) -> np.ndarray:
+    """
+    Largest 8-bit level whose fixed-point value does not exceed each value.
+
+    The exact inverse of fixedPointTable(), truncating like int().
+
+    Args:
+        values: Integer array of fixed-point working-space values
+        table: Table from fixedPointTable()
+
+    Returns:
+        uint8 array of the same shape
+    """
+    return (np.searchsorted(table, values, side="right") - 1).clip(0, 255).astype(np.uint8)
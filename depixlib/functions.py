@@ -4,19 +4,156 @@ Core functions for Depix depixelization algorithm.
 from __future__ import annotations
 
 import logging
-from typing import List, Tuple, Dict
+from typing import Iterable, Tuple, Dict
 import numpy as np
-from PIL import Image
+from depixlib.BlockTable import BLOCK_MATCHED, BLOCK_SINGLE_MATCH, BlockTable, asBlockTable
 from depixlib.LoadedImage import LoadedImage
-from depixlib.Rectangle import ColorRectangle, Rectangle, RectangleMatch
+from depixlib.Rectangle import ColorRectangle, MatchSet, Rectangle
 
 logger = logging.getLogger(__name__)
 
+# Largest block edge the grid detector considers, in pixels
+MAX_GRID_PERIOD = 64
+
+# Share of edge energy that must fall on the grid lines to accept a grid
+GRID_MIN_SCORE = 0.5
+
+# Image rows processed at once when building edge profiles and cell sums
+GRID_BAND_ROWS = 1024
+
+
+def _runEnds(change: np.ndarray) -> np.ndarray:
+    """
+    For every cell, the index where its run along the last axis ends.
+
+    Args:
+        change: (..., N - 1) bool array, True where cell i + 1 differs from i
+
+    Returns:
+        (..., N) int array with the first index after each cell's run
+    """
+    n = change.shape[-1] + 1
+    boundaries = np.where(change, np.arange(1, n), n)
+    ends = np.full(change.shape[:-1] + (n,), n, dtype=np.int64)
+    ends[..., :-1] = np.minimum.accumulate(boundaries[..., ::-1], axis=-1)[..., ::-1]
+    return ends
+
+
+def _nextSmallerBelow(values: np.ndarray) -> np.ndarray:
+    """
+    For every cell, the first row below it holding a smaller value.
+
+    Uses binary lifting over a sparse table of column minima, so the cost is
+    O(rows * cols * log(rows)) in NumPy operations.
+
+    Args:
+        values: (R, K) integer array
+
+    Returns:
+        (R, K) int array of row indices, R where no smaller value follows
+    """
+    rows, cols = values.shape
+    columns = np.arange(cols)
+    minima = [values]
+    step = 1
+    while 2 * step <= rows:
+        previous = minima[-1]
+        minima.append(np.minimum(previous[:-step], previous[step:]))
+        step *= 2
+
+    position = np.arange(1, rows + 1)[:, None].repeat(cols, axis=1)
+    for level in range(len(minima) - 1, -1, -1):
+        span = 1 << level
+        table = minima[level]
+        valid = position + span <= rows
+        lookup = np.where(valid, position, 0)
+        extend = valid & (table[np.minimum(lookup, len(table) - 1), columns] >= values)
+        position = np.where(extend, position + span, position)
+    return position
+
+
+def findSameColorBlocks(
+    pixelatedImage: LoadedImage,
+    rectangle: Rectangle
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find all same-color sub-rectangles within the given rectangle as arrays.
+
+    Colour changes found with np.diff along both axes split the region into
+    a grid of uniformly coloured cells. Blocks are then grown over that grid
+    exactly as the original scan did: each block takes the colour run to its
+    right, extends down while the rows below repeat it, and the next column
+    of blocks starts after the last block of the current one.
+
+    Args:
+        pixelatedImage: The loaded pixelated image
+        rectangle: The rectangle to search within
+
+    Returns:
+        Tuple of (x, y, width, height, colors) arrays, colors being (N, 3)
+    """
+    region = pixelatedImage.array[
+        rectangle.y:rectangle.y + rectangle.height + 1,
+        rectangle.x:rectangle.x + rectangle.width + 1
+    ]
+    pixels = region.astype(np.uint32)
+    packed = (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | pixels[:, :, 2]
+
+    # Grid of uniform cells, delimited by every colour change in any row/column
+    xChange = (np.diff(packed, axis=1) != 0).any(axis=0)
+    yChange = (np.diff(packed, axis=0) != 0).any(axis=1)
+    xStarts = np.concatenate(([0], np.flatnonzero(xChange) + 1, [packed.shape[1]]))
+    yStarts = np.concatenate(([0], np.flatnonzero(yChange) + 1, [packed.shape[0]]))
+    cells = packed[yStarts[:-1][:, None], xStarts[:-1][None, :]]
+    rows, cols = cells.shape
+    columns = np.arange(cols)
+
+    # Width of each block in cells: its colour run to the right
+    widths = _runEnds(cells[:, 1:] != cells[:, :-1]) - columns
+    # Height: rows below with the same colour and at least the same run
+    colorEnds = _runEnds((cells[1:] != cells[:-1]).T).T
+    heights = np.minimum(colorEnds, _nextSmallerBelow(widths)) - np.arange(rows)[:, None]
+
+    # Walk every column's chain of blocks top to bottom in lockstep
+    chainRows = []
+    chainCols = []
+    lastWidths = np.zeros(cols, dtype=np.int64)
+    current = np.zeros(cols, dtype=np.int64)
+    while True:
+        active = np.flatnonzero(current < rows)
+        if len(active) == 0:
+            break
+        chainRows.append(current[active])
+        chainCols.append(active)
+        lastWidths[active] = widths[current[active], active]
+        current[active] += heights[current[active], active]
+
+    # Columns actually visited: each one starts after the last block of the previous
+    visited = np.zeros(cols, dtype=bool)
+    column = 0
+    while column < cols:
+        visited[column] = True
+        column += int(lastWidths[column])
+
+    J = np.concatenate(chainRows)
+    I = np.concatenate(chainCols)
+    keep = visited[I]
+    J, I = J[keep], I[keep]
+    order = np.lexsort((J, I))
+    J, I = J[order], I[order]
+
+    x = xStarts[I]
+    y = yStarts[J]
+    width = xStarts[I + widths[J, I]] - x
+    height = yStarts[J + heights[J, I]] - y
+    colors = region[y, x]
+    return x + rectangle.x, y + rectangle.y, width, height, colors
+
 
 def findSameColorSubRectangles(
     pixelatedImage: LoadedImage,
     rectangle: Rectangle
-) -> List[ColorRectangle]:
+) -> BlockTable:
     """
     Find all same-color sub-rectangles within the given rectangle.
     
@@ -25,149 +162,305 @@ def findSameColorSubRectangles(
         rectangle: The rectangle to search within
         
     Returns:
-        List of ColorRectangle objects
+        BlockTable of the blocks, iterable as ColorRectangle objects
     """
-    rects = []
-    x = rectangle.x
-    max_x = rectangle.x + rectangle.width + 1
-    max_y = rectangle.y + rectangle.height + 1
+    return BlockTable.fromArrays(*findSameColorBlocks(pixelatedImage, rectangle))
 
-    while x < max_x:
-        y = rectangle.y
-        while y < max_y:
-            start_color = pixelatedImage.imageData[x][y]
-            
-            # Find width of same-color block
-            width = 1
-            while (x + width < max_x and 
-                   pixelatedImage.imageData[x + width][y] == start_color):
-                width += 1
-            
-            # Find height of same-color block
-            height = 1
-            while y + height < max_y:
-                if all(pixelatedImage.imageData[x + dx][y + height] == start_color 
-                       for dx in range(width)):
-                    height += 1
-                else:
-                    break
-            
-            rects.append(ColorRectangle(
-                start_color,
-                (x, y),
-                (x + width, y + height)
-            ))
-            y += height
-        x += width
+
+def _edgeProfile(region: np.ndarray, axis: int) -> np.ndarray:
+    """Summed absolute colour difference between neighbouring rows or columns."""
+    if axis == 0:
+        profile = np.zeros(max(region.shape[0] - 1, 0), dtype=np.float64)
+        for start in range(0, region.shape[0] - 1, GRID_BAND_ROWS):
+            band = region[start:start + GRID_BAND_ROWS + 1].astype(np.int16)
+            profile[start:start + len(band) - 1] = np.abs(np.diff(band, axis=0)).sum(axis=(1, 2))
+        return profile
+
+    profile = np.zeros(max(region.shape[1] - 1, 0), dtype=np.float64)
+    for start in range(0, region.shape[0], GRID_BAND_ROWS):
+        band = region[start:start + GRID_BAND_ROWS].astype(np.int16)
+        profile += np.abs(np.diff(band, axis=1)).sum(axis=(0, 2))
+    return profile
+
+
+def _detectPeriod(profile: np.ndarray, length: int) -> Tuple[int, int, float]:
+    """
+    Find the period and phase of the edges in an edge profile.
+
+    The profile is folded modulo every candidate period, a comb correlation
+    with a grid of that period. The true period puts all edge energy on one
+    phase; its divisors spread the same energy over several phases and its
+    multiples lose half of it, so the score below peaks at the true period.
+
+    Args:
+        profile: Edge strength between position i and i + 1
+        length: Image extent along this axis
+
+    Returns:
+        Tuple of (period, phase of the grid lines, share of the edge energy
+        explained by the grid, in [0, 1])
+    """
+    total = profile.sum()
+    maxPeriod = min(MAX_GRID_PERIOD, length // 2)
+    if total == 0 or maxPeriod < 2:
+        # No edges: the whole extent is one block
+        return length, 0, 1.0
+
+    # Edge i lies on the boundary at position i + 1
+    positions = np.arange(1, len(profile) + 1)
+    best = (length, 0, 0.0)
+    bestScore = 0.0
+    for period in range(2, maxPeriod + 1):
+        folded = np.bincount(positions % period, weights=profile, minlength=period)
+        score = (folded.max() - folded.mean()) / total
+        if score > bestScore:
+            # A perfect grid of this period scores 1 - 1 / period
+            bestScore = score
+            best = (period, int(folded.argmax()), float(score / (1.0 - 1.0 / period)))
+    return best
+
+
+def detectBlockGrid(
+    pixelatedImage: LoadedImage,
+    rectangle: Rectangle
+) -> Tuple[int, int, int, int] | None:
+    """
+    Estimate the block size and grid offset of a pixelated region.
+
+    Horizontal and vertical edge profiles are analysed separately, so the
+    estimate tolerates noise such as JPEG artifacts that breaks exact
+    colour runs.
+
+    Args:
+        pixelatedImage: The loaded pixelated image
+        rectangle: The rectangle to search within
+
+    Returns:
+        Tuple of (block width, block height, x offset, y offset) relative to
+        the rectangle, or None if no regular grid was found
+    """
+    region = pixelatedImage.array[
+        rectangle.y:rectangle.y + rectangle.height + 1,
+        rectangle.x:rectangle.x + rectangle.width + 1
+    ]
+    height, width = region.shape[:2]
+    blockWidth, offsetX, scoreX = _detectPeriod(_edgeProfile(region, 1), width)
+    blockHeight, offsetY, scoreY = _detectPeriod(_edgeProfile(region, 0), height)
+    logger.debug(
+        "Grid estimate %dx%d+%d+%d (scores %.2f, %.2f)",
+        blockWidth, blockHeight, offsetX, offsetY, scoreX, scoreY
+    )
+    if min(scoreX, scoreY) < GRID_MIN_SCORE:
+        return None
+    return blockWidth, blockHeight, offsetX, offsetY
+
+
+def gridStarts(length: int, period: int, offset: int) -> np.ndarray:
+    """
+    Cell start positions of a grid, including partial cells at both ends.
+
+    Args:
+        length: Length of the axis
+        period: Cell size
+        offset: Position of any grid line
+
+    Returns:
+        Sorted start positions, beginning with 0
+    """
+    starts = np.arange(offset % period, length, period)
+    if len(starts) == 0 or starts[0] != 0:
+        starts = np.concatenate(([0], starts))
+    return starts
+
+
+def findGridBlocks(
+    pixelatedImage: LoadedImage,
+    rectangle: Rectangle,
+    grid: Tuple[int, int, int, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cut a region into the cells of a regular block grid.
+
+    Each cell becomes one block coloured with the rounded mean of its
+    pixels, which is the block colour itself on clean input and the best
+    estimate of it on noisy input.
+
+    Args:
+        pixelatedImage: The loaded pixelated image
+        rectangle: The rectangle to search within
+        grid: (block width, block height, x offset, y offset) relative to
+            the rectangle, as from detectBlockGrid()
+
+    Returns:
+        Tuple of (x, y, width, height, colors) arrays, colors being (N, 3)
+    """
+    region = pixelatedImage.array[
+        rectangle.y:rectangle.y + rectangle.height + 1,
+        rectangle.x:rectangle.x + rectangle.width + 1
+    ]
+    height, width = region.shape[:2]
+    blockWidth, blockHeight, offsetX, offsetY = grid
+    xStarts = gridStarts(width, blockWidth, offsetX)
+    yStarts = gridStarts(height, blockHeight, offsetY)
+    widths = np.diff(np.append(xStarts, width))
+    heights = np.diff(np.append(yStarts, height))
+
+    # Cell sums one band of cell rows at a time, to bound the uint32 copy
+    sums = np.empty((len(yStarts), len(xStarts), 3), dtype=np.float64)
+    bandCells = max(1, GRID_BAND_ROWS // blockHeight)
+    for first in range(0, len(yStarts), bandCells):
+        last = min(first + bandCells, len(yStarts))
+        top = yStarts[first]
+        bottom = yStarts[last] if last < len(yStarts) else height
+        band = region[top:bottom].astype(np.uint32)
+        rowSums = np.add.reduceat(band, yStarts[first:last] - top, axis=0)
+        sums[first:last] = np.add.reduceat(rowSums, xStarts, axis=1)
+    areas = heights[:, None, None] * widths[None, :, None]
+    colors = np.rint(sums / areas).astype(np.uint8)
+
+    y, x = np.meshgrid(yStarts, xStarts, indexing="ij")
+    h, w = np.meshgrid(heights, widths, indexing="ij")
+    # Column-major order, like findSameColorBlocks()
+    order = np.lexsort((y.ravel(), x.ravel()))
+    return (
+        x.ravel()[order] + rectangle.x,
+        y.ravel()[order] + rectangle.y,
+        w.ravel()[order],
+        h.ravel()[order],
+        colors.reshape(-1, 3)[order]
+    )
+
+
+def findGridSubRectangles(
+    pixelatedImage: LoadedImage,
+    rectangle: Rectangle,
+    grid: Tuple[int, int, int, int] | None = None
+) -> BlockTable:
+    """
+    Find the blocks of a regular pixelation grid.
     
-    return rects
+    Args:
+        pixelatedImage: The loaded pixelated image
+        rectangle: The rectangle to search within
+        grid: Known (block width, block height, x offset, y offset), detected
+            with detectBlockGrid() if None
+        
+    Returns:
+        BlockTable of the grid cells, or of findSameColorSubRectangles()
+        if no grid was found
+    """
+    if grid is None:
+        grid = detectBlockGrid(pixelatedImage, rectangle)
+        if grid is None:
+            logger.warning("No regular block grid found, using colour runs")
+            return findSameColorSubRectangles(pixelatedImage, rectangle)
+        logger.info("Detected %dx%d block grid at offset (%d, %d)", *grid)
+    return BlockTable.fromArrays(*findGridBlocks(pixelatedImage, rectangle, grid))
 
 
 def removeMootColorRectangles(
-    rects: List[ColorRectangle],
+    rects: BlockTable | Iterable[ColorRectangle],
     editorBackgroundColor: Tuple[int, int, int] | None
-) -> List[ColorRectangle]:
+) -> BlockTable:
     """
     Remove rectangles with moot colors (black, white, background).
     
     Args:
-        rects: List of color rectangles
+        rects: Table or list of color rectangles
         editorBackgroundColor: Optional background color to filter
         
     Returns:
-        Filtered list of color rectangles
+        Filtered table of color rectangles
     """
+    rects = asBlockTable(rects)
     moot_colors = [(0, 0, 0), (255, 255, 255)]
     if editorBackgroundColor:
         moot_colors.append(editorBackgroundColor)
     
-    filtered = [r for r in rects if r.color not in moot_colors]
+    filtered = rects.withoutColors(moot_colors)
     logger.debug("Removed %d moot color rectangles", len(rects) - len(filtered))
     return filtered
 
 
 def findRectangleSizeOccurences(
-    rects: List[ColorRectangle]
+    rects: BlockTable | Iterable[ColorRectangle]
 ) -> Dict[Tuple[int, int], int]:
     """
     Count occurrences of each rectangle size.
     
     Args:
-        rects: List of color rectangles
+        rects: Table or list of color rectangles
         
     Returns:
         Dictionary mapping (width, height) to occurrence count
     """
-    sizes: Dict[Tuple[int, int], int] = {}
-    for r in rects:
-        size = (r.width, r.height)
-        sizes[size] = sizes.get(size, 0) + 1
-    return sizes
+    return asBlockTable(rects).sizeCounts()
 
 
 def dropEmptyRectangleMatches(
-    rectangleMatches: Dict[Tuple[int, int], List[RectangleMatch]],
-    pixelatedSubRectangles: List[ColorRectangle]
-) -> List[ColorRectangle]:
+    rectangleMatches: Dict[Tuple[int, int], MatchSet],
+    pixelatedSubRectangles: BlockTable | Iterable[ColorRectangle]
+) -> BlockTable:
     """
     Remove rectangles that have no matches.
     
     Args:
         rectangleMatches: Dictionary of matches
-        pixelatedSubRectangles: List of rectangles
+        pixelatedSubRectangles: Table or list of rectangles
         
     Returns:
-        Filtered list of rectangles with matches
+        Filtered table of rectangles with matches, flagged BLOCK_MATCHED
     """
-    filtered = [
-        r for r in pixelatedSubRectangles
-        if (r.x, r.y) in rectangleMatches 
-        and len(rectangleMatches[(r.x, r.y)]) > 0
-    ]
+    table = asBlockTable(pixelatedSubRectangles)
+    matched = np.fromiter(
+        (
+            len(rectangleMatches.get((x, y), ())) > 0
+            for x, y in zip(table.x.tolist(), table.y.tolist())
+        ),
+        dtype=bool,
+        count=len(table)
+    )
+    filtered = table.filter(matched)
+    filtered.flags[:] |= BLOCK_MATCHED
     logger.debug(
         "Dropped %d rectangles with no matches",
-        len(pixelatedSubRectangles) - len(filtered)
+        len(table) - len(filtered)
     )
     return filtered
 
 
 def splitSingleMatchAndMultipleMatches(
-    pixelatedSubRectangles: List[ColorRectangle],
-    rectangleMatches: Dict[Tuple[int, int], List[RectangleMatch]]
-) -> Tuple[List[ColorRectangle], List[ColorRectangle]]:
+    pixelatedSubRectangles: BlockTable | Iterable[ColorRectangle],
+    rectangleMatches: Dict[Tuple[int, int], MatchSet],
+    searchImage: LoadedImage | None = None
+) -> Tuple[BlockTable, BlockTable]:
     """
     Split rectangles into single-match and multiple-match groups.
     
     Args:
-        pixelatedSubRectangles: List of rectangles
+        pixelatedSubRectangles: Table or list of rectangles
         rectangleMatches: Dictionary of matches
+        searchImage: Search image, used to treat matches with identical
+            pixel content as one; without it only positions are compared
         
     Returns:
         Tuple of (single_results, multi_results)
     """
-    single_results = []
-    multi_results = []
+    table = asBlockTable(pixelatedSubRectangles)
+    is_single = np.zeros(len(table), dtype=bool)
 
-    for r in pixelatedSubRectangles:
-        matches = rectangleMatches[(r.x, r.y)]
-        
-        if len(matches) == 1:
-            single_results.append(r)
-            continue
+    for i, (x, y) in enumerate(zip(table.x.tolist(), table.y.tolist())):
+        matches = rectangleMatches[(x, y)]
         
         # Check if all matches are identical
-        first_data = np.array(matches[0].data)
-        is_single = True
-        
-        for m in matches[1:]:
-            if not np.array_equal(first_data, np.array(m.data)):
-                is_single = False
-                break
-        
-        if is_single:
-            single_results.append(r)
+        if searchImage is not None:
+            is_single[i] = matches.allIdentical(searchImage.array)
         else:
-            multi_results.append(r)
+            is_single[i] = len(set(zip(matches.xs.tolist(), matches.ys.tolist()))) == 1
+    
+    table.flags[is_single] |= BLOCK_SINGLE_MATCH
+    single_results = table.filter(is_single)
+    multi_results = table.filter(~is_single)
     
     logger.debug(
         "Split: %d single matches, %d multiple matches",
@@ -177,83 +470,151 @@ def splitSingleMatchAndMultipleMatches(
     return single_results, multi_results
 
 
+def propagateNeighbourMatches(
+    singleResults: BlockTable,
+    multipleResults: BlockTable,
+    rectangleMatches: Dict[Tuple[int, int], MatchSet]
+) -> Tuple[BlockTable, BlockTable]:
+    """
+    Resolve multiple-match blocks from the offsets of resolved neighbours.
+    
+    Neighbouring blocks of one line of text come from neighbouring places in
+    the search image, so their matches sit at the same offset from the
+    block. A multiple-match block takes the candidate whose offset is shared
+    by the most resolved neighbours; ties stay ambiguous. Every resolved
+    block is then used for its own neighbours, until no block changes.
+    
+    Args:
+        singleResults: Blocks with a single match
+        multipleResults: Blocks with multiple matches
+        rectangleMatches: Dictionary of matches, updated in place with the
+            chosen match of every resolved block
+        
+    Returns:
+        Tuple of (single_results, multi_results) after propagation
+    """
+    if len(singleResults) == 0 or len(multipleResults) == 0:
+        return singleResults, multipleResults
+    table = BlockTable(np.concatenate([singleResults.records, multipleResults.records]))
+    
+    resolved = np.zeros(len(table), dtype=bool)
+    resolved[:len(singleResults)] = True
+    offsetKeys = np.zeros(len(table), dtype=np.int64)
+    for i in range(len(singleResults)):
+        x, y = int(table.x[i]), int(table.y[i])
+        first = rectangleMatches[(x, y)][0]
+        offsetKeys[i] = _offsetKey(first.x - x, first.y - y)
+    
+    neighbours = table.neighbours()
+    pending = [
+        i for i in range(len(singleResults), len(table))
+        if resolved[neighbours[i]].any()
+    ]
+    rounds = 0
+    while pending:
+        rounds += 1
+        newlyResolved = []
+        for i in pending:
+            if resolved[i]:
+                continue
+            x, y = int(table.x[i]), int(table.y[i])
+            matches = rectangleMatches[(x, y)]
+            known = neighbours[i][resolved[neighbours[i]]]
+            candidateKeys = _offsetKey(
+                matches.xs.astype(np.int64) - x, matches.ys.astype(np.int64) - y
+            )
+            votes = (candidateKeys[:, None] == offsetKeys[known][None, :]).sum(axis=1)
+            best = int(votes.argmax())
+            if votes[best] == 0 or (votes == votes[best]).sum() > 1:
+                continue
+            
+            rectangleMatches[(x, y)] = MatchSet(
+                matches.xs[best:best + 1],
+                matches.ys[best:best + 1],
+                matches.scores[best:best + 1],
+                matches.width,
+                matches.height
+            )
+            resolved[i] = True
+            offsetKeys[i] = candidateKeys[best]
+            newlyResolved.append(i)
+        
+        pending = sorted({
+            int(j) for i in newlyResolved for j in neighbours[i] if not resolved[j]
+        })
+    
+    table.flags[resolved] |= BLOCK_SINGLE_MATCH
+    logger.debug(
+        "Neighbour pass resolved %d blocks in %d rounds",
+        int(resolved.sum()) - len(singleResults),
+        rounds
+    )
+    return table.filter(resolved), table.filter(~resolved)
+
+
+def _offsetKey(dx: np.ndarray | int, dy: np.ndarray | int) -> np.ndarray:
+    """Pack a match offset (dx, dy) into one integer for comparisons."""
+    return (np.asarray(dy, dtype=np.int64) << 32) + np.asarray(dx, dtype=np.int64)
+
+
 def writeFirstMatchToImage(
-    singleMatchRectangles: List[ColorRectangle],
-    rectangleMatches: Dict[Tuple[int, int], List[RectangleMatch]],
+    singleMatchRectangles: BlockTable | Iterable[ColorRectangle],
+    rectangleMatches: Dict[Tuple[int, int], MatchSet],
     searchImage: LoadedImage,
-    unpixelatedOutputImage: Image.Image
+    outputCanvas: np.ndarray
 ) -> None:
     """
-    Write first match for each single-match rectangle to output image.
+    Write first match for each single-match rectangle to output canvas.
     
     Args:
-        singleMatchRectangles: List of rectangles with single matches
+        singleMatchRectangles: Rectangles with single matches
         rectangleMatches: Dictionary of matches
         searchImage: The search image
-        unpixelatedOutputImage: Output image to write to
+        outputCanvas: Writable (H, W, 3) uint8 output array
     """
     for r in singleMatchRectangles:
-        matches = rectangleMatches.get((r.x, r.y), [])
+        matches = rectangleMatches.get((r.x, r.y))
         
         if not matches:
             continue
-            
-        match = matches[0]
         
-        # Use match data (already extracted and flattened in dy->dx order)
-        idx = 0
-        for dy in range(r.height):
-            for dx in range(r.width):
-                if idx < len(match.data):
-                    color = match.data[idx]
-                    # Ensure color is tuple of ints
-                    if isinstance(color, tuple) and len(color) >= 3:
-                        color = tuple(int(c) for c in color[:3])
-                        unpixelatedOutputImage.putpixel((r.x + dx, r.y + dy), color)
-                idx += 1
+        outputCanvas[r.y:r.y + r.height, r.x:r.x + r.width] = matches[0].window(
+            searchImage.array, r.width, r.height
+        )
 
 
 def writeAverageMatchToImage(
-    pixelatedSubRectangles: List[ColorRectangle],
-    rectangleMatches: Dict[Tuple[int, int], List[RectangleMatch]],
+    pixelatedSubRectangles: BlockTable | Iterable[ColorRectangle],
+    rectangleMatches: Dict[Tuple[int, int], MatchSet],
     searchImage: LoadedImage,
-    unpixelatedOutputImage: Image.Image
+    outputCanvas: np.ndarray,
+    weighted: bool = False
 ) -> None:
     """
-    Write averaged matches for multiple-match rectangles to output image.
+    Write averaged matches for multiple-match rectangles to output canvas.
     
     Args:
-        pixelatedSubRectangles: List of rectangles with multiple matches
+        pixelatedSubRectangles: Rectangles with multiple matches
         rectangleMatches: Dictionary of matches
         searchImage: The search image
-        unpixelatedOutputImage: Output image to write to
+        outputCanvas: Writable (H, W, 3) uint8 output array
+        weighted: Weight each match by the inverse of its score, so closer
+            matches count more (matches without a score weigh 1)
     """
     for r in pixelatedSubRectangles:
-        matches = rectangleMatches.get((r.x, r.y), [])
+        matches = rectangleMatches.get((r.x, r.y))
         
         if not matches:
             continue
         
-        # Initialize accumulator
-        accumulator = np.zeros((r.height, r.width, 3), dtype=np.float32)
+        windows = matches.windows(searchImage.array).astype(np.float32)
         
-        # Average all matches
-        for match in matches:
-            idx = 0
-            for dy in range(r.height):
-                for dx in range(r.width):
-                    if idx < len(match.data):
-                        pixel = match.data[idx]
-                        if isinstance(pixel, tuple) and len(pixel) >= 3:
-                            accumulator[dy, dx] += np.array(pixel[:3], dtype=np.float32)
-                    idx += 1
-        
-        # Divide by number of matches
-        if len(matches) > 0:
-            accumulator = accumulator / len(matches)
+        if weighted:
+            weights = np.where(
+                np.isnan(matches.scores), 1.0, 1.0 / (matches.scores + 1e-6)
+            ).astype(np.float32)
+            average = np.tensordot(weights / weights.sum(), windows, axes=1)
+        else:
+            average = windows.mean(axis=0)
         
-        # Write to output image
-        for dy in range(r.height):
-            for dx in range(r.width):
-                color = tuple(int(c) for c in accumulator[dy, dx])
-                unpixelatedOutputImage.putpixel((r.x + dx, r.y + dy), color)
+        outputCanvas[r.y:r.y + r.height, r.x:r.x + r.width] = average.astype(np.uint8)
@@ -4,148 +4,1034 @@ NumPy-accelerated functions for fast template matching.
 from __future__ import annotations
 
 import logging
-from typing import Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import cv2
 
+from depixlib.BlockTable import BlockTable, asBlockTable
+from depixlib.colorspace import integerLevels, toWorkingSpace
+from depixlib.IndexCache import IndexCache
 from depixlib.LoadedImage import LoadedImage
-from depixlib.Rectangle import ColorRectangle, RectangleMatch
+from depixlib.metrics import DISABLED, Metrics
+from depixlib.parallel import ArrayDescriptor, SharedArray, attachSharedArray
+from depixlib.Rectangle import ColorRectangle, MatchSet
+from depixlib.SearchIndex import SearchIndex
 
 logger = logging.getLogger(__name__)
 
+MATCHERS = ("template", "sqdiff", "index", "integer", "distinct")
+
+# Upper bound on float64 score-map elements held at once by the sqdiff matcher
+SQDIFF_CHUNK_ELEMENTS = 1 << 24
+
+# Identical windows score equal in exact arithmetic but differ by rounding
+# noise here; treat them as ties so the first one wins, like cv2.minMaxLoc
+SQDIFF_TIE_EPSILON = 1e-9
+
+# Most distinct windows per block size the 'distinct' matcher scores; sizes
+# with more are matched exhaustively like the 'integer' matcher
+DISTINCT_BUDGET = 1 << 18
+
+# Grouping windows costs about as much as scoring this many colours, so
+# sizes with fewer distinct block colours are matched exhaustively
+DISTINCT_MIN_COLORS = 8
+
+
+def buildSearchIndex(
+    searchImage: LoadedImage,
+    averageType: str,
+    tolerance: float,
+    cache: IndexCache | None
+) -> SearchIndex:
+    """Create a SearchIndex for the search image, backed by the cache if given."""
+    imageHash = None
+    if cache is not None:
+        imageHash = searchImage.contentHash or IndexCache.hashFile(searchImage.path)
+    return SearchIndex(searchImage.array, averageType, tolerance, cache, imageHash)
+
+
+def _findIndexMatches(
+    rectangleSizeOccurrences: Dict[Tuple[int, int], int],
+    groups: Dict[Tuple[int, int], BlockTable],
+    index: SearchIndex,
+    maxMatches: int | None,
+    textBands: bool,
+    phase: int | None,
+    metrics: Metrics
+) -> Dict[Tuple[int, int], MatchSet]:
+    """Resolve blocks by average-colour lookup in a SearchIndex."""
+    matches: Dict[Tuple[int, int], MatchSet] = {}
+    for (w, h), count in rectangleSizeOccurrences.items():
+        logger.debug("Processing block size: %dx%d (%d occurrences)", w, h, count)
+        group = groups.get((w, h), ())
+        for r in group:
+            xs, ys, distances = index.findCandidates(
+                r.color, w, h, limit=maxMatches, textBands=textBands, phase=phase
+            )
+            matches[(r.x, r.y)] = MatchSet(xs, ys, distances, w, h)
+        metrics.count("matcherCalls", len(group))
+
+    logger.info(
+        "Found candidates for %d of %d blocks",
+        sum(1 for m in matches.values() if m),
+        sum(len(g) for g in groups.values())
+    )
+    return matches
+
+
+def selectTopCandidates(
+    scores: np.ndarray,
+    topK: int,
+    scoreThreshold: float | None,
+    w: int,
+    h: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pick the best-scoring window positions from a score map.
+    
+    The lowest scores are found with np.argpartition, then greedy
+    non-maximum suppression drops candidates whose window overlaps a better
+    one, so the candidates are distinct places in the search image rather
+    than one place shifted by a pixel.
+    
+    Args:
+        scores: (H', W') score map, lower is better
+        topK: Maximum number of candidates
+        scoreThreshold: Optional maximum score of a candidate
+        w: Block width (suppression extent along x)
+        h: Block height (suppression extent along y)
+        
+    Returns:
+        Tuple of (x coordinates, y coordinates, scores), best first
+    """
+    return _selectTopWindows(
+        scores.ravel(), None, scores.shape[1], topK, scoreThreshold, w, h
+    )
+
+
+def _selectTopWindows(
+    scores: np.ndarray,
+    windows: np.ndarray | None,
+    columns: int,
+    topK: int,
+    scoreThreshold: float | None,
+    w: int,
+    h: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """selectTopCandidates() over the scores of some windows of a map."""
+    poolSize = min(scores.size, _poolSize(topK, w, h))
+    if poolSize < scores.size:
+        # Keep every window tied with the cutoff so ties are ordered by position
+        cutoff = np.partition(scores, poolSize - 1)[poolSize - 1]
+        pool = np.flatnonzero(scores <= cutoff)
+    else:
+        pool = np.arange(scores.size)
+    poolScores = scores[pool]
+    if windows is not None:
+        pool = windows[pool]
+    return _suppressOverlaps(pool, poolScores, columns, topK, scoreThreshold, w, h)
+
+
+def _bandWindows(
+    index: SearchIndex,
+    w: int,
+    h: int,
+    textBands: bool,
+    phase: int | None = None
+) -> np.ndarray | None:
+    """Flat indices of the windows matched with textBands and phase, None for all."""
+    if not textBands:
+        return None
+    mask = index.bandMask(w, h) if phase is None else index.phaseMask(w, h, phase)
+    windows = np.flatnonzero(mask)
+    logger.debug("%dx%d: searching %d of %d windows in text bands", w, h, len(windows), mask.size)
+    return windows
+
+
+def _poolSize(topK: int, w: int, h: int) -> int:
+    """Best windows that always contain the topK non-overlapping best."""
+    # Each chosen window suppresses at most this many others
+    return topK * (2 * w - 1) * (2 * h - 1)
+
+
+def _suppressOverlaps(
+    pool: np.ndarray,
+    poolScores: np.ndarray,
+    columns: int,
+    topK: int,
+    scoreThreshold: float | None,
+    w: int,
+    h: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Greedy non-maximum suppression over flat window indices and their scores."""
+    # Sort by score, ties by position, like cv2.minMaxLoc
+    order = np.lexsort((pool, poolScores))
+    pool, poolScores = pool[order], poolScores[order]
+    if scoreThreshold is not None:
+        keep = poolScores <= scoreThreshold
+        pool, poolScores = pool[keep], poolScores[keep]
+    
+    pool_ys, pool_xs = np.divmod(pool, columns)
+    available = np.ones(len(pool), dtype=bool)
+    chosen = []
+    while len(chosen) < topK:
+        candidates = np.flatnonzero(available)
+        if len(candidates) == 0:
+            break
+        best = candidates[0]
+        chosen.append(best)
+        available &= ~(
+            (np.abs(pool_xs - pool_xs[best]) < w)
+            & (np.abs(pool_ys - pool_ys[best]) < h)
+        )
+    
+    chosen = np.array(chosen, dtype=np.int64)
+    return pool_xs[chosen], pool_ys[chosen], poolScores[chosen]
+
+
+def constantTemplateSqdiffNormed(
+    windowSums: np.ndarray,
+    windowSquaredSums: np.ndarray,
+    colors: np.ndarray,
+    area: int
+) -> np.ndarray:
+    """
+    TM_SQDIFF_NORMED score maps for single-colour templates.
+
+    For a template of constant colour c over n pixels the squared difference
+    against a window is sum(I^2) - 2 c.sum(I) + n |c|^2, so the whole map
+    follows from window sums without correlating the template. Values are
+    clamped to [0, 1] the same way OpenCV does.
+
+    Args:
+        windowSums: (H', W', 3) per-channel sum of every window
+        windowSquaredSums: (H', W') sum of squares of every window
+        colors: (B, 3) template colours in the same value space
+        area: Number of pixels in a template (w * h)
+
+    Returns:
+        (B, H', W') float64 score maps
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    templateSquared = area * np.square(colors).sum(axis=1)[:, None, None]
+    cross = np.einsum("yxc,bc->byx", windowSums, colors)
+
+    numerator = np.maximum(windowSquaredSums - 2.0 * cross + templateSquared, 0.0)
+    denominator = np.sqrt(windowSquaredSums * templateSquared)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = numerator / denominator
+    scores[~(numerator < denominator)] = 1.0
+    return scores
+
+
+def _findClosedFormMatches(
+    rectangleSizeOccurrences: Dict[Tuple[int, int], int],
+    groups: Dict[Tuple[int, int], BlockTable],
+    index: SearchIndex,
+    topK: int,
+    scoreThreshold: float | None,
+    textBands: bool,
+    phase: int | None,
+    metrics: Metrics
+) -> Dict[Tuple[int, int], MatchSet]:
+    """Best TM_SQDIFF_NORMED locations per block, from integral images."""
+    matches: Dict[Tuple[int, int], MatchSet] = {}
+    for (w, h), count in rectangleSizeOccurrences.items():
+        logger.debug("Processing block size: %dx%d (%d occurrences)", w, h, count)
+        if w > index.width or h > index.height:
+            continue
+
+        group = groups.get((w, h))
+        if group is None:
+            continue
+
+        # Blocks of the same colour share a score map, so solve each colour
+        # once; the table colour is the cell mean of a noisy grid block
+        colors = toWorkingSpace(group.colors, index.averageType)
+        uniqueColors, inverse = np.unique(colors, axis=0, return_inverse=True)
+        metrics.count("matcherCalls", len(uniqueColors))
+
+        sums = index.windowSums(w, h)
+        squaredSums = index.windowSquaredSums(w, h)
+        columns = squaredSums.shape[1]
+        windows = _bandWindows(index, w, h, textBands, phase)
+        if windows is not None:
+            # Score the band windows as a one-row map
+            sums = sums.reshape(-1, 3)[windows][None]
+            squaredSums = squaredSums.ravel()[windows][None]
+        windowCount = squaredSums.size
+        chunk = max(1, SQDIFF_CHUNK_ELEMENTS // max(windowCount, 1))
+
+        colorMatches: List[MatchSet] = []
+        for start in range(0, len(uniqueColors), chunk):
+            scores = constantTemplateSqdiffNormed(
+                sums, squaredSums, uniqueColors[start:start + chunk], w * h
+            )
+            if topK > 1 or scoreThreshold is not None:
+                for scoreMap in scores:
+                    colorMatches.append(MatchSet(
+                        *_selectTopWindows(
+                            scoreMap.ravel(), windows, columns, topK, scoreThreshold, w, h
+                        ),
+                        w, h
+                    ))
+                continue
+
+            scores = scores.reshape(len(scores), -1)
+            minima = scores.min(axis=1, keepdims=True)
+            bestIndices = np.argmax(scores <= minima + SQDIFF_TIE_EPSILON, axis=1)
+            if windows is not None:
+                bestIndices = windows[bestIndices]
+            match_ys, match_xs = np.divmod(bestIndices, columns)
+            for match_x, match_y, score in zip(
+                match_xs.tolist(), match_ys.tolist(), minima[:, 0].tolist()
+            ):
+                colorMatches.append(MatchSet.single(match_x, match_y, score, w, h))
+
+        for x, y, u in zip(group.x.tolist(), group.y.tolist(), inverse.ravel()):
+            matches[(x, y)] = colorMatches[u]
+
+    logger.info(
+        "Found %d matches for %d blocks",
+        len(matches),
+        sum(len(g) for g in groups.values())
+    )
+    return matches
+
+
+def integerSqdiffNormed(
+    windowSums: np.ndarray,
+    windowSquaredSums: np.ndarray,
+    color: np.ndarray,
+    area: int
+) -> np.ndarray:
+    """
+    TM_SQDIFF_NORMED score map of a single-colour template, from exact sums.
+
+    The squared difference sum(I^2) - 2 c.sum(I) + n |c|^2 is evaluated in
+    the unsigned dtype of the squared sums. Intermediate wrap-around
+    cancels, so the result is exact whenever it fits, and only the final
+    normalization is floating point. Identical windows therefore tie exactly.
+
+    Args:
+        windowSums: (H', W', 3) per-channel integer sum of every window,
+            in an unsigned dtype no wider than windowSquaredSums
+        windowSquaredSums: (H', W') integer sum of squares of every window
+        color: (3,) template colour in the same integer levels
+        area: Number of pixels in a template (w * h)
+
+    Returns:
+        (H', W') float64 score map, clamped to [0, 1] like OpenCV
+    """
+    dtype = windowSquaredSums.dtype
+    color = np.asarray(color, dtype=dtype)
+    cross = np.multiply(windowSums[..., 0], color[0], dtype=dtype)
+    cross += np.multiply(windowSums[..., 1], color[1], dtype=dtype)
+    cross += np.multiply(windowSums[..., 2], color[2], dtype=dtype)
+    templateSquared = dtype.type(area) * np.square(color).sum(dtype=dtype)
+
+    difference = windowSquaredSums - 2 * cross
+    difference += templateSquared
+
+    numerator = difference.astype(np.float64)
+    denominator = np.sqrt(windowSquaredSums.astype(np.float64) * float(templateSquared))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = numerator / denominator
+    scores[~(numerator < denominator)] = 1.0
+    return scores
+
+
+def _selectDistinctCandidates(
+    groupScores: np.ndarray,
+    first: np.ndarray,
+    order: np.ndarray,
+    offsets: np.ndarray,
+    columns: int,
+    topK: int,
+    scoreThreshold: float | None,
+    w: int,
+    h: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    selectTopCandidates() over window groups scored once per group.
+
+    Args:
+        groupScores: Score of every SearchIndex.distinctWindows() group
+        first: First window of every group
+        order: SearchIndex.distinctWindowOrder()
+        offsets: Start of every group in order, and the total at the end
+        columns: Number of window positions per row
+        topK: Maximum number of candidates
+        scoreThreshold: Optional maximum score of a candidate
+        w: Block width
+        h: Block height
+
+    Returns:
+        Tuple of (x coordinates, y coordinates, scores), best first
+    """
+    # Every group holds a window, so the pool lies in this many best groups
+    poolSize = _poolSize(topK, w, h)
+    ranked = np.arange(len(groupScores))
+    if poolSize < len(groupScores):
+        cutoff = np.partition(groupScores, poolSize - 1)[poolSize - 1]
+        ranked = np.flatnonzero(groupScores <= cutoff)
+    ranked = ranked[np.lexsort((first[ranked], groupScores[ranked]))]
+
+    # Whole groups until the pool is full, plus any tying with the last one
+    ends = np.cumsum(np.diff(offsets)[ranked])
+    last = min(int(np.searchsorted(ends, poolSize)), len(ranked) - 1)
+    rankedScores = groupScores[ranked]
+    last = int(np.searchsorted(rankedScores, rankedScores[last], side="right")) - 1
+    chosen = ranked[:last + 1]
+
+    pool = np.concatenate([order[offsets[g]:offsets[g + 1]] for g in chosen.tolist()])
+    poolScores = np.repeat(groupScores[chosen], np.diff(offsets)[chosen])
+    return _suppressOverlaps(pool, poolScores, columns, topK, scoreThreshold, w, h)
+
+
+def _findIntegerMatches(
+    rectangleSizeOccurrences: Dict[Tuple[int, int], int],
+    groups: Dict[Tuple[int, int], BlockTable],
+    index: SearchIndex,
+    topK: int,
+    scoreThreshold: float | None,
+    textBands: bool,
+    phase: int | None,
+    metrics: Metrics,
+    distinctBudget: int | None = None
+) -> Dict[Tuple[int, int], MatchSet]:
+    """
+    Best TM_SQDIFF_NORMED locations per block, from exact integer window sums.
+
+    With a distinctBudget, windows with equal statistics are scored once
+    per group (see SearchIndex.distinctWindows()), for sizes with at least
+    DISTINCT_MIN_COLORS block colours and at most distinctBudget groups;
+    the result is the same. The few windows of one phase are always scored
+    one by one.
+    """
+    levels = integerLevels(index.averageType)
+    # Largest window whose sums of squares and differences fit in uint64
+    maxArea = int(np.iinfo(np.uint64).max) // (3 * int(levels[-1]) ** 2)
+
+    matches: Dict[Tuple[int, int], MatchSet] = {}
+    for (w, h), count in rectangleSizeOccurrences.items():
+        logger.debug("Processing block size: %dx%d (%d occurrences)", w, h, count)
+        if w > index.width or h > index.height:
+            continue
+        if w * h > maxArea:
+            logger.warning(
+                "Skipping %dx%d blocks: the integer matcher handles at most %d pixels",
+                w, h, maxArea
+            )
+            continue
+
+        group = groups.get((w, h))
+        if group is None:
+            continue
+
+        # Blocks of the same colour share a score map, so solve each colour once
+        colors = levels[group.colors]
+        uniqueColors, inverse = np.unique(colors, axis=0, return_inverse=True)
+        metrics.count("matcherCalls", len(uniqueColors))
+
+        sums = index.windowIntegerSums(w, h).reshape(-1, 3)
+        squaredSums = index.windowIntegerSquaredSums(w, h)
+        columns = squaredSums.shape[1]
+        squaredSums = squaredSums.ravel()
+
+        first = None
+        if (distinctBudget is not None and phase is None
+                and len(uniqueColors) >= DISTINCT_MIN_COLORS):
+            first, windowGroups = index.distinctWindows(w, h, textBands)
+            logger.debug(
+                "%dx%d: %d distinct of %d windows", w, h, len(first), windowGroups.size
+            )
+            if len(first) > distinctBudget:
+                logger.info(
+                    "%dx%d blocks: %d distinct windows exceed the budget of %d, "
+                    "matching exhaustively", w, h, len(first), distinctBudget
+                )
+                metrics.count("distinctFallbacks")
+                first = None
+            else:
+                metrics.count("distinctWindows", len(first))
+                groupSums = sums[first]
+                groupSquaredSums = squaredSums[first]
+                if topK > 1 or scoreThreshold is not None:
+                    order = index.distinctWindowOrder(w, h, textBands)
+                    offsets = np.zeros(len(first) + 1, dtype=np.int64)
+                    np.cumsum(np.bincount(windowGroups, minlength=len(first)), out=offsets[1:])
+
+        windows = None
+        if first is None:
+            windows = _bandWindows(index, w, h, textBands, phase)
+            if windows is not None:
+                sums, squaredSums = sums[windows], squaredSums[windows]
+
+        colorMatches: List[MatchSet] = []
+        for color in uniqueColors:
+            if first is not None:
+                groupScores = integerSqdiffNormed(
+                    groupSums, groupSquaredSums, color, w * h
+                )
+                if topK > 1 or scoreThreshold is not None:
+                    colorMatches.append(MatchSet(
+                        *_selectDistinctCandidates(
+                            groupScores, first, order, offsets, columns,
+                            topK, scoreThreshold, w, h
+                        ),
+                        w, h
+                    ))
+                    continue
+                # Groups are in raster order of their first window, so the
+                # first best group holds the first best window
+                best = int(np.argmin(groupScores))
+                match_y, match_x = divmod(int(first[best]), columns)
+                colorMatches.append(
+                    MatchSet.single(match_x, match_y, float(groupScores[best]), w, h)
+                )
+                continue
+
+            scores = integerSqdiffNormed(sums, squaredSums, color, w * h)
+            if topK > 1 or scoreThreshold is not None:
+                colorMatches.append(MatchSet(
+                    *_selectTopWindows(
+                        scores, windows, columns, topK, scoreThreshold, w, h
+                    ),
+                    w, h
+                ))
+                continue
+
+            # Ties are exact here, and argmin keeps the first like cv2.minMaxLoc
+            best = int(np.argmin(scores))
+            window = best if windows is None else int(windows[best])
+            match_y, match_x = divmod(window, columns)
+            colorMatches.append(
+                MatchSet.single(match_x, match_y, float(scores[best]), w, h)
+            )
+
+        for x, y, u in zip(group.x.tolist(), group.y.tolist(), inverse.ravel()):
+            matches[(x, y)] = colorMatches[u]
+
+    logger.info(
+        "Found %d matches for %d blocks",
+        len(matches),
+        sum(len(g) for g in groups.values())
+    )
+    return matches
+
+
+def _matchTemplateChunk(
+    search_array: np.ndarray,
+    pixel_array: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    w: int,
+    h: int,
+    topK: int = 1,
+    scoreThreshold: float | None = None,
+    windows: np.ndarray | None = None
+) -> List[Tuple[int, int, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Template-match a chunk of same-size blocks against the search image.
+    
+    Only the flat score map positions in windows are candidates, if given.
+    When they lie on few rows, only the image rows under those windows are
+    matched.
+    
+    Returns:
+        List of (x, y, match_xs, match_ys, scores) for blocks that matched
+    """
+    source, sourceWindows = search_array, windows
+    if windows is not None:
+        columns = search_array.shape[1] - w + 1
+        rows, rowOf = np.unique(windows // columns, return_inverse=True)
+        if len(rows) * h < search_array.shape[0]:
+            # Stack the h image rows under each window row; window row i of
+            # the stack's score map is then row i * h
+            source = search_array[rows[:, None] + np.arange(h)].reshape(
+                -1, search_array.shape[1], search_array.shape[2]
+            )
+            sourceWindows = rowOf.ravel() * h * columns + windows % columns
+    results = []
+    for x, y in zip(xs.tolist(), ys.tolist()):
+        try:
+            # Extract block from pixelated image
+            # NOTE: numpy arrays are [row, col] = [y, x]
+            block = pixel_array[y:y + h, x:x + w]
+            
+            # Ensure block has correct dimensions
+            if block.shape[0] != h or block.shape[1] != w:
+                logger.warning(
+                    "Block at (%d, %d) has incorrect dimensions: expected %dx%d, got %s",
+                    x, y, w, h, block.shape
+                )
+                continue
+            
+            # Perform template matching
+            result = cv2.matchTemplate(
+                source,
+                block,
+                cv2.TM_SQDIFF_NORMED
+            )
+            
+            if windows is not None:
+                scores = result.ravel()[sourceWindows]
+                if topK > 1 or scoreThreshold is not None:
+                    results.append((x, y) + _selectTopWindows(
+                        scores, windows, result.shape[1], topK, scoreThreshold, w, h
+                    ))
+                    continue
+                best = int(np.argmin(scores))
+                match_y, match_x = divmod(int(windows[best]), result.shape[1])
+                results.append((
+                    x, y,
+                    np.array([match_x]), np.array([match_y]), np.array([scores[best]])
+                ))
+                continue
+            
+            if topK > 1 or scoreThreshold is not None:
+                results.append((x, y) + selectTopCandidates(
+                    result, topK, scoreThreshold, w, h
+                ))
+                continue
+            
+            # Find best match
+            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+            
+            # min_loc is (x, y) in the search image
+            match_x, match_y = min_loc
+            results.append((
+                x, y,
+                np.array([match_x]), np.array([match_y]), np.array([min_val])
+            ))
+            
+        except Exception as e:
+            logger.error(
+                "Error processing block at (%d, %d): %s",
+                x, y, str(e)
+            )
+    return results
+
+
+# Arrays attached by each worker process of the parallel template matcher
+_workerArrays: Dict[str, np.ndarray] = {}
+_workerHandles: List[shared_memory.SharedMemory] = []
+
+
+def _attachWorkerArrays(
+    searchDescriptor: ArrayDescriptor,
+    pixelDescriptor: ArrayDescriptor
+) -> None:
+    """Process pool initializer: attach to the shared search and pixel arrays."""
+    # One process per core already; keep OpenCV from adding its own threads
+    cv2.setNumThreads(1)
+    for name, descriptor in (("search", searchDescriptor), ("pixel", pixelDescriptor)):
+        shm, array = attachSharedArray(descriptor)
+        _workerHandles.append(shm)
+        _workerArrays[name] = array
+
+
+def _matchTemplateChunkInWorker(
+    chunk: Tuple[np.ndarray, np.ndarray, int, int, int, float | None, ArrayDescriptor | None]
+) -> List[Tuple[int, int, np.ndarray, np.ndarray, np.ndarray]]:
+    # Band windows arrive as a shared array descriptor, attached once per process
+    *head, windowsDescriptor = chunk
+    windows = None
+    if windowsDescriptor is not None:
+        name = windowsDescriptor[0]
+        if name not in _workerArrays:
+            shm, _workerArrays[name] = attachSharedArray(windowsDescriptor)
+            _workerHandles.append(shm)
+        windows = _workerArrays[name]
+    return _matchTemplateChunk(
+        _workerArrays["search"], _workerArrays["pixel"], *head, windows
+    )
+
+
+def _memoSetting(
+    matcher: str,
+    index: SearchIndex,
+    maxMatches: int | None,
+    topK: int,
+    scoreThreshold: float | None,
+    textBands: bool,
+    phase: int | None
+) -> str:
+    """Name of a matcher and the options its result depends on."""
+    if matcher == "index":
+        options = f"tol{index.tolerance:g}-max{maxMatches}"
+    else:
+        options = f"top{topK}-score{scoreThreshold}"
+    bands = f"bands{int(textBands)}" if phase is None else f"phase{phase}"
+    return f"{matcher}-{options}-{bands}"
+
+
+def _findMemoizedMatches(
+    rectangleSizeOccurrences: Dict[Tuple[int, int], int],
+    groups: Dict[Tuple[int, int], BlockTable],
+    searchIndex: SearchIndex,
+    pixelatedImage: LoadedImage,
+    matcher: str,
+    maxMatches: int | None,
+    workers: int,
+    topK: int,
+    scoreThreshold: float | None,
+    distinctBudget: int,
+    textBands: bool,
+    phase: int | None,
+    metrics: Metrics
+) -> Dict[Tuple[int, int], MatchSet]:
+    """
+    _findMatches() for one block per (size, colour) not in the match memo.
+
+    The other blocks of that size and colour reuse its result, now and in
+    later calls with the same SearchIndex (see SearchIndex.matchMemo()).
+    Blocks are keyed by their table colour; 'template' correlates the
+    block pixels, so there only uniform blocks are shared.
+    """
+    setting = _memoSetting(
+        matcher, searchIndex, maxMatches, topK, scoreThreshold, textBands, phase
+    )
+    pixels = pixelatedImage.array
+
+    matches: Dict[Tuple[int, int], MatchSet] = {}
+    searched: Dict[Tuple[int, int], BlockTable] = {}
+    shared: List[Tuple[int, int, BlockTable, np.ndarray]] = []
+    hits = misses = 0
+    for (w, h) in rectangleSizeOccurrences:
+        group = groups.get((w, h))
+        if group is None:
+            continue
+        keys = group.packedColors()
+        shareable = np.ones(len(group), dtype=bool)
+        if matcher == "template":
+            shareable = np.array([
+                bool((pixels[y:y + h, x:x + w] == pixels[y, x]).all())
+                for x, y in zip(group.x.tolist(), group.y.tolist())
+            ], dtype=bool)
+
+        memo = searchIndex.matchMemo(w, h, setting)
+        known = np.fromiter(
+            (key in memo for key in keys.tolist()), dtype=bool, count=len(keys)
+        ) & shareable
+        for x, y, key in zip(
+            group.x[known].tolist(), group.y[known].tolist(), keys[known].tolist()
+        ):
+            matches[(x, y)] = memo[key]
+
+        # Search the first block of every new colour, and unshareable blocks
+        pending = np.flatnonzero(shareable & ~known)
+        _, first = np.unique(keys[pending], return_index=True)
+        search = ~shareable
+        search[pending[first]] = True
+        if search.any():
+            searched[(w, h)] = group.filter(search)
+        shared.append((w, h, group.filter(shareable & ~known), keys[pending]))
+        hits += int(known.sum()) + len(pending) - len(first)
+        misses += len(first)
+
+    metrics.count("matchMemoHits", hits)
+    metrics.count("matchMemoMisses", misses)
+    if hits + misses:
+        logger.info(
+            "Match memo: %d of %d block searches reused (%.1f%%)",
+            hits, hits + misses, 100.0 * hits / (hits + misses)
+        )
+
+    found = _findMatches(
+        {size: len(group) for size, group in searched.items()}, searched,
+        searchIndex, pixelatedImage, matcher, maxMatches, workers, topK,
+        scoreThreshold, distinctBudget, textBands, phase, metrics
+    )
+    matches.update(found)
+
+    for w, h, group, keys in shared:
+        memo = searchIndex.matchMemo(w, h, setting)
+        for x, y, key in zip(group.x.tolist(), group.y.tolist(), keys.tolist()):
+            result = found.get((x, y))
+            if result is not None:
+                memo[key] = result
+            else:
+                # A block the matcher skipped, or a later one of its colour
+                result = memo.get(key)
+                if result is not None:
+                    matches[(x, y)] = result
+        searchIndex.storeMatchMemo(w, h, setting)
+    return matches
+
 
 def findRectangleMatches(
     rectangleSizeOccurrences: Dict[Tuple[int, int], int],
-    pixelatedSubRectangles: List[ColorRectangle],
+    pixelatedSubRectangles: BlockTable | List[ColorRectangle],
     searchImage: LoadedImage,
     pixelatedImage: LoadedImage,
-    averageType: str
-) -> Dict[Tuple[int, int], List[RectangleMatch]]:
+    averageType: str,
+    matcher: str = "template",
+    tolerance: float = 1.0,
+    maxMatches: int | None = 64,
+    cache: IndexCache | None = None,
+    workers: int = 1,
+    topK: int = 1,
+    scoreThreshold: float | None = None,
+    searchIndex: SearchIndex | None = None,
+    metrics: Metrics | None = None,
+    distinctBudget: int = DISTINCT_BUDGET,
+    textBands: bool = False,
+    matchMemo: bool = True
+) -> Dict[Tuple[int, int], MatchSet]:
     """
     Find matching rectangles using NumPy-accelerated template matching.
     
     Args:
         rectangleSizeOccurrences: Dictionary of rectangle sizes
-        pixelatedSubRectangles: List of pixelated rectangles
+        pixelatedSubRectangles: Table or list of pixelated rectangles
         searchImage: Image to search for matches
         pixelatedImage: Pixelated input image
-        averageType: Type of averaging ('gammacorrected' or 'linear')
+        averageType: Type of averaging ('gammacorrected', 'linear' or 'srgb')
+        matcher: 'template' for full template matching per block,
+            'sqdiff' for the same TM_SQDIFF_NORMED result computed in closed
+            form from integral images, 'integer' for the same score from
+            exact integer sums of the uint8 search image, 'distinct' for the
+            'integer' result scoring each group of windows with equal sums
+            once, or 'index' for average-colour lookup in a SearchIndex
+        tolerance: Per-channel colour tolerance for the 'index' matcher
+        maxMatches: Maximum candidates kept per block by the 'index' matcher
+        cache: Optional on-disk cache of per-size search structures and
+            the working-space search image
+        workers: Number of processes for the 'template' matcher; blocks are
+            split into chunks and the images shared through shared memory
+        topK: Candidates kept per block by all matchers but 'index',
+            after suppressing overlapping windows
+        scoreThreshold: Optional maximum TM_SQDIFF_NORMED score of a
+            candidate for all matchers but 'index'
+        searchIndex: Prebuilt index of searchImage to reuse across calls;
+            its average type and tolerance take the place of averageType,
+            tolerance and cache
+        metrics: Optional Metrics counting searches in "matcherCalls": one
+            per block for 'template' and 'index', one per distinct block
+            colour for the others; 'distinct' also counts the window groups
+            it scores in "distinctWindows" and the sizes matched
+            exhaustively in "distinctFallbacks". With matchMemo, blocks
+            served from the memo count in "matchMemoHits" and the searches
+            made in "matchMemoMisses". With textBands, the matches the
+            line phase is voted from count in "phaseVotes"
+        distinctBudget: Most window groups per block size the 'distinct'
+            matcher scores; larger sizes are matched like 'integer'
+        textBands: Only match windows overlapping a line of text in the
+            search image (SearchIndex.bandMask()); once the fullest row of
+            blocks is matched, the other rows only match windows at their
+            offset within a line (SearchIndex.phaseMask())
+        matchMemo: Search each block size and colour once and share the
+            result through SearchIndex.matchMemo(), across calls with the
+            same searchIndex and across runs with a cache
         
     Returns:
         Dictionary mapping (x, y) coordinates to list of matches
     """
+    if matcher not in MATCHERS:
+        raise ValueError(f"Unknown matcher {matcher!r}, expected one of {MATCHERS}")
+
+    if searchIndex is None:
+        searchIndex = buildSearchIndex(
+            searchImage, averageType, tolerance, cache
+        )
+    elif searchIndex.averageType != averageType:
+        raise ValueError(
+            f"Search index uses {searchIndex.averageType!r} averaging, not {averageType!r}"
+        )
+
+    table = asBlockTable(pixelatedSubRectangles)
+    groups = table.groupBySize()
+
+    metrics = metrics or DISABLED
+    find = _findMemoizedMatches if matchMemo else _findMatches
+
+    def match(blocks: BlockTable, phase: int | None) -> Dict[Tuple[int, int], MatchSet]:
+        subgroups = blocks.groupBySize()
+        return find(
+            {size: len(subgroups[size]) for size in rectangleSizeOccurrences if size in subgroups},
+            subgroups, searchIndex, pixelatedImage, matcher, maxMatches, workers,
+            topK, scoreThreshold, distinctBudget, textBands, phase, metrics
+        )
+
+    if textBands and searchIndex.lineHeight and len(table):
+        return _findPhasedMatches(table, searchIndex, match, metrics)
+    return find(
+        rectangleSizeOccurrences, groups, searchIndex, pixelatedImage, matcher,
+        maxMatches, workers, topK, scoreThreshold, distinctBudget, textBands, None, metrics
+    )
+
+
+def _findPhasedMatches(
+    table: BlockTable,
+    index: SearchIndex,
+    match: Callable[[BlockTable, int | None], Dict[Tuple[int, int], MatchSet]],
+    metrics: Metrics
+) -> Dict[Tuple[int, int], MatchSet]:
+    """
+    Match the fullest row of blocks in the text bands, then the rest at its phase.
+
+    All blocks of a pixelated row sit at the same offset within their line
+    of text, so the SearchIndex.linePhase() most of that row's matches
+    share fixes the phase of every other row. Those rows only search the
+    windows at their phase (SearchIndex.phaseMask()), one row of windows
+    per line instead of every row of the bands.
+    """
+    rows, counts = np.unique(table.y, return_counts=True)
+    voteY = int(rows[np.argmax(counts)])
+    voting = table.y == voteY
+    matches = match(table.filter(voting), None)
+    rest = table.filter(~voting)
+
+    ys = [int(m.ys[0]) for m in matches.values() if len(m)]
+    metrics.count("phaseVotes", len(ys))
+    if not ys:
+        logger.info("No match in block row %d to take the line phase from", voteY)
+        matches.update(match(rest, None))
+        return matches
+    phases, votes = np.unique(index.linePhase(np.array(ys)), return_counts=True)
+    phase = int(phases[np.argmax(votes)])
+    logger.info(
+        "Line phase %d from %d of %d blocks in row %d",
+        phase, int(votes.max()), len(ys), voteY
+    )
+
+    restPhases = (phase + rest.y.astype(np.int64) - voteY) % index.lineHeight
+    for restPhase in np.unique(restPhases).tolist():
+        matches.update(match(rest.filter(restPhases == restPhase), restPhase))
+    return matches
+
+
+def _findMatches(
+    rectangleSizeOccurrences: Dict[Tuple[int, int], int],
+    groups: Dict[Tuple[int, int], BlockTable],
+    searchIndex: SearchIndex,
+    pixelatedImage: LoadedImage,
+    matcher: str,
+    maxMatches: int | None,
+    workers: int,
+    topK: int,
+    scoreThreshold: float | None,
+    distinctBudget: int,
+    textBands: bool,
+    phase: int | None,
+    metrics: Metrics
+) -> Dict[Tuple[int, int], MatchSet]:
+    """Run one matcher over every block, see findRectangleMatches()."""
+    averageType = searchIndex.averageType
+    if matcher == "index":
+        logger.info("Using search index matching")
+        return _findIndexMatches(
+            rectangleSizeOccurrences,
+            groups,
+            searchIndex,
+            maxMatches,
+            textBands,
+            phase,
+            metrics
+        )
+    if matcher == "sqdiff":
+        logger.info("Using closed-form constant-template matching")
+        return _findClosedFormMatches(
+            rectangleSizeOccurrences,
+            groups,
+            searchIndex,
+            topK,
+            scoreThreshold,
+            textBands,
+            phase,
+            metrics
+        )
+    if matcher in ("integer", "distinct"):
+        logger.info("Using integer constant-template matching")
+        return _findIntegerMatches(
+            rectangleSizeOccurrences,
+            groups,
+            searchIndex,
+            topK,
+            scoreThreshold,
+            textBands,
+            phase,
+            metrics,
+            distinctBudget if matcher == "distinct" else None
+        )
+
     logger.info("Using NumPy-accelerated template matching")
     
     # Convert images to numpy arrays
-    search_array = np.array(
-        searchImage.getCopyOfLoadedPILImage(),
-        dtype=np.float32
-    ) / 255.0
+    # Normalize to 0-1, with gamma correction for linear averaging
+    search_array = searchIndex.workingArray
+    pixel_array = pixelatedImage.working(averageType)
     
-    pixel_array = np.array(
-        pixelatedImage.getCopyOfLoadedPILImage(),
-        dtype=np.float32
-    ) / 255.0
+    matches: Dict[Tuple[int, int], MatchSet] = {}
+    total_blocks = sum(len(g) for g in groups.values())
     
-    # Handle alpha channel if present
-    if search_array.ndim == 3 and search_array.shape[2] == 4:
-        search_array = search_array[:, :, :3]
-    if pixel_array.ndim == 3 and pixel_array.shape[2] == 4:
-        pixel_array = pixel_array[:, :, :3]
-    
-    # Apply gamma correction for linear averaging
-    if averageType == "linear":
-        search_array = np.power(search_array, 2.2)
-        pixel_array = np.power(pixel_array, 2.2)
+    # Process each unique size, in chunks of blocks
+    chunks = []
+    for (w, h), count in rectangleSizeOccurrences.items():
+        group = groups.get((w, h))
+        if group is None:
+            continue
+        windows = _bandWindows(searchIndex, w, h, textBands, phase)
+        chunkSize = max(1, -(-len(group) // (workers * 4)))
+        for start in range(0, len(group), chunkSize):
+            chunks.append((
+                group.x[start:start + chunkSize],
+                group.y[start:start + chunkSize],
+                w,
+                h,
+                topK,
+                scoreThreshold,
+                windows
+            ))
     
-    matches: Dict[Tuple[int, int], List[RectangleMatch]] = {}
-    total_blocks = len(pixelatedSubRectangles)
-    processed = 0
+    if workers > 1 and len(chunks) > 1:
+        logger.info("Matching %d blocks with %d worker processes", total_blocks, workers)
+        with ExitStack() as stack:
+            sharedSearch = stack.enter_context(SharedArray(search_array))
+            sharedPixels = stack.enter_context(SharedArray(pixel_array))
+            # Share each size's band windows once instead of pickling them per chunk
+            sharedWindows: Dict[int, SharedArray] = {}
+            workerChunks = []
+            for chunk in chunks:
+                windows = chunk[6]
+                if windows is not None:
+                    if id(windows) not in sharedWindows:
+                        sharedWindows[id(windows)] = stack.enter_context(
+                            SharedArray(windows)
+                        )
+                    windows = sharedWindows[id(windows)].descriptor
+                workerChunks.append(chunk[:6] + (windows,))
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_attachWorkerArrays,
+                initargs=(sharedSearch.descriptor, sharedPixels.descriptor)
+            ))
+            results = list(executor.map(_matchTemplateChunkInWorker, workerChunks))
+    else:
+        results = []
+        processed = 0
+        for chunk in chunks:
+            results.append(_matchTemplateChunk(search_array, pixel_array, *chunk))
+            processed += len(chunk[0])
+            logger.info(
+                "Progress: %d/%d blocks processed (%.1f%%)",
+                processed,
+                total_blocks,
+                (processed / total_blocks) * 100
+            )
     
-    # Process each unique size
-    for (w, h), count in rectangleSizeOccurrences.items():
-        logger.debug("Processing block size: %dx%d (%d occurrences)", w, h, count)
-        
-        # Find all rectangles with this size
-        matching_rects = [
-            r for r in pixelatedSubRectangles
-            if r.width == w and r.height == h
-        ]
-        
-        for r in matching_rects:
-            processed += 1
-            
-            try:
-                # Extract block from pixelated image
-                # NOTE: numpy arrays are [row, col] = [y, x]
-                block = pixel_array[r.y:r.y + h, r.x:r.x + w]
-                
-                # Ensure block has correct dimensions
-                if block.shape[0] != h or block.shape[1] != w:
-                    logger.warning(
-                        "Block at (%d, %d) has incorrect dimensions: expected %dx%d, got %s",
-                        r.x, r.y, w, h, block.shape
-                    )
-                    continue
-                
-                # Ensure 3D array even for grayscale
-                if block.ndim == 2:
-                    block = np.stack([block, block, block], axis=-1)
-                
-                # Perform template matching
-                result = cv2.matchTemplate(
-                    search_array,
-                    block,
-                    cv2.TM_SQDIFF_NORMED
-                )
-                
-                # Find best match
-                min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-                
-                # min_loc is (x, y) in the search image
-                match_x, match_y = min_loc
-                
-                # Extract matched data CORRECTLY from searchImage.imageData
-                # imageData is [x][y] format, NOT [y][x]
-                matched_data = []
-                for dy in range(h):
-                    for dx in range(w):
-                        px = match_x + dx
-                        py = match_y + dy
-                        
-                        # Check bounds
-                        if px < searchImage.width and py < searchImage.height:
-                            # imageData is [x][y]!
-                            color = searchImage.imageData[px][py]
-                            matched_data.append(color)
-                        else:
-                            # Out of bounds - pad with black
-                            matched_data.append((0, 0, 0))
-                
-                # Create match object
-                match = RectangleMatch(
-                    match_x,
-                    match_y,
-                    matched_data
-                )
-                
-                matches[(r.x, r.y)] = [match]
-                
-            except Exception as e:
-                logger.error(
-                    "Error processing block at (%d, %d): %s",
-                    r.x, r.y, str(e)
-                )
-                continue
-            
-            # Progress logging
-            if processed % 50 == 0 or processed == total_blocks:
-                logger.info(
-                    "Progress: %d/%d blocks processed (%.1f%%)",
-                    processed,
-                    total_blocks,
-                    (processed / total_blocks) * 100
-                )
+    metrics.count("matcherCalls", sum(len(chunk[0]) for chunk in chunks))
+
+    # Results come back in chunk order, so the output does not depend on workers
+    for chunk, result in zip(chunks, results):
+        w, h = chunk[2], chunk[3]
+        for x, y, match_xs, match_ys, scores in result:
+            matches[(x, y)] = MatchSet(match_xs, match_ys, scores, w, h)
     
     logger.info("Found %d matches for %d blocks", len(matches), total_blocks)
     return matches
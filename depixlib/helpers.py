@@ -11,6 +11,28 @@ def check_file(s: str) -> str:
         raise argparse.ArgumentTypeError(f"{s!r} is not a file.")
 
 
+def check_positive_int(s: str) -> int:
+    """Parse a strictly positive integer."""
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{s!r} is not an integer.")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{s!r} must be at least 1.")
+    return value
+
+
+def check_non_negative_int(s: str) -> int:
+    """Parse an integer that is zero or more."""
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{s!r} is not an integer.")
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"{s!r} must be at least 0.")
+    return value
+
+
 def check_color(s: str | None) -> Tuple[int, int, int] | None:
     """Parse color string in format 'r,g,b'."""
     if s is None:
@@ -0,0 +1,138 @@
+"""
+Stage timers and counters for the depixelization pipeline.
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterator
+
+
+class Metrics:
+    """
+    Wall time per stage, event counters and bucketed counts of one or more runs.
+
+    Pipeline functions take an optional Metrics and fall back to DISABLED,
+    whose methods do nothing, so uninstrumented runs pay one attribute
+    lookup per stage. Batch and service code give every job its own Metrics
+    and merge() them into a shared one.
+    """
+
+    enabled = True
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, float] = {}
+        self.stageCalls: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+            self.stageCalls[name] = self.stageCalls.get(name, 0) + 1
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """
+        Time a block of code, adding to earlier times of the same stage.
+
+        Args:
+            name: Stage name
+
+        Returns:
+            Context manager wrapping the stage
+        """
+        return self._timer(name)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Add to a counter.
+
+        Args:
+            name: Counter name
+            value: Amount to add
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, bucket: Any, value: int = 1) -> None:
+        """
+        Add to one bucket of a histogram.
+
+        Args:
+            name: Histogram name
+            bucket: Bucket label, stored as a string
+            value: Amount to add
+        """
+        histogram = self.histograms.setdefault(name, {})
+        key = str(bucket)
+        histogram[key] = histogram.get(key, 0) + value
+
+    def merge(self, other: Metrics) -> None:
+        """
+        Add another Metrics into this one; safe to call from several threads.
+
+        Args:
+            other: Metrics of one job
+        """
+        with self._lock:
+            for name, seconds in other.stages.items():
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+            for name, calls in other.stageCalls.items():
+                self.stageCalls[name] = self.stageCalls.get(name, 0) + calls
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in other.histograms.items():
+                target = self.histograms.setdefault(name, {})
+                for key, value in histogram.items():
+                    target[key] = target.get(key, 0) + value
+
+    def toDict(self) -> Dict[str, Any]:
+        """Everything recorded, as JSON-serializable dicts."""
+        with self._lock:
+            return {
+                "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                "stageCalls": dict(self.stageCalls),
+                "counters": dict(self.counters),
+                "histograms": {name: dict(h) for name, h in self.histograms.items()},
+            }
+
+    def writeJson(self, path: str) -> None:
+        """
+        Write toDict() to a file.
+
+        Args:
+            path: Output path
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(self.toDict(), indent=2) + "\n")
+
+
+class _DisabledMetrics(Metrics):
+    """Metrics that record nothing."""
+
+    enabled = False
+
+    def stage(self, name: str) -> ContextManager[None]:
+        return _NULL_STAGE
+
+    def count(self, name: str, value: int = 1) -> None:
+        pass
+
+    def observe(self, name: str, bucket: Any, value: int = 1) -> None:
+        pass
+
+    def merge(self, other: Metrics) -> None:
+        pass
+
+
+_NULL_STAGE: ContextManager[None] = nullcontext()
+
+# Shared no-op instance used when no Metrics is passed
+DISABLED: Metrics = _DisabledMetrics()
@@ -0,0 +1,70 @@
+"""
+Helpers for sharing NumPy arrays with worker processes.
+"""
+from __future__ import annotations
+
+import logging
+from multiprocessing import shared_memory
+from typing import Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# (shared memory name, shape, dtype string) - small and cheap to pickle
+ArrayDescriptor = Tuple[str, Tuple[int, ...], str]
+
+
+class SharedArray:
+    """
+    A NumPy array copied once into a named shared memory block.
+
+    Workers attach to it by descriptor instead of receiving a pickled copy.
+    The creating process owns the block and must close() it when done.
+    """
+
+    def __init__(self, array: np.ndarray) -> None:
+        """
+        Copy an array into new shared memory.
+
+        Args:
+            array: Array to share
+        """
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array: np.ndarray = np.ndarray(
+            array.shape, dtype=array.dtype, buffer=self._shm.buf
+        )
+        self.array[...] = array
+        self.descriptor: ArrayDescriptor = (
+            self._shm.name, tuple(array.shape), array.dtype.str
+        )
+
+    def close(self) -> None:
+        """Release and remove the shared memory block."""
+        del self.array
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self) -> SharedArray:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+
+def attachSharedArray(
+    descriptor: ArrayDescriptor
+) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Attach to an array shared by another process.
+
+    Args:
+        descriptor: SharedArray.descriptor of the owning process
+
+    Returns:
+        Tuple of (shared memory handle to keep alive, read-only array view)
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    array: np.ndarray = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
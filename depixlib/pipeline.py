@@ -0,0 +1,206 @@
+"""
+The depixelization pipeline from a loaded pixelated image to an output array.
+"""
+from __future__ import annotations
+
+import logging
+from collections import Counter
+from typing import Dict, Tuple
+import numpy as np
+
+from depixlib.functions import (
+    dropEmptyRectangleMatches,
+    findGridSubRectangles,
+    findRectangleSizeOccurences,
+    findSameColorSubRectangles,
+    propagateNeighbourMatches,
+    removeMootColorRectangles,
+    splitSingleMatchAndMultipleMatches,
+    writeAverageMatchToImage,
+    writeFirstMatchToImage
+)
+from depixlib.functions_numpy import findRectangleMatches
+from depixlib.IndexCache import IndexCache
+from depixlib.LoadedImage import LoadedImage
+from depixlib.metrics import DISABLED, Metrics
+from depixlib.Rectangle import Rectangle
+from depixlib.SearchIndex import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+
+def depixelize(
+    pixelatedImage: LoadedImage,
+    searchImage: LoadedImage,
+    averageType: str = "gammacorrected",
+    backgroundColor: Tuple[int, int, int] | None = None,
+    matcher: str = "template",
+    tolerance: float = 1.0,
+    cache: IndexCache | None = None,
+    workers: int = 1,
+    topK: int = 1,
+    scoreThreshold: float | None = None,
+    neighbourPass: bool = True,
+    weightedAverage: bool = False,
+    blockGrid: bool = False,
+    textBands: bool = False,
+    matchMemo: bool = True,
+    searchIndex: SearchIndex | None = None,
+    metrics: Metrics | None = None
+) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Run every stage of Depix on one pixelated image.
+
+    Args:
+        pixelatedImage: Pixelated input image
+        searchImage: Image to search for matches
+        averageType: Type of averaging ('gammacorrected', 'linear' or 'srgb')
+        backgroundColor: Optional background colour to ignore
+        matcher: Block matching strategy, see findRectangleMatches()
+        tolerance: Per-channel colour tolerance for the 'index' matcher
+        cache: Optional on-disk cache of per-size search structures
+        workers: Number of processes for the 'template' matcher
+        topK: Candidates kept per block by all matchers but 'index'
+        scoreThreshold: Optional maximum score of a candidate
+        neighbourPass: Resolve multiple matches from neighbouring blocks
+        weightedAverage: Weight ambiguous matches by match score
+        blockGrid: Cut the image into a detected regular block grid instead
+            of following exact colour runs
+        textBands: Only match windows overlapping a line of text in the
+            search image, at the line offset voted by the fullest block row
+        matchMemo: Search each block size and colour once, sharing results
+            through the search index (see findRectangleMatches())
+        searchIndex: Prebuilt index of searchImage, kept warm by callers
+            that process many images against one search image
+        metrics: Optional Metrics receiving stage times and block counts
+
+    Returns:
+        Tuple of (output (H, W, 3) uint8 array, block counts per stage)
+    """
+    metrics = metrics or DISABLED
+    outputCanvas = pixelatedImage.array.copy()
+
+    # Find rectangles
+    with metrics.stage("detect"):
+        logger.info("Finding color rectangles from pixelated space")
+        pixelatedRectangle = Rectangle(
+            (0, 0),
+            (pixelatedImage.width - 1, pixelatedImage.height - 1)
+        )
+        if blockGrid:
+            pixelatedSubRectangles = findGridSubRectangles(
+                pixelatedImage, pixelatedRectangle
+            )
+        else:
+            pixelatedSubRectangles = findSameColorSubRectangles(
+                pixelatedImage, pixelatedRectangle
+            )
+    stats = {"blocks": len(pixelatedSubRectangles)}
+    logger.info("Found %d same color rectangles", len(pixelatedSubRectangles))
+
+    with metrics.stage("filter"):
+        # Filter rectangles
+        pixelatedSubRectangles = removeMootColorRectangles(
+            pixelatedSubRectangles, backgroundColor
+        )
+        logger.info(
+            "%d rectangles left after moot filter",
+            len(pixelatedSubRectangles)
+        )
+
+        # Find rectangle sizes
+        rectangleSizeOccurrences = findRectangleSizeOccurences(
+            pixelatedSubRectangles
+        )
+        logger.info(
+            "Found %d different rectangle sizes",
+            len(rectangleSizeOccurrences)
+        )
+    if metrics.enabled:
+        for (w, h), count in rectangleSizeOccurrences.items():
+            metrics.observe("blocksPerSize", f"{w}x{h}", count)
+
+    # Find matches
+    with metrics.stage("match"):
+        logger.info("Finding matches in search image")
+        rectangleMatches = findRectangleMatches(
+            rectangleSizeOccurrences,
+            pixelatedSubRectangles,
+            searchImage,
+            pixelatedImage,
+            averageType,
+            matcher=matcher,
+            tolerance=tolerance,
+            cache=cache,
+            workers=workers,
+            topK=topK,
+            scoreThreshold=scoreThreshold,
+            textBands=textBands,
+            matchMemo=matchMemo,
+            searchIndex=searchIndex,
+            metrics=metrics
+        )
+    if metrics.enabled:
+        for candidates, count in Counter(map(len, rectangleMatches.values())).items():
+            metrics.observe("matchesPerBlock", candidates, count)
+
+    with metrics.stage("split"):
+        # Drop empty matches
+        logger.info("Removing blocks with no matches")
+        pixelatedSubRectangles = dropEmptyRectangleMatches(
+            rectangleMatches,
+            pixelatedSubRectangles
+        )
+        stats["matched"] = len(pixelatedSubRectangles)
+
+        # Split matches
+        logger.info("Splitting single matches and multiple matches")
+        singleResults, pixelatedSubRectangles = splitSingleMatchAndMultipleMatches(
+            pixelatedSubRectangles,
+            rectangleMatches,
+            searchImage
+        )
+        logger.info(
+            "[%d straight matches | %d multiple matches]",
+            len(singleResults),
+            len(pixelatedSubRectangles)
+        )
+
+    if neighbourPass:
+        with metrics.stage("neighbours"):
+            logger.info("Resolving multiple matches from neighbouring blocks")
+            singleResults, pixelatedSubRectangles = propagateNeighbourMatches(
+                singleResults,
+                pixelatedSubRectangles,
+                rectangleMatches
+            )
+            logger.info(
+                "[%d straight matches | %d multiple matches]",
+                len(singleResults),
+                len(pixelatedSubRectangles)
+            )
+    stats["single"] = len(singleResults)
+    stats["multiple"] = len(pixelatedSubRectangles)
+
+    # Write results
+    with metrics.stage("write"):
+        logger.info("Writing single match results to output")
+        writeFirstMatchToImage(
+            singleResults,
+            rectangleMatches,
+            searchImage,
+            outputCanvas
+        )
+
+        logger.info("Writing average results for multiple matches to output")
+        writeAverageMatchToImage(
+            pixelatedSubRectangles,
+            rectangleMatches,
+            searchImage,
+            outputCanvas,
+            weighted=weightedAverage
+        )
+
+    for name, value in stats.items():
+        metrics.count(f"blocks.{name}", value)
+    return outputCanvas, stats
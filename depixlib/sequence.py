@@ -0,0 +1,471 @@
+"""
+Text decoding against a search image rendered from a known character sequence.
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
+
+from depixlib.colorspace import AVERAGE_TYPES, toWorkingSpace
+from depixlib.functions import detectBlockGrid
+from depixlib.helpers import check_file, check_positive_int
+from depixlib.LoadedImage import LoadedImage
+from depixlib.metrics import DISABLED, Metrics
+from depixlib.Rectangle import Rectangle
+from depixlib.SearchIndex import backgroundColor, detectTextBands
+
+logger = logging.getLogger(__name__)
+
+# Text candidates returned by decodeText() unless asked otherwise
+DEFAULT_CANDIDATES = 5
+
+
+class SequenceLayout:
+    """
+    Where each character of a sequence sits in a monospaced render of it.
+
+    The sequence is wrapped at a fixed number of characters per line, with
+    every character in a cell of the same width and every line the same
+    height apart.
+    """
+
+    def __init__(
+        self,
+        sequence: str,
+        charsPerLine: int,
+        cellWidth: int,
+        lineHeight: int,
+        originX: int,
+        originY: int,
+        background: Tuple[int, int, int]
+    ) -> None:
+        """
+        Initialize from known metrics (see detect()).
+
+        Args:
+            sequence: The rendered characters, without line breaks
+            charsPerLine: Characters before the render wraps to a new line
+            cellWidth: Advance of one character in pixels
+            lineHeight: Distance between the tops of two lines in pixels
+            originX: Left edge of the first cell of every line
+            originY: Top edge of the first line's cells
+            background: RGB background colour of the render
+        """
+        self.sequence = sequence
+        self.charsPerLine = charsPerLine
+        self.cellWidth = cellWidth
+        self.lineHeight = lineHeight
+        self.originX = originX
+        self.originY = originY
+        self.background = background
+
+    @classmethod
+    def detect(cls, searchArray: np.ndarray, sequence: str) -> SequenceLayout:
+        """
+        Fit the layout of a sequence to its render.
+
+        The line count and the ink width of full and last lines give the
+        characters per line and the cell width; the cell grid is then
+        placed where the fewest text pixels fall on cell boundaries.
+
+        Args:
+            searchArray: (H, W, 3) uint8 RGB render of the sequence
+            sequence: The rendered characters, without line breaks
+
+        Returns:
+            The layout
+
+        Raises:
+            ValueError: If the image is not a monospaced render of the
+                sequence over at least two lines
+        """
+        bands = detectTextBands(searchArray)
+        if len(bands) < 2:
+            raise ValueError(
+                f"Found {len(bands)} text line(s) in the search image, need at least 2"
+            )
+        lines = len(bands)
+        lineHeight = int(round(float(np.median(np.diff(bands[:, 0])))))
+        # Ink tops differ by glyph, so fit one grid of line tops
+        originY = int(np.median(bands[:, 0] - lineHeight * np.arange(lines)))
+        originY -= (lineHeight - int(np.median(bands[:, 1] - bands[:, 0]))) // 2
+
+        fullWidth = float(np.median(bands[:-1, 3] - bands[:-1, 2]))
+        lastWidth = float(bands[-1, 3] - bands[-1, 2])
+        charsPerLine = int(round(len(sequence) / (lastWidth / fullWidth + lines - 1)))
+        cellWidth = int(round(fullWidth / charsPerLine)) if charsPerLine else 0
+        if (
+            cellWidth < 1
+            or -(-len(sequence) // charsPerLine) != lines
+            or abs(fullWidth - charsPerLine * cellWidth) > cellWidth
+        ):
+            raise ValueError(
+                "The search image is not a monospaced render of the sequence "
+                f"({lines} lines of about {fullWidth:.0f} pixels)"
+            )
+
+        background = backgroundColor(searchArray)
+        ink = (searchArray[:, :, :3] != np.array(background, dtype=np.uint8)).any(axis=2)
+        rows = np.zeros(len(ink), dtype=bool)
+        for top, bottom, _, _ in bands.tolist():
+            rows[top:bottom] = True
+        columnInk = ink[rows].sum(axis=0)
+        left = int(bands[:, 2].min())
+        boundaryInk = []
+        for originX in range(left - cellWidth + 1, left + 1):
+            boundaries = originX + cellWidth * np.arange(charsPerLine + 1)
+            boundaries = boundaries[(boundaries >= 0) & (boundaries < len(columnInk))]
+            boundaryInk.append((int(columnInk[boundaries].sum()), originX))
+        originX = min(boundaryInk)[1]
+
+        logger.info(
+            "Sequence layout: %d characters per line, %dx%d cells at (%d, %d)",
+            charsPerLine, cellWidth, lineHeight, originX, originY
+        )
+        return cls(
+            sequence, charsPerLine, cellWidth, lineHeight, originX, originY, background
+        )
+
+    def position(self, offset: int) -> Tuple[int, int]:
+        """
+        Top-left corner of the cell of a sequence offset.
+
+        Args:
+            offset: Index into the sequence
+
+        Returns:
+            (x, y) in the search image
+        """
+        line, column = divmod(offset, self.charsPerLine)
+        return self.originX + column * self.cellWidth, self.originY + line * self.lineHeight
+
+    def offsetAt(self, x: int, y: int) -> int | None:
+        """
+        Sequence offset of the cell covering a search image pixel.
+
+        Args:
+            x: Search image column
+            y: Search image row
+
+        Returns:
+            Index into the sequence, or None outside the rendered text
+        """
+        column, line = (x - self.originX) // self.cellWidth, (y - self.originY) // self.lineHeight
+        if not (0 <= column < self.charsPerLine and line >= 0):
+            return None
+        offset = line * self.charsPerLine + column
+        return offset if offset < len(self.sequence) else None
+
+    def pairStrips(self, searchArray: np.ndarray) -> Tuple[str, np.ndarray]:
+        """
+        Render of every ordered pair of characters, two cells wide.
+
+        A pair the sequence renders side by side is cut from the search
+        image, which keeps pixels a glyph spills into its neighbour. Pairs
+        split across lines, and pairs with a space when the sequence has
+        none, are put together from single cells.
+
+        Args:
+            searchArray: (H, W, 3) uint8 RGB render of the sequence
+
+        Returns:
+            Tuple of (alphabet, (A, A, lineHeight, 2 * cellWidth, 3) uint8
+            array indexed by the alphabet positions of both characters)
+        """
+        alphabet = "".join(sorted(set(self.sequence) | {" "}))
+        index = {c: i for i, c in enumerate(alphabet)}
+        # Pad with background, so cells of the last line and column fit
+        height, width = searchArray.shape[:2]
+        padded = np.empty(
+            (max(height, self.originY) + 2 * self.lineHeight,
+             max(width, self.originX) + 2 * self.cellWidth, 3),
+            dtype=np.uint8
+        )
+        padded[:] = self.background
+        top, left = max(-self.originY, 0), max(-self.originX, 0)
+        padded[top:top + height, left:left + width] = searchArray[:, :, :3]
+
+        def cut(offset: int, cells: int) -> np.ndarray:
+            x, y = self.position(offset)
+            return padded[y + top:y + top + self.lineHeight,
+                          x + left:x + left + cells * self.cellWidth]
+
+        blank = np.empty((self.lineHeight, self.cellWidth, 3), dtype=np.uint8)
+        blank[:] = self.background
+        cells = {c: cut(offset, 1) for offset, c in reversed(list(enumerate(self.sequence)))}
+        cells.setdefault(" ", blank)
+
+        strips = np.empty(
+            (len(alphabet), len(alphabet), self.lineHeight, 2 * self.cellWidth, 3),
+            dtype=np.uint8
+        )
+        for a in alphabet:
+            for b in alphabet:
+                strips[index[a], index[b], :, :self.cellWidth] = cells[a]
+                strips[index[a], index[b], :, self.cellWidth:] = cells[b]
+        # De Bruijn order 2 renders each pair once; the first render wins
+        for offset in reversed(range(len(self.sequence) - 1)):
+            if offset % self.charsPerLine != self.charsPerLine - 1:
+                a, b = self.sequence[offset], self.sequence[offset + 1]
+                strips[index[a], index[b]] = cut(offset, 2)
+        return alphabet, strips
+
+
+def _nBestPaths(
+    transitions: np.ndarray,
+    final: np.ndarray,
+    count: int
+) -> List[Tuple[float, List[int]]]:
+    """
+    Lowest-cost state sequences of a chain (list Viterbi).
+
+    Args:
+        transitions: (L - 1, A, A) cost of each pair of neighbouring states
+        final: (A,) cost of each last state
+        count: Number of paths to return
+
+    Returns:
+        List of (cost, states), cheapest first
+    """
+    states = transitions.shape[1] if len(transitions) else len(final)
+    # costs[s, r]: r-th cheapest path ending in state s
+    costs = np.full((states, count), np.inf)
+    costs[:, 0] = 0.0
+    pointers = []
+    for step in transitions:
+        candidates = (costs[:, :, None] + step[:, None, :]).reshape(states * count, states)
+        best = np.argsort(candidates, axis=0, kind="stable")[:count]
+        costs = np.take_along_axis(candidates, best, axis=0).T
+        pointers.append(best.T)
+
+    totals = (costs + final[:, None]).ravel()
+    paths = []
+    for flat in np.argsort(totals, kind="stable")[:count].tolist():
+        if not np.isfinite(totals[flat]):
+            break
+        state, rank = divmod(flat, count)
+        path = [state]
+        for pointer in reversed(pointers):
+            state, rank = divmod(int(pointer[state, rank]), count)
+            path.append(state)
+        paths.append((float(totals[flat]), path[::-1]))
+    return paths
+
+
+def decodeText(
+    pixelatedImage: LoadedImage,
+    searchImage: LoadedImage,
+    sequence: str,
+    averageType: str = "gammacorrected",
+    candidates: int = DEFAULT_CANDIDATES,
+    grid: Tuple[int, int, int, int] | None = None,
+    metrics: Metrics | None = None
+) -> List[Tuple[str, float]]:
+    """
+    Read one pixelated line of text as characters of a rendered sequence.
+
+    Every block of the line lies in one character cell or straddles two
+    neighbours, so its colour is predicted exactly by the render of that
+    pair of characters in the search image. The best text is then a
+    shortest path over one state per character (Viterbi), searched for
+    each placement of the character cells against the block grid. The cost
+    grows with the line length times the squared alphabet size, not with
+    the search image area, and the whole alphabet is scored rather than
+    one best window per block.
+
+    Args:
+        pixelatedImage: Pixelated image of a single line of text
+        searchImage: Monospaced render of the sequence in the same font
+        sequence: The rendered characters, without line breaks
+        averageType: Type of averaging ('gammacorrected', 'linear' or 'srgb')
+        candidates: Number of texts to return
+        grid: Known (block width, block height, x offset, y offset), detected
+            with detectBlockGrid() if None
+        metrics: Optional Metrics timing the "decode" stage and counting
+            the cell placements tried in "decodePlacements"
+
+    Returns:
+        List of (text, mean squared block error), best first
+
+    Raises:
+        ValueError: If no block grid is found, blocks are wider than a
+            character, or the search image is not a render of the sequence
+    """
+    metrics = metrics or DISABLED
+    with metrics.stage("decode"):
+        layout = SequenceLayout.detect(searchImage.array, sequence)
+        alphabet, strips = layout.pairStrips(searchImage.array)
+        cellWidth, lineHeight = layout.cellWidth, layout.lineHeight
+
+        if grid is None:
+            grid = detectBlockGrid(
+                pixelatedImage,
+                Rectangle((0, 0), (pixelatedImage.width - 1, pixelatedImage.height - 1))
+            )
+            if grid is None:
+                raise ValueError("No regular block grid found in the pixelated image")
+        blockWidth, blockHeight, offsetX, offsetY = grid
+        if blockWidth > cellWidth:
+            raise ValueError(
+                f"Blocks are {blockWidth} pixels wide, wider than a {cellWidth}-pixel character"
+            )
+
+        # Observed colour of every whole block
+        blockXs = np.arange(offsetX % blockWidth, pixelatedImage.width - blockWidth + 1, blockWidth)
+        blockYs = np.arange(offsetY % blockHeight, pixelatedImage.height - blockHeight + 1, blockHeight)
+        if len(blockXs) == 0 or len(blockYs) == 0:
+            raise ValueError("The pixelated image holds no whole block")
+        working = pixelatedImage.working(averageType).astype(np.float64)
+        observed = np.stack([
+            np.stack([
+                working[y:y + blockHeight, x:x + blockWidth].mean(axis=(0, 1))
+                for x in blockXs.tolist()
+            ])
+            for y in blockYs.tolist()
+        ])
+
+        # Mean of every block-sized box of every pair strip, with one block
+        # of background above and below; blocks further off the line see
+        # background only, so their rows are clamped to these
+        margin = blockHeight
+        background = toWorkingSpace(np.array(layout.background, dtype=np.uint8), averageType)
+        tall = np.empty(strips.shape[:2] + (lineHeight + 2 * margin, 2 * cellWidth, 3))
+        tall[:] = background
+        tall[:, :, margin:margin + lineHeight] = toWorkingSpace(strips, averageType)
+        integral = np.zeros(tall.shape[:2] + (tall.shape[2] + 1, tall.shape[3] + 1, 3))
+        integral[:, :, 1:, 1:] = tall.cumsum(axis=2).cumsum(axis=3)
+        boxMeans = (
+            integral[:, :, blockHeight:, blockWidth:]
+            - integral[:, :, :-blockHeight, blockWidth:]
+            - integral[:, :, blockHeight:, :-blockWidth]
+            + integral[:, :, :-blockHeight, :-blockWidth]
+        )[:, :, :, :cellWidth].astype(np.float32) / (blockWidth * blockHeight)
+        observed = observed.astype(np.float32)
+
+        # Try every placement of the cells: a horizontal phase and the row
+        # of the pixelated image at the top of the line
+        best: Tuple[float, int, int] | None = None
+        placements = [
+            (x0, y0)
+            for x0 in range(1 - cellWidth, 1)
+            for y0 in range(1 - lineHeight, pixelatedImage.height)
+        ]
+        metrics.count("decodePlacements", len(placements))
+        for x0, y0 in placements:
+            transitions, final = _placementCosts(
+                boxMeans, observed, blockXs, blockYs, x0, y0, cellWidth, margin
+            )
+            cost = _nBestPaths(transitions, final, 1)[0][0]
+            if best is None or cost < best[0]:
+                best = (cost, x0, y0)
+        if best is None:
+            raise ValueError("No path through the layout fits the pixelated image")
+
+        _, x0, y0 = best
+        logger.info("Best cell placement: phase %d, line top at row %d", x0, y0)
+        transitions, final = _placementCosts(
+            boxMeans, observed, blockXs, blockYs, x0, y0, cellWidth, margin
+        )
+        # Paths differing only in blanks at the ends read the same, so ask
+        # for spares before dropping duplicates
+        results: List[Tuple[str, float]] = []
+        for cost, path in _nBestPaths(transitions, final, 4 * candidates):
+            text = "".join(alphabet[state] for state in path).strip()
+            if text not in (seen[0] for seen in results):
+                results.append((text, cost / observed.shape[0] / observed.shape[1]))
+            if len(results) == candidates:
+                break
+    return results
+
+
+def _placementCosts(
+    boxMeans: np.ndarray,
+    observed: np.ndarray,
+    blockXs: np.ndarray,
+    blockYs: np.ndarray,
+    x0: int,
+    y0: int,
+    cellWidth: int,
+    margin: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Chain costs of one cell placement, see decodeText()."""
+    # Block j starts in cell cells[j], at column phases[j] of that cell
+    cells, phases = np.divmod(blockXs - x0, cellWidth)
+    rows = np.clip(blockYs - y0, -margin, boxMeans.shape[2] - 1 - margin) + margin
+    predicted = boxMeans[:, :, rows[:, None], phases[None, :]]
+    errors = np.square(predicted - observed).sum(axis=(-1, 2))
+
+    # Sum the blocks of each cell; a cell nothing starts in costs nothing
+    costs = np.zeros((int(cells[-1]) + 1,) + errors.shape[:2])
+    starts = np.flatnonzero(np.diff(cells, prepend=-1))
+    costs[cells[starts]] = np.moveaxis(np.add.reduceat(errors, starts, axis=2), 2, 0)
+    # No block reaches past the last cell, so its neighbour is free
+    return costs[:-1], costs[-1].min(axis=1)
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    """Parse `depix decode` command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="depix decode",
+        description="Read pixelated text as characters of the sequence a search image renders.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Example usage:
+  python3 depix.py decode -p images/testimages/testimage3_pixels.png \\
+      -s images/searchimages/debruinseq_notepad_Windows10_close.png \\
+      --sequence images/searchimages/debruinseq.txt
+        """
+    )
+    parser.add_argument(
+        "-p", "--pixelimage",
+        required=True,
+        type=check_file,
+        metavar="PATH",
+        help="Path to image with one pixelated line of text"
+    )
+    parser.add_argument(
+        "-s", "--searchimage",
+        required=True,
+        type=check_file,
+        metavar="PATH",
+        help="Monospaced render of the sequence in the same font"
+    )
+    parser.add_argument(
+        "--sequence",
+        required=True,
+        type=check_file,
+        metavar="PATH",
+        help="Text file with the rendered characters"
+    )
+    parser.add_argument(
+        "-a", "--averagetype",
+        default="gammacorrected",
+        choices=AVERAGE_TYPES,
+        help="Type of RGB averaging (default: gammacorrected)"
+    )
+    parser.add_argument(
+        "-n", "--candidates",
+        default=DEFAULT_CANDIDATES,
+        type=check_positive_int,
+        metavar="N",
+        help=f"Text candidates to print (default: {DEFAULT_CANDIDATES})"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    """Entry point of `depix decode`."""
+    args = parse_args(argv)
+    sequence = "".join(Path(args.sequence).read_text().splitlines())
+    results = decodeText(
+        LoadedImage(args.pixelimage),
+        LoadedImage(args.searchimage),
+        sequence,
+        args.averagetype,
+        args.candidates
+    )
+    for text, error in results:
+        print(f"{error:.6f}\t{text}")
@@ -0,0 +1,506 @@
+"""
+Long-running depixelization service with resident search indexes.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Sequence, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+from PIL import Image
+
+from depixlib.batch import JOB_OPTIONS, SearchImagePool, depixelizeJob
+from depixlib.colorspace import AVERAGE_TYPES
+from depixlib.functions_numpy import MATCHERS
+from depixlib.helpers import check_color, check_non_negative_int, check_positive_int
+from depixlib.IndexCache import IndexCache
+from depixlib.LoadedImage import LoadedImage
+from depixlib.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_BYTES = 64 * 1024
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# (status, extra headers, body)
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+def _jsonResponse(status: int, payload: Dict[str, Any]) -> Response:
+    return status, {"Content-Type": "application/json"}, json.dumps(payload).encode()
+
+
+class DepixService:
+    """
+    HTTP/1.1 service that depixelizes uploaded images.
+
+    Requests are parsed on an asyncio event loop and the matching runs on a
+    thread pool, where NumPy and OpenCV release the GIL; threads rather than
+    processes let every job use the same resident SearchImagePool. Jobs
+    beyond the workers wait in a queue of bounded length, and requests
+    arriving while it is full are refused with 503 before their body is
+    read. Requests may only pick search images configured at startup or
+    files inside the search directory; others are refused with 403.
+
+    Endpoints:
+        POST /depixelize?searchimage=PATH&...  body: pixelated image file;
+            returns the output PNG with match statistics in the
+            X-Depix-Stats header. Query parameters are the JOB_OPTIONS of
+            batch mode, except outputimage.
+        GET /stats  service counters, resident memory and the stage times
+            and counters summed over all jobs, as JSON
+        GET /health  liveness check
+    """
+
+    def __init__(
+        self,
+        pool: SearchImagePool,
+        defaults: Dict[str, Any],
+        workers: int = 1,
+        maxQueue: int = 16,
+        maxRequestBytes: int = 64 * 1024 * 1024,
+        searchImages: Sequence[str] = (),
+        searchDirectory: str | None = None
+    ) -> None:
+        """
+        Initialize the service.
+
+        Args:
+            pool: Resident search images and indexes
+            defaults: Option values for query parameters a request omits
+            workers: Threads running depixelization jobs
+            maxQueue: Jobs allowed to wait for a worker before refusing more
+            maxRequestBytes: Largest accepted request body
+            searchImages: Search images requests may name, besides the
+                default one
+            searchDirectory: Directory whose files requests may name as
+                search images; relative names are resolved inside it
+        """
+        self.pool = pool
+        self.defaults = defaults
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.maxRequestBytes = maxRequestBytes
+        self.searchImages = {
+            os.path.realpath(path)
+            for path in (*searchImages, defaults.get("searchimage"))
+            if path is not None
+        }
+        self.searchDirectory = (
+            None if searchDirectory is None else os.path.realpath(searchDirectory)
+        )
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.active = 0
+        self.served = 0
+        self.failed = 0
+        self.rejected = 0
+        self.metrics = Metrics()
+
+    def close(self) -> None:
+        """Wait for running jobs and stop the worker threads."""
+        self.executor.shutdown(wait=True)
+
+    async def handleConnection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter
+    ) -> None:
+        """Serve requests on one connection until the client closes it."""
+        try:
+            while True:
+                keepAlive, response = await self._readAndHandle(reader)
+                if response is None:
+                    break
+                self._writeResponse(writer, response, keepAlive)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _readAndHandle(
+        self,
+        reader: asyncio.StreamReader
+    ) -> Tuple[bool, Response | None]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return False, None
+        except asyncio.LimitOverrunError:
+            return False, _jsonResponse(400, {"error": "Request header too large"})
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            return False, _jsonResponse(400, {"error": "Malformed request line"})
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        keepAlive = (
+            headers.get("connection", "").lower() != "close"
+            and version == "HTTP/1.1"
+        )
+
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            return False, _jsonResponse(400, {"error": "Invalid Content-Length"})
+        if length < 0:
+            return False, _jsonResponse(400, {"error": "Invalid Content-Length"})
+        if length > self.maxRequestBytes:
+            return False, _jsonResponse(413, {"error": "Request body too large"})
+        if method == "POST" and urlsplit(target).path == "/depixelize" and self._queueFull():
+            # Refuse before buffering the body; the connection cannot be reused
+            return False, self._rejectResponse()
+        body = await reader.readexactly(length) if length else b""
+
+        return keepAlive, await self.handle(method, target, body)
+
+    @staticmethod
+    def _writeResponse(
+        writer: asyncio.StreamWriter,
+        response: Response,
+        keepAlive: bool
+    ) -> None:
+        status, headers, body = response
+        lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}"]
+        headers = dict(headers)
+        headers["Content-Length"] = str(len(body))
+        headers["Connection"] = "keep-alive" if keepAlive else "close"
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+    async def handle(self, method: str, target: str, body: bytes) -> Response:
+        """
+        Route one request.
+
+        Args:
+            method: HTTP method
+            target: Request target, path plus query string
+            body: Request body
+
+        Returns:
+            Tuple of (status, headers, body)
+        """
+        url = urlsplit(target)
+        if url.path == "/health":
+            return _jsonResponse(200, {"status": "ok"})
+        if url.path == "/stats":
+            return _jsonResponse(200, self.stats())
+        if url.path != "/depixelize":
+            return _jsonResponse(404, {"error": f"Unknown path {url.path}"})
+        if method != "POST":
+            return _jsonResponse(405, {"error": "Use POST"})
+
+        try:
+            job = self._jobOptions(parse_qsl(url.query))
+        except PermissionError as e:
+            return _jsonResponse(403, {"error": str(e)})
+        except (TypeError, ValueError) as e:
+            return _jsonResponse(400, {"error": str(e)})
+
+        if self._queueFull():
+            return self._rejectResponse()
+
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            png, stats = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._depixelize, body, job
+            )
+        except Exception as e:
+            self.failed += 1
+            logger.error("Request failed: %s", e)
+            return _jsonResponse(500, {"error": str(e)})
+        finally:
+            self.active -= 1
+
+        self.served += 1
+        stats["seconds"] = round(time.perf_counter() - start, 4)
+        return 200, {
+            "Content-Type": "image/png",
+            "X-Depix-Stats": json.dumps(stats),
+        }, png
+
+    def _queueFull(self) -> bool:
+        return self.active >= self.workers + self.maxQueue
+
+    def _rejectResponse(self) -> Response:
+        self.rejected += 1
+        status, headers, payload = _jsonResponse(503, {"error": "Queue full"})
+        headers["Retry-After"] = "1"
+        return status, headers, payload
+
+    def _searchImagePath(self, name: str) -> str:
+        """Resolve a requested search image, refusing files not configured."""
+        if self.searchDirectory is not None and not os.path.isabs(name):
+            name = os.path.join(self.searchDirectory, name)
+        path = os.path.realpath(name)
+        inDirectory = self.searchDirectory is not None and os.path.commonpath(
+            [path, self.searchDirectory]
+        ) == self.searchDirectory
+        if path not in self.searchImages and not inDirectory:
+            raise PermissionError(f"Search image {name} is not served")
+        return path
+
+    def _jobOptions(self, query: List[Tuple[str, str]]) -> Dict[str, Any]:
+        job = dict(self.defaults)
+        for name, value in query:
+            if name not in JOB_OPTIONS or name == "outputimage":
+                raise ValueError(f"Unknown option {name!r}")
+            job[name] = JOB_OPTIONS[name](value)
+        if job.get("searchimage") is None:
+            raise ValueError("No search image given")
+        job["searchimage"] = self._searchImagePath(job["searchimage"])
+        if not os.path.isfile(job["searchimage"]):
+            raise ValueError(f"Search image {job['searchimage']} does not exist")
+        if job["matcher"] not in MATCHERS:
+            raise ValueError(f"Unknown matcher {job['matcher']!r}")
+        if job["averagetype"] not in AVERAGE_TYPES:
+            raise ValueError(f"Unknown average type {job['averagetype']!r}")
+        return job
+
+    def _depixelize(self, body: bytes, job: Dict[str, Any]) -> Tuple[bytes, Dict[str, Any]]:
+        """Decode, depixelize and encode one image; runs on a worker thread."""
+        metrics = Metrics()
+        with metrics.stage("load"), Image.open(io.BytesIO(body)) as image:
+            pixelatedImage = LoadedImage.fromArray(np.asarray(image.convert("RGB")))
+        outputCanvas, stats = depixelizeJob(pixelatedImage, job, self.pool, metrics)
+        self.pool.trim()
+
+        output = io.BytesIO()
+        with metrics.stage("save"):
+            Image.fromarray(outputCanvas).save(output, format="PNG")
+        self.metrics.merge(metrics)
+        return output.getvalue(), dict(stats, stages=metrics.toDict()["stages"])
+
+    def stats(self) -> Dict[str, Any]:
+        """Service counters and resident memory."""
+        return {
+            "active": self.active,
+            "served": self.served,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "indexes": len(self.pool),
+            "residentBytes": self.pool.nbytes,
+            "metrics": self.metrics.toDict(),
+        }
+
+
+async def serve(
+    service: DepixService,
+    socketPath: str | None = None,
+    host: str = "127.0.0.1",
+    port: int = 8765
+) -> None:
+    """
+    Run the service until cancelled.
+
+    Args:
+        service: Service to run
+        socketPath: Unix socket to listen on instead of host and port
+        host: Address to listen on
+        port: TCP port to listen on
+    """
+    if socketPath is not None:
+        server = await asyncio.start_unix_server(
+            service.handleConnection, path=socketPath, limit=MAX_HEADER_BYTES
+        )
+        logger.info("Listening on unix socket %s", socketPath)
+    else:
+        server = await asyncio.start_server(
+            service.handleConnection, host=host, port=port, limit=MAX_HEADER_BYTES
+        )
+        logger.info("Listening on http://%s:%d", host, port)
+
+    # Stop cleanly on SIGTERM/SIGINT so the socket file is removed
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    if task is not None:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, task.cancel)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+        if socketPath is not None and os.path.exists(socketPath):
+            os.unlink(socketPath)
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    """Parse `depix serve` command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="depix serve",
+        description="Serve depixelization requests with resident search indexes.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Example usage:
+  python3 depix.py serve -s search.png --port 8765
+  curl --data-binary @pixelated.png -o output.png \\
+      'http://127.0.0.1:8765/depixelize?matcher=index'
+  python3 depix.py serve --socket /tmp/depix.sock --workers 4
+        """
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        metavar="PATH",
+        help="Listen on a Unix socket instead of TCP"
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1)"
+    )
+    parser.add_argument(
+        "--port",
+        default=8765,
+        type=int,
+        help="TCP port to listen on (default: 8765)"
+    )
+    parser.add_argument(
+        "-s", "--searchimage",
+        default=None,
+        metavar="PATH",
+        help="Default search image for requests that do not set one"
+    )
+    parser.add_argument(
+        "--allowsearch",
+        default=[],
+        action="append",
+        metavar="PATH",
+        help="Another search image requests may select; repeat for more"
+    )
+    parser.add_argument(
+        "--searchdir",
+        default=None,
+        metavar="PATH",
+        help="Directory whose images requests may select as search images"
+    )
+    parser.add_argument(
+        "-a", "--averagetype",
+        default="gammacorrected",
+        choices=AVERAGE_TYPES,
+        help="Default type of RGB averaging (default: gammacorrected)"
+    )
+    parser.add_argument(
+        "-b", "--backgroundcolor",
+        default=None,
+        type=check_color,
+        metavar="R,G,B",
+        help="Default background color to ignore (format: r,g,b)"
+    )
+    parser.add_argument(
+        "-m", "--matcher",
+        default="index",
+        choices=MATCHERS,
+        help="Default block matching strategy (default: index)"
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=1.0,
+        type=float,
+        metavar="N",
+        help="Per-channel colour tolerance for the index matcher (default: 1.0)"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        default=os.cpu_count() or 1,
+        type=check_positive_int,
+        metavar="N",
+        help="Worker threads running jobs (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--queuesize",
+        default=16,
+        type=check_non_negative_int,
+        metavar="N",
+        help="Jobs allowed to wait for a worker before refusing (default: 16)"
+    )
+    parser.add_argument(
+        "--maxrequest",
+        default=64,
+        type=check_positive_int,
+        metavar="MB",
+        help="Largest accepted upload in megabytes (default: 64)"
+    )
+    parser.add_argument(
+        "--memorylimit",
+        default=2048,
+        type=check_positive_int,
+        metavar="MB",
+        help="Resident search image and index memory before eviction (default: 2048)"
+    )
+    parser.add_argument(
+        "--cachedir",
+        default=None,
+        metavar="PATH",
+        help="Directory for cached decoded search images and indexes"
+    )
+    parser.add_argument(
+        "--cachesize",
+        default=2048,
+        type=int,
+        metavar="MB",
+        help="Size cap of the index cache in megabytes (default: 2048)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    """Entry point of `depix serve`."""
+    args = parse_args(argv)
+    logging.getLogger("depixlib").setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    cache = None
+    if args.cachedir:
+        cache = IndexCache(args.cachedir, args.cachesize * 1024 * 1024)
+    pool = SearchImagePool(cache, maxBytes=args.memorylimit * 1024 * 1024)
+
+    defaults = {name: getattr(args, name, None) for name in JOB_OPTIONS}
+    defaults.update(
+        topk=1, scorethreshold=None, noneighbourpass=False, weightedaverage=False, grid=False,
+        textbands=False, nomatchmemo=False
+    )
+    del defaults["outputimage"]
+
+    service = DepixService(
+        pool,
+        defaults,
+        workers=args.workers,
+        maxQueue=args.queuesize,
+        maxRequestBytes=args.maxrequest * 1024 * 1024,
+        searchImages=args.allowsearch,
+        searchDirectory=args.searchdir
+    )
+    try:
+        asyncio.run(serve(service, args.socket, args.host, args.port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Shut down")
@@ -0,0 +1,226 @@
+"""
+Tiled processing of tall pixelated images within a memory budget.
+"""
+from __future__ import annotations
+
+import logging
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+import numpy as np
+
+from depixlib.functions_numpy import buildSearchIndex
+from depixlib.LoadedImage import LoadedImage
+from depixlib.metrics import DISABLED
+from depixlib.pipeline import depixelize
+
+logger = logging.getLogger(__name__)
+
+# Working memory per tile pixel: the float32 working copy, block detection
+# index arrays, the tile output and matcher temporaries, rounded up
+TILE_BYTES_PER_PIXEL = 96
+
+# Rows compared at once when looking for tile boundaries
+BOUNDARY_SCAN_ROWS = 1024
+
+
+class PngStreamWriter:
+    """
+    Write an RGB PNG row band by row band, without holding the whole image.
+
+    The image size is fixed up front; bands are deflated as they arrive and
+    written out in IDAT chunks.
+    """
+
+    def __init__(self, path: str, width: int, height: int, chunkBytes: int = 1 << 20) -> None:
+        """
+        Create the file and write the PNG header.
+
+        Args:
+            path: Output file path
+            width: Image width
+            height: Image height
+            chunkBytes: Compressed bytes collected before writing an IDAT chunk
+        """
+        self.width = width
+        self.height = height
+        self.rowsWritten = 0
+        self._chunkBytes = chunkBytes
+        self._compressor = zlib.compressobj(6)
+        self._pending = bytearray()
+        self._file = open(path, "wb")
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        self._writeChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _writeChunk(self, kind: bytes, data: bytes) -> None:
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def writeRows(self, rows: np.ndarray) -> None:
+        """
+        Append a band of rows.
+
+        Args:
+            rows: (n, width, 3) uint8 array
+        """
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, 3), got {rows.shape}")
+        if self.rowsWritten + len(rows) > self.height:
+            raise ValueError("More rows than the image height")
+
+        # Every row starts with filter type 0 (None)
+        scanlines = np.zeros((len(rows), 1 + 3 * self.width), dtype=np.uint8)
+        scanlines[:, 1:] = rows.reshape(len(rows), -1)
+        self._pending += self._compressor.compress(scanlines.tobytes())
+        self.rowsWritten += len(rows)
+        if len(self._pending) >= self._chunkBytes:
+            self._writeChunk(b"IDAT", bytes(self._pending))
+            self._pending.clear()
+
+    def close(self) -> None:
+        """Finish the image; all rows must have been written."""
+        if self._file.closed:
+            return
+        try:
+            if self.rowsWritten != self.height:
+                raise ValueError(f"Wrote {self.rowsWritten} of {self.height} rows")
+            self._pending += self._compressor.flush()
+            self._writeChunk(b"IDAT", bytes(self._pending))
+            self._writeChunk(b"IEND", b"")
+        finally:
+            self._file.close()
+
+    def __enter__(self) -> PngStreamWriter:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        if exc[0] is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+def tileRowsForBudget(width: int, memoryBudget: int) -> int:
+    """
+    Number of image rows a tile may have to stay within a memory budget.
+
+    Args:
+        width: Image width
+        memoryBudget: Working memory allowed per tile in bytes
+
+    Returns:
+        Tile height in rows, at least 1
+    """
+    return max(1, memoryBudget // (max(width, 1) * TILE_BYTES_PER_PIXEL))
+
+
+def _rowChangeCounts(array: np.ndarray) -> np.ndarray:
+    """Number of columns whose colour changes between row y - 1 and row y."""
+    height = array.shape[0]
+    counts = np.zeros(height, dtype=np.int64)
+    for start in range(1, height, BOUNDARY_SCAN_ROWS):
+        end = min(start + BOUNDARY_SCAN_ROWS, height)
+        changed = np.any(array[start:end] != array[start - 1:end - 1], axis=2)
+        counts[start:end] = np.count_nonzero(changed, axis=1)
+    return counts
+
+
+def tileBoundaries(array: np.ndarray, tileRows: int) -> List[Tuple[int, int]]:
+    """
+    Split an image into horizontal tiles along block grid rows.
+
+    Each tile ends at the row, in the second half of the allowed tile
+    height, where the most columns change colour. On a pixelated image
+    that is a boundary between block rows, so few blocks are cut in two.
+
+    Args:
+        array: (H, W, 3) image array
+        tileRows: Maximum tile height
+
+    Returns:
+        List of (start row, end row) pairs covering the image
+    """
+    height = array.shape[0]
+    if height <= tileRows:
+        return [(0, height)]
+
+    counts = _rowChangeCounts(array)
+    tiles = []
+    start = 0
+    while height - start > tileRows:
+        low = start + max(1, tileRows // 2)
+        high = start + tileRows
+        # Last row with the highest count, so tiles stay as large as allowed
+        window = counts[low:high + 1]
+        end = low + len(window) - 1 - int(np.argmax(window[::-1]))
+        tiles.append((start, end))
+        start = end
+    tiles.append((start, height))
+    return tiles
+
+
+def depixelizeTiled(
+    pixelatedImage: LoadedImage,
+    searchImage: LoadedImage,
+    outputPath: str,
+    memoryBudget: int,
+    tileRows: int | None = None,
+    **options: Any
+) -> Dict[str, int]:
+    """
+    Depixelize an image tile by tile, streaming the output PNG to disk.
+
+    Block detection and matching only ever see one tile, so their working
+    memory is bounded by the budget instead of the image size. Each output
+    band is written as soon as its tile is done. Tiles are views of
+    pixelatedImage.array; the budget covers the input only when that array
+    is memory-mapped, as LoadedImage(path, cache) does.
+
+    Args:
+        pixelatedImage: Pixelated input image
+        searchImage: Image to search for matches
+        outputPath: Output PNG path
+        memoryBudget: Working memory allowed per tile in bytes
+        tileRows: Tile height, derived from memoryBudget if None
+        **options: Keyword arguments of depixelize()
+
+    Returns:
+        Block counts per stage, summed over tiles, plus the number of tiles
+    """
+    if Path(outputPath).suffix.lower() != ".png":
+        raise ValueError("Tiled processing writes PNG output")
+    if tileRows is None:
+        tileRows = tileRowsForBudget(pixelatedImage.width, memoryBudget)
+
+    # One index for all tiles, so search image structures are built once
+    if options.get("searchIndex") is None:
+        options["searchIndex"] = buildSearchIndex(
+            searchImage,
+            options.get("averageType", "gammacorrected"),
+            options.get("tolerance", 1.0),
+            options.get("cache")
+        )
+
+    metrics = options.get("metrics") or DISABLED
+    tiles = tileBoundaries(pixelatedImage.array, tileRows)
+    logger.info(
+        "Processing %d tiles of up to %d rows", len(tiles), tileRows
+    )
+
+    metrics.count("tiles", len(tiles))
+    totals: Dict[str, int] = {"tiles": len(tiles)}
+    with PngStreamWriter(outputPath, pixelatedImage.width, pixelatedImage.height) as writer:
+        for number, (start, end) in enumerate(tiles, 1):
+            logger.info("Tile %d/%d: rows %d-%d", number, len(tiles), start, end - 1)
+            tile = LoadedImage.fromArray(
+                pixelatedImage.array[start:end], path=f"{pixelatedImage.path}[{start}:{end}]"
+            )
+            outputTile, stats = depixelize(tile, searchImage, **options)
+            with metrics.stage("save"):
+                writer.writeRows(outputTile)
+            for name, value in stats.items():
+                totals[name] = totals.get(name, 0) + value
+    return totals
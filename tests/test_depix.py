@@ -8,6 +8,7 @@ from pathlib import Path
 # Add parent directory to path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from depixlib.LoadedImage import LoadedImage
 from depixlib.Rectangle import Rectangle, ColorRectangle, RectangleMatch
 from depixlib.helpers import (
     check_color,
@@ -18,6 +19,31 @@ from depixlib.helpers import (
 )
 
 
+class TestLoadedImage(unittest.TestCase):
+    """Test LoadedImage class."""
+    
+    def test_load_strips_alpha(self):
+        """Test that RGBA images load as a read-only (H, W, 3) uint8 array."""
+        path = Path(__file__).parent.parent / "images/testimages/testimage3_pixels.png"
+        image = LoadedImage(str(path))
+        
+        self.assertEqual(image.array.shape, (image.height, image.width, 3))
+        self.assertEqual(image.array.dtype.name, "uint8")
+        self.assertFalse(image.array.flags.writeable)
+    
+    def test_image_data_view(self):
+        """Test legacy [x][y] access on an array-backed image."""
+        import numpy as np
+        
+        array = np.zeros((2, 3, 3), dtype=np.uint8)
+        array[1, 2] = (10, 20, 30)
+        image = LoadedImage.fromArray(array)
+        
+        self.assertEqual((image.width, image.height), (3, 2))
+        self.assertEqual(image.imageData[2][1], (10, 20, 30))
+        self.assertEqual(len(image.imageData), 3)
+
+
 class TestRectangle(unittest.TestCase):
     """Test Rectangle class."""
     
@@ -75,11 +101,77 @@ class TestRectangleMatch(unittest.TestCase):
     
     def test_match_creation(self):
         """Test match creation."""
-        data = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
-        match = RectangleMatch(10, 20, data)
+        match = RectangleMatch(10, 20, 0.5)
         self.assertEqual(match.x, 10)
         self.assertEqual(match.y, 20)
-        self.assertEqual(len(match.data), 3)
+        self.assertEqual(match.score, 0.5)
+    
+    def test_match_window_is_view(self):
+        """Test that match pixels are resolved as views of the search array."""
+        import numpy as np
+        
+        search = np.arange(4 * 5 * 3, dtype=np.uint8).reshape(4, 5, 3)
+        window = RectangleMatch(1, 2, None).window(search, 3, 2)
+        
+        self.assertEqual(window.shape, (2, 3, 3))
+        self.assertTrue(np.shares_memory(window, search))
+
+
+class TestMatchSet(unittest.TestCase):
+    """Test MatchSet class."""
+    
+    def test_identical_content(self):
+        """Test that matches at different positions with equal pixels are one."""
+        import numpy as np
+        from depixlib.Rectangle import MatchSet
+        
+        search = np.zeros((4, 6, 3), dtype=np.uint8)
+        search[0, 5] = 7
+        
+        same = MatchSet([0, 2], [0, 1], [0.1, 0.2], 2, 2)
+        different = MatchSet([0, 4], [0, 0], None, 2, 2)
+        
+        self.assertTrue(same.allIdentical(search))
+        self.assertFalse(different.allIdentical(search))
+        self.assertEqual(same.windows(search).shape, (2, 2, 2, 3))
+        self.assertEqual([(m.x, m.y, m.score) for m in different], [(0, 0, None), (4, 0, None)])
+
+
+class TestBlockTable(unittest.TestCase):
+    """Test BlockTable class."""
+    
+    def setUp(self):
+        from depixlib.BlockTable import BlockTable
+        
+        self.table = BlockTable.fromRectangles([
+            ColorRectangle((255, 0, 0), (0, 0), (5, 5)),
+            ColorRectangle((0, 255, 0), (5, 0), (10, 5)),
+            ColorRectangle((0, 0, 255), (10, 0), (20, 10)),
+        ])
+    
+    def test_rows_are_color_rectangles(self):
+        """Test integer indexing and iteration yield ColorRectangle views."""
+        rect = self.table[2]
+        self.assertIsInstance(rect, ColorRectangle)
+        self.assertEqual((rect.color, rect.x, rect.width, rect.height), ((0, 0, 255), 10, 10, 10))
+        self.assertEqual([r.x for r in self.table], [0, 5, 10])
+    
+    def test_group_by_size(self):
+        """Test grouping blocks by size."""
+        groups = self.table.groupBySize()
+        self.assertEqual(sorted(groups), [(5, 5), (10, 10)])
+        self.assertEqual(list(groups[(5, 5)].x), [0, 5])
+    
+    def test_filter_and_lookup(self):
+        """Test colour filtering and lookup by coordinate."""
+        filtered = self.table.withoutColors([(0, 255, 0)])
+        self.assertEqual(len(filtered), 2)
+        self.assertEqual(list(filtered.lookup([10, 5, 0], [0, 0, 0])), [1, -1, 0])
+    
+    def test_neighbours(self):
+        """Test grid-indexed neighbour lookup."""
+        neighbours = self.table.neighbours()
+        self.assertEqual([list(n) for n in neighbours], [[1], [0, 2], [1]])
 
 
 class TestHelpers(unittest.TestCase):
@@ -92,6 +184,17 @@ class TestHelpers(unittest.TestCase):
         self.assertEqual(check_color("128, 128, 128"), (128, 128, 128))
         self.assertIsNone(check_color(None))
     
+    def test_check_non_negative_int(self):
+        """Test zero is accepted and negative integers are refused."""
+        from depixlib.helpers import check_non_negative_int
+        
+        self.assertEqual(check_non_negative_int("0"), 0)
+        self.assertEqual(check_non_negative_int("16"), 16)
+        with self.assertRaises(Exception):
+            check_non_negative_int("-1")
+        with self.assertRaises(Exception):
+            check_non_negative_int("many")
+    
     def test_check_color_invalid(self):
         """Test invalid color parsing."""
         with self.assertRaises(Exception):
@@ -177,6 +280,116 @@ class TestFunctions(unittest.TestCase):
         filtered = removeMootColorRectangles(rects, (40, 41, 35))
         self.assertEqual(len(filtered), 1)  # Only gray
     
+    def test_find_same_color_sub_rectangles(self):
+        """Test block detection, including runs merged across equal neighbours."""
+        import numpy as np
+        from depixlib.functions import findSameColorSubRectangles
+        
+        array = np.zeros((4, 6, 3), dtype=np.uint8)
+        array[0:2, 0:2] = (10, 10, 10)
+        array[0:2, 2:4] = (20, 20, 20)
+        array[0:2, 4:6] = (20, 20, 20)
+        array[2:4, 0:2] = (30, 30, 30)
+        array[2:4, 2:6] = (40, 40, 40)
+        image = LoadedImage.fromArray(array)
+        
+        rects = findSameColorSubRectangles(image, Rectangle((0, 0), (5, 3)))
+        
+        self.assertEqual(
+            [(r.color, r.x, r.y, r.width, r.height) for r in rects],
+            [
+                ((10, 10, 10), 0, 0, 2, 2),
+                ((30, 30, 30), 0, 2, 2, 2),
+                ((20, 20, 20), 2, 0, 4, 2),
+                ((40, 40, 40), 2, 2, 4, 2),
+            ]
+        )
+    
+    def test_write_matches_to_canvas(self):
+        """Test slice-copy and averaged writes into the output canvas."""
+        import numpy as np
+        from depixlib.functions import writeAverageMatchToImage, writeFirstMatchToImage
+        from depixlib.Rectangle import MatchSet
+        
+        search = np.zeros((4, 4, 3), dtype=np.uint8)
+        search[0:2, 0:2] = 100
+        search[2:4, 2:4] = 200
+        searchImage = LoadedImage.fromArray(search)
+        canvas = np.zeros((2, 4, 3), dtype=np.uint8)
+        
+        single = ColorRectangle((1, 1, 1), (0, 0), (2, 2))
+        multi = ColorRectangle((2, 2, 2), (2, 0), (4, 2))
+        matches = {
+            (0, 0): MatchSet.single(2, 2, 0.1, 2, 2),
+            (2, 0): MatchSet([0, 2], [0, 2], [0.0, 1.0], 2, 2),
+        }
+        
+        writeFirstMatchToImage([single], matches, searchImage, canvas)
+        writeAverageMatchToImage([multi], matches, searchImage, canvas)
+        self.assertTrue((canvas[:, 0:2] == 200).all())
+        self.assertTrue((canvas[:, 2:4] == 150).all())
+        
+        writeAverageMatchToImage([multi], matches, searchImage, canvas, weighted=True)
+        self.assertTrue((canvas[:, 2:4] == 100).all())
+    
+    def test_propagate_neighbour_matches(self):
+        """Test ambiguous blocks take the offset of resolved neighbours."""
+        from depixlib.BlockTable import BLOCK_SINGLE_MATCH, BlockTable
+        from depixlib.functions import propagateNeighbourMatches
+        from depixlib.Rectangle import MatchSet
+        
+        single = BlockTable.fromRectangles([ColorRectangle((1, 1, 1), (0, 0), (2, 2))])
+        multi = BlockTable.fromRectangles([
+            ColorRectangle((2, 2, 2), (2, 0), (4, 2)),
+            ColorRectangle((3, 3, 3), (4, 0), (6, 2)),
+            ColorRectangle((4, 4, 4), (20, 20), (22, 22)),
+        ])
+        matches = {
+            (0, 0): MatchSet.single(10, 5, 0.0, 2, 2),
+            (2, 0): MatchSet([30, 12], [1, 5], [0.1, 0.2], 2, 2),
+            (4, 0): MatchSet([14, 40], [5, 3], [0.3, 0.1], 2, 2),
+            (20, 20): MatchSet([0, 8], [0, 8], [0.1, 0.1], 2, 2),
+        }
+        
+        single, multi = propagateNeighbourMatches(single, multi, matches)
+        self.assertEqual(sorted(single.x.tolist()), [0, 2, 4])
+        self.assertEqual(multi.x.tolist(), [20])
+        self.assertTrue((single.flags & BLOCK_SINGLE_MATCH).all())
+        self.assertEqual((matches[(2, 0)][0].x, matches[(2, 0)][0].y), (12, 5))
+        self.assertEqual((matches[(4, 0)][0].x, matches[(4, 0)][0].y), (14, 5))
+        self.assertEqual(len(matches[(20, 20)]), 2)
+    
+    def test_detect_block_grid(self):
+        """Test the block grid is found through noise and a phase offset."""
+        import numpy as np
+        from depixlib.functions import detectBlockGrid, findGridSubRectangles
+        
+        rng = np.random.default_rng(1)
+        cells = rng.integers(0, 256, size=(9, 13, 3), dtype=np.uint8)
+        array = np.repeat(np.repeat(cells, 6, axis=0), 8, axis=1)[3:, 5:]
+        noise = rng.integers(-3, 4, size=array.shape)
+        array = np.clip(array.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        image = LoadedImage.fromArray(array)
+        rectangle = Rectangle((0, 0), (image.width - 1, image.height - 1))
+        
+        self.assertEqual(detectBlockGrid(image, rectangle), (8, 6, 3, 3))
+        blocks = findGridSubRectangles(image, rectangle)
+        full = (blocks.width == 8) & (blocks.height == 6)
+        self.assertEqual(int(full.sum()), 12 * 8)
+        # Cell means average the noise away
+        index = int(np.flatnonzero(full & (blocks.x == 3) & (blocks.y == 3))[0])
+        self.assertTrue(np.all(np.abs(blocks.colors[index].astype(int) - cells[1, 1]) <= 1))
+    
+    def test_detect_block_grid_rejects_photos(self):
+        """Test images without a block grid are not cut into one."""
+        import numpy as np
+        from depixlib.functions import detectBlockGrid
+        
+        rng = np.random.default_rng(2)
+        image = LoadedImage.fromArray(rng.integers(0, 256, size=(60, 80, 3), dtype=np.uint8))
+        rectangle = Rectangle((0, 0), (image.width - 1, image.height - 1))
+        self.assertIsNone(detectBlockGrid(image, rectangle))
+    
     def test_find_rectangle_size_occurrences(self):
         """Test rectangle size counting."""
         from depixlib.functions import findRectangleSizeOccurences
@@ -195,5 +408,1082 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(sizes[(5, 10)], 1)  # One 5x10 rectangle
 
 
+class TestSearchIndex(unittest.TestCase):
+    """Test average-colour search index."""
+    
+    def test_find_candidates(self):
+        """Test that windows with the block's average colour are found."""
+        import numpy as np
+        from depixlib.SearchIndex import SearchIndex
+        
+        search = np.full((20, 30, 3), 255, dtype=np.uint8)
+        search[5:10, 12:17] = (100, 50, 25)
+        
+        index = SearchIndex(search, "gammacorrected", tolerance=0.5)
+        xs, ys, distances = index.findCandidates((100, 50, 25), 5, 5)
+        
+        self.assertEqual(list(zip(xs, ys)), [(12, 5)])
+        self.assertAlmostEqual(float(distances[0]), 0.0, places=4)
+    
+    def test_window_means_linear(self):
+        """Test that linear window means are averaged in linear light."""
+        import numpy as np
+        from depixlib.SearchIndex import SearchIndex
+        
+        search = np.zeros((2, 2, 3), dtype=np.uint8)
+        search[0, :] = 255
+        
+        index = SearchIndex(search, "linear")
+        mean = index.windowMeans(2, 2)[0, 0, 0]
+        self.assertAlmostEqual(float(mean), 255 * 0.5 ** (1 / 2.2), places=2)
+
+
+    def test_text_bands(self):
+        """Test text lines are found and restrict every matcher."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.LoadedImage import LoadedImage
+        from depixlib.SearchIndex import SearchIndex
+        from depixlib.functions_numpy import findRectangleMatches
+        
+        search = np.full((30, 40, 3), 255, dtype=np.uint8)
+        search[4:9, 6:30] = (10, 10, 10)
+        search[16:22, 2:12] = (10, 10, 10)
+        
+        index = SearchIndex(search, "gammacorrected")
+        self.assertEqual(index.textBands.tolist(), [[4, 9, 6, 30], [16, 22, 2, 12]])
+        mask = index.bandMask(4, 3)
+        self.assertTrue(mask[2, 3] and mask[8, 5] and mask[20, 0])
+        self.assertFalse(mask[0, 0] or mask[12, 5] or mask[18, 20])
+        
+        # A background block matches the first window, which is off every band
+        pixelated = LoadedImage.fromArray(np.full((3, 4, 3), 255, dtype=np.uint8))
+        table = BlockTable.fromArrays(
+            np.array([0]), np.array([0]), 4, 3, pixelated.array[[0], [0]]
+        )
+        for matcher in ("template", "sqdiff", "integer", "distinct", "index"):
+            for textBands in (False, True):
+                match = findRectangleMatches(
+                    {(4, 3): 1}, table, LoadedImage.fromArray(search), pixelated,
+                    "gammacorrected", matcher=matcher, tolerance=255, topK=2,
+                    searchIndex=SearchIndex(search, "gammacorrected", tolerance=255),
+                    textBands=textBands
+                )[(0, 0)]
+                self.assertTrue(len(match) > 0)
+                inBands = mask[match.ys, match.xs].all()
+                self.assertEqual(inBands, textBands, matcher)
+    
+    def test_line_phase(self):
+        """Test rows after the phase vote only match windows at their line phase."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.LoadedImage import LoadedImage
+        from depixlib.SearchIndex import SearchIndex
+        from depixlib.functions_numpy import findRectangleMatches
+        from depixlib.metrics import Metrics
+        
+        # Three identical lines of 4x3 tiles, 10 rows apart
+        rng = np.random.default_rng(6)
+        tiles = rng.permutation(200)[:12].reshape(2, 6, 1).repeat(3, axis=2).astype(np.uint8)
+        search = np.full((33, 30, 3), 255, dtype=np.uint8)
+        for top in (3, 13, 23):
+            search[top:top + 6, :24] = tiles.repeat(3, 0).repeat(4, 1)
+        # A copy of one second-row tile one row below the first line's top
+        search[4:7, 26:30] = tiles[1, 2]
+        
+        index = SearchIndex(search, "gammacorrected", tolerance=0)
+        self.assertEqual(index.lineHeight, 10)
+        self.assertEqual(index.linePhase(np.array([3, 5, 12, 13, 0])).tolist(), [0, 2, 9, 0, 7])
+        rows = np.flatnonzero(index.phaseMask(4, 3, 3).any(axis=1))
+        self.assertEqual(rows.tolist(), [6, 16, 26])
+        
+        # Two rows of blocks cut from the tiles; the second row is 3 rows
+        # into its line, where the copy is not
+        pixelated = LoadedImage.fromArray(tiles[:, 1:4].repeat(3, 0).repeat(4, 1))
+        xs, ys = np.meshgrid([0, 4, 8], [0, 3])
+        table = BlockTable.fromArrays(
+            xs.ravel(), ys.ravel(), 4, 3, pixelated.array[ys.ravel(), xs.ravel()]
+        )
+        for matcher in ("template", "sqdiff", "integer", "distinct", "index"):
+            metrics = Metrics()
+            matches = findRectangleMatches(
+                {(4, 3): 6}, table, LoadedImage.fromArray(search), pixelated,
+                "gammacorrected", matcher=matcher, searchIndex=index,
+                textBands=True, metrics=metrics
+            )
+            self.assertEqual(metrics.counters["phaseVotes"], 3, matcher)
+            for (x, y), match in matches.items():
+                self.assertTrue(len(match) > 0, matcher)
+                self.assertEqual(set(index.linePhase(match.ys).tolist()), {y}, matcher)
+                self.assertEqual(match.xs[0], x + 4, matcher)
+    
+    
+class TestClosedFormMatching(unittest.TestCase):
+    """Test closed-form TM_SQDIFF_NORMED for constant templates."""
+    
+    def test_matches_opencv(self):
+        """Test score map against cv2.matchTemplate."""
+        import cv2
+        import numpy as np
+        from depixlib.SearchIndex import SearchIndex, toWorkingSpace
+        from depixlib.functions_numpy import constantTemplateSqdiffNormed
+        
+        rng = np.random.default_rng(0)
+        search = rng.integers(1, 256, size=(30, 40, 3), dtype=np.uint8)
+        color = np.array([120, 60, 200], dtype=np.uint8)
+        template = np.tile(color, (4, 3, 1))
+        
+        expected = cv2.matchTemplate(
+            toWorkingSpace(search, "linear"),
+            toWorkingSpace(template, "linear"),
+            cv2.TM_SQDIFF_NORMED
+        )
+        
+        index = SearchIndex(search, "linear")
+        scores = constantTemplateSqdiffNormed(
+            index.windowSums(3, 4),
+            index.windowSquaredSums(3, 4),
+            toWorkingSpace(color[None], "linear"),
+            12
+        )[0]
+        
+        self.assertEqual(scores.shape, expected.shape)
+        np.testing.assert_allclose(scores, expected, atol=1e-5)
+        self.assertEqual(scores.argmin(), expected.argmin())
+    
+    def test_integer_scores_exact(self):
+        """Test integer score maps against float64 and wrapped accumulators."""
+        import numpy as np
+        from depixlib.colorspace import integerLevels
+        from depixlib.SearchIndex import SearchIndex
+        from unittest.mock import patch
+        from depixlib.functions_numpy import integerSqdiffNormed
+        
+        rng = np.random.default_rng(1)
+        # Large enough that the uint16 and uint32 band integrals wrap around
+        search = rng.integers(200, 256, size=(160, 170, 3), dtype=np.uint8)
+        search[100:104, 50:53] = 7
+        color = np.array([7, 7, 7], dtype=np.uint8)
+        index = SearchIndex(search, "gammacorrected")
+        self.assertEqual(index.windowIntegerSums(3, 4).dtype, np.uint16)
+        self.assertEqual(index.windowIntegerSquaredSums(3, 4).dtype, np.uint32)
+        
+        scores = integerSqdiffNormed(
+            index.windowIntegerSums(3, 4),
+            index.windowIntegerSquaredSums(3, 4),
+            integerLevels("gammacorrected")[color],
+            12
+        )
+        # Summing in bands of rows gives the same sums as in one pass
+        with patch("depixlib.SearchIndex.INTEGER_BAND_ROWS", 7):
+            banded = SearchIndex(search, "gammacorrected")
+            np.testing.assert_array_equal(
+                banded.windowIntegerSums(3, 4), index.windowIntegerSums(3, 4)
+            )
+            np.testing.assert_array_equal(
+                banded.windowIntegerSquaredSums(3, 4), index.windowIntegerSquaredSums(3, 4)
+            )
+        windows = np.lib.stride_tricks.sliding_window_view(
+            search.astype(np.float64), (4, 3), axis=(0, 1)
+        )
+        difference = np.square(windows - 7.0).sum(axis=(2, 3, 4))
+        energy = np.square(windows).sum(axis=(2, 3, 4))
+        expected = np.minimum(difference / np.sqrt(energy * 12 * 3 * 49.0), 1.0)
+        np.testing.assert_allclose(scores, expected, rtol=1e-12)
+        self.assertEqual(np.unravel_index(scores.argmin(), scores.shape), (100, 50))
+        self.assertEqual(scores.min(), 0.0)
+    
+    def test_integer_matcher_matches_sqdiff(self):
+        """Test the integer matcher picks the sqdiff matcher's windows."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.LoadedImage import LoadedImage
+        from depixlib.functions_numpy import findRectangleMatches
+        
+        rng = np.random.default_rng(2)
+        search = LoadedImage.fromArray(
+            rng.integers(0, 256, size=(40, 50, 3), dtype=np.uint8)
+        )
+        pixelated = LoadedImage.fromArray(
+            np.repeat(np.repeat(
+                rng.integers(0, 256, size=(4, 5, 3), dtype=np.uint8), 3, axis=0
+            ), 4, axis=1)
+        )
+        ys, xs = np.mgrid[0:12:3, 0:20:4]
+        table = BlockTable.fromArrays(
+            xs.ravel(), ys.ravel(), 4, 3,
+            pixelated.array[ys.ravel(), xs.ravel()]
+        )
+        for averageType in ("gammacorrected", "linear", "srgb"):
+            expected = findRectangleMatches(
+                {(4, 3): len(table)}, table, search, pixelated, averageType,
+                matcher="sqdiff"
+            )
+            matches = findRectangleMatches(
+                {(4, 3): len(table)}, table, search, pixelated, averageType,
+                matcher="integer"
+            )
+            self.assertEqual(matches.keys(), expected.keys())
+            for key, match in matches.items():
+                self.assertEqual(
+                    (match.xs.tolist(), match.ys.tolist()),
+                    (expected[key].xs.tolist(), expected[key].ys.tolist())
+                )
+                np.testing.assert_allclose(match.scores, expected[key].scores, rtol=1e-4)
+    
+    def test_integer_matcher_memory(self):
+        """Test the integer matcher keeps only narrow per-size window sums."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.SearchIndex import SearchIndex
+        from depixlib.functions_numpy import findRectangleMatches
+        
+        rng = np.random.default_rng(4)
+        searchArray = rng.integers(0, 256, size=(120, 90, 3), dtype=np.uint8)
+        search = LoadedImage.fromArray(searchArray)
+        pixelated = LoadedImage.fromArray(
+            rng.integers(0, 256, size=(2, 2, 3), dtype=np.uint8).repeat(5, 0).repeat(5, 1)
+        )
+        table = BlockTable.fromArrays(
+            np.array([0, 5]), np.array([0, 5]), 5, 5, pixelated.array[[0, 5], [0, 5]]
+        )
+        windows = 116 * 86
+        # Bytes per window: uint16 sums and uint32 squared sums for
+        # gammacorrected, uint32 and uint64 for linear; float64 for sqdiff
+        for averageType, matcher, perWindow in (
+            ("gammacorrected", "integer", 10),
+            ("linear", "integer", 20),
+            ("gammacorrected", "sqdiff", 32),
+        ):
+            index = SearchIndex(searchArray, averageType)
+            findRectangleMatches(
+                {(5, 5): 2}, table, search, pixelated, averageType,
+                matcher=matcher, searchIndex=index, matchMemo=False
+            )
+            if matcher == "integer":
+                # Only the per-size sums; no whole-image integrals are kept
+                self.assertEqual(index.nbytes, perWindow * windows)
+                if averageType == "gammacorrected":
+                    self.assertLess(index.nbytes, searchArray.size * 4)
+            else:
+                # Per-size sums on top of the float32 copy and float64 integrals
+                self.assertGreater(index.nbytes, perWindow * windows + searchArray.size * 4)
+    
+    def test_noisy_grid_blocks_match_by_cell_mean(self):
+        """Test constant-colour matchers score noisy grid blocks by their mean."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.functions import findGridBlocks
+        from depixlib.functions_numpy import findRectangleMatches
+        
+        # 4x3 tiles whose colours are 8 levels apart, so the mean of a noisy
+        # block finds its tile where a single pixel often does not; magenta
+        # borders keep windows off the tile edges
+        levels = 40 + 8 * np.arange(6)
+        tiles = np.stack(np.meshgrid(levels, levels, indexing="ij"), axis=2)
+        tiles = np.concatenate([tiles, np.full((6, 6, 1), 100)], axis=2).astype(np.uint8)
+        cells = np.empty((6, 6, 5, 6, 3), dtype=np.uint8)
+        cells[:] = (255, 0, 255)
+        cells[:, :, 1:4, 1:5] = tiles[:, :, None, None]
+        search = LoadedImage.fromArray(cells.transpose(0, 2, 1, 3, 4).reshape(30, 36, 3))
+        
+        rng = np.random.default_rng(12)
+        picks = rng.integers(0, 6, size=(5, 6, 2))
+        clean = tiles[picks[..., 0], picks[..., 1]].repeat(3, 0).repeat(4, 1)
+        noise = rng.integers(-6, 7, size=clean.shape)
+        pixelated = LoadedImage.fromArray((clean + noise).astype(np.uint8))
+        region = Rectangle((0, 0), (pixelated.width - 1, pixelated.height - 1))
+        table = BlockTable.fromArrays(*findGridBlocks(pixelated, region, (4, 3, 0, 0)))
+        
+        expected = findRectangleMatches(
+            {(4, 3): len(table)}, table, search, pixelated, "gammacorrected",
+            matcher="template", matchMemo=False
+        )
+        self.assertEqual(len(expected), 30)
+        for matcher in ("sqdiff", "integer", "distinct"):
+            matches = findRectangleMatches(
+                {(4, 3): len(table)}, table, search, pixelated, "gammacorrected",
+                matcher=matcher
+            )
+            for key, match in expected.items():
+                self.assertEqual(
+                    (matches[key].xs.tolist(), matches[key].ys.tolist()),
+                    (match.xs.tolist(), match.ys.tolist()),
+                    f"{matcher} at {key}"
+                )
+    
+    def test_distinct_matcher_matches_integer(self):
+        """Test the distinct matcher picks the integer matcher's windows."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.LoadedImage import LoadedImage
+        from depixlib.SearchIndex import SearchIndex
+        from depixlib.functions_numpy import findRectangleMatches
+        from depixlib.metrics import Metrics
+        
+        # A tiled search image, so most windows repeat an earlier one
+        rng = np.random.default_rng(3)
+        search = LoadedImage.fromArray(
+            np.tile(rng.integers(0, 4, size=(7, 9, 3), dtype=np.uint8) * 60, (6, 5, 1))
+        )
+        index = SearchIndex(search.array, "gammacorrected")
+        first, windowGroups = index.distinctWindows(4, 3)
+        self.assertLessEqual(len(first), 7 * 9)
+        self.assertEqual(first.tolist(), sorted(first.tolist()))
+        np.testing.assert_array_equal(
+            index.windowIntegerSums(4, 3).reshape(-1, 3)[first][windowGroups],
+            index.windowIntegerSums(4, 3).reshape(-1, 3)
+        )
+        
+        pixelated = LoadedImage.fromArray(
+            np.repeat(np.repeat(
+                rng.integers(0, 256, size=(4, 5, 3), dtype=np.uint8), 3, axis=0
+            ), 4, axis=1)
+        )
+        ys, xs = np.mgrid[0:12:3, 0:20:4]
+        table = BlockTable.fromArrays(
+            xs.ravel(), ys.ravel(), 4, 3,
+            pixelated.array[ys.ravel(), xs.ravel()]
+        )
+        for topK in (1, 3):
+            expected = findRectangleMatches(
+                {(4, 3): len(table)}, table, search, pixelated, "gammacorrected",
+                matcher="integer", topK=topK
+            )
+            for budget, fallbacks in ((len(first), 0), (len(first) - 1, 1)):
+                metrics = Metrics()
+                matches = findRectangleMatches(
+                    {(4, 3): len(table)}, table, search, pixelated, "gammacorrected",
+                    matcher="distinct", topK=topK, searchIndex=index,
+                    metrics=metrics, distinctBudget=budget, matchMemo=False
+                )
+                self.assertEqual(metrics.counters.get("distinctFallbacks", 0), fallbacks)
+                self.assertEqual(
+                    metrics.counters.get("distinctWindows", 0), 0 if fallbacks else budget
+                )
+                for key, match in matches.items():
+                    self.assertEqual(match.scores.tolist(), expected[key].scores.tolist())
+                    if topK == 1:
+                        self.assertEqual(
+                            (match.xs.tolist(), match.ys.tolist()),
+                            (expected[key].xs.tolist(), expected[key].ys.tolist())
+                        )
+    
+    def test_select_top_candidates(self):
+        """Test top-k selection suppresses overlapping windows."""
+        import numpy as np
+        from depixlib.functions_numpy import selectTopCandidates
+        
+        scores = np.ones((10, 12), dtype=np.float32)
+        scores[2, 3] = 0.0
+        scores[2, 4] = 0.1   # overlaps the best window
+        scores[7, 9] = 0.2
+        scores[0, 0] = 0.5
+        
+        xs, ys, values = selectTopCandidates(scores, 3, None, 2, 2)
+        self.assertEqual(list(zip(xs.tolist(), ys.tolist())), [(3, 2), (9, 7), (0, 0)])
+        np.testing.assert_allclose(values, [0.0, 0.2, 0.5])
+        
+        xs, ys, values = selectTopCandidates(scores, 3, 0.3, 2, 2)
+        self.assertEqual(list(zip(xs.tolist(), ys.tolist())), [(3, 2), (9, 7)])
+    
+    def test_select_top_candidates_ties(self):
+        """Test windows tied at the pool cutoff are ordered by position."""
+        import numpy as np
+        from depixlib.functions_numpy import selectTopCandidates
+        
+        scores = np.array([
+            [2, 2, 2, 2, 2, 0, 0, 2, 0, 2, 2, 2, 1, 0, 1],
+            [2, 1, 2, 1, 2, 0, 1, 0, 0, 2, 2, 0, 2, 2, 0],
+        ], dtype=np.float32)
+        for topK in (1, 2):
+            xs, ys, _ = selectTopCandidates(scores, topK, None, 1, 1)
+            self.assertEqual(list(zip(xs.tolist(), ys.tolist())), [(5, 0), (6, 0)][:topK])
+
+
+class TestIndexCache(unittest.TestCase):
+    """Test persistent search index cache."""
+    
+    def test_warm_index_matches_cold(self):
+        """Test that a cached index returns the same arrays memory-mapped."""
+        import tempfile
+        import numpy as np
+        from depixlib.IndexCache import IndexCache
+        from depixlib.SearchIndex import SearchIndex
+        
+        search = np.random.default_rng(1).integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            cold = SearchIndex(search, "linear", cache=IndexCache(directory), imageHash="abc")
+            expected = np.array(cold.windowSums(3, 2))
+            
+            warm = SearchIndex(search, "linear", cache=IndexCache(directory), imageHash="abc")
+            sums = warm.windowSums(3, 2)
+            
+            self.assertIsInstance(sums, np.memmap)
+            np.testing.assert_array_equal(sums, expected)
+            self.assertEqual(warm.cache.hits, 1)
+            self.assertIsNone(warm._integral)
+    
+    def test_decoded_image_cache(self):
+        """Test decoded images are memory-mapped and refreshed when the file changes."""
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.IndexCache import IndexCache
+        
+        rng = np.random.default_rng(8)
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / "search.png")
+            first = rng.integers(0, 256, (8, 9, 3), dtype=np.uint8)
+            Image.fromarray(first).save(path)
+            cache = IndexCache(str(Path(directory) / "cache"))
+            
+            LoadedImage(path, cache)
+            warm = LoadedImage(path, cache)
+            self.assertIsInstance(warm.array, np.memmap)
+            np.testing.assert_array_equal(warm.array, first)
+            self.assertEqual(cache.hits, 2)
+            
+            second = rng.integers(0, 256, (8, 9, 3), dtype=np.uint8)
+            Image.fromarray(second).save(path)
+            np.testing.assert_array_equal(LoadedImage(path, cache).array, second)
+    
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted first."""
+        import os
+        import tempfile
+        import numpy as np
+        from depixlib.IndexCache import IndexCache
+        
+        array = np.zeros(1000, dtype=np.float64)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = IndexCache(directory, maxBytes=2500 * 8)
+            cache.store("a", "sums", array)
+            cache.store("b", "sums", array)
+            os.utime(os.path.join(directory, "a"), (1, 1))
+            os.utime(os.path.join(directory, "b"), (2, 2))
+            cache.store("c", "sums", array)
+            
+            self.assertIsNone(cache.load("a", "sums"))
+            self.assertIsNotNone(cache.load("b", "sums"))
+            self.assertIsNotNone(cache.load("c", "sums"))
+    
+    def test_concurrent_stores(self):
+        """Test threads storing one array each leave a whole array behind."""
+        import os
+        import tempfile
+        import threading
+        import numpy as np
+        from depixlib.IndexCache import IndexCache
+        
+        with tempfile.TemporaryDirectory() as directory:
+            cache = IndexCache(directory)
+            arrays = [np.full((100 * (i + 1), 4), i, dtype=np.float64) for i in range(8)]
+            threads = [
+                threading.Thread(target=cache.store, args=("a", "memo", array))
+                for array in arrays
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            
+            stored = np.asarray(cache.load("a", "memo"))
+            self.assertTrue(any(np.array_equal(stored, array) for array in arrays))
+            self.assertEqual(os.listdir(os.path.join(directory, "a")), ["memo.npy"])
+    
+    def test_match_memo(self):
+        """Test blocks of one size and colour are searched once, across runs."""
+        import tempfile
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.IndexCache import IndexCache
+        from depixlib.SearchIndex import SearchIndex
+        from depixlib.functions_numpy import findRectangleMatches
+        from depixlib.metrics import Metrics
+        
+        rng = np.random.default_rng(9)
+        search = LoadedImage.fromArray(rng.integers(0, 256, (20, 24, 3), dtype=np.uint8))
+        # Six 3x2 blocks in two colours
+        colors = np.array([[10, 200, 30], [90, 40, 160]], dtype=np.uint8)[[0, 1, 0, 0, 1, 0]]
+        pixelated = LoadedImage.fromArray(colors[None].repeat(2, 0).repeat(3, 1))
+        xs = np.arange(0, 18, 3)
+        table = BlockTable.fromArrays(xs, np.zeros(6, dtype=np.int64), 3, 2, colors)
+        
+        def match(index, **options):
+            metrics = Metrics()
+            matches = findRectangleMatches(
+                {(3, 2): 6}, table, search, pixelated, "gammacorrected",
+                searchIndex=index, metrics=metrics, **options
+            )
+            return matches, metrics.counters
+        
+        with tempfile.TemporaryDirectory() as directory:
+            def newIndex():
+                return SearchIndex(
+                    search.array, "gammacorrected", cache=IndexCache(directory), imageHash="abc"
+                )
+            
+            index = newIndex()
+            expected, _ = match(index, matchMemo=False)
+            matches, counters = match(index)
+            self.assertEqual((counters["matchMemoHits"], counters["matchMemoMisses"]), (4, 2))
+            self.assertEqual(counters["matcherCalls"], 2)
+            self.assertIs(matches[(0, 0)], matches[(9, 0)])
+            for key, match_set in expected.items():
+                self.assertEqual(matches[key].xs.tolist(), match_set.xs.tolist())
+                self.assertEqual(matches[key].scores.tolist(), match_set.scores.tolist())
+            
+            _, counters = match(index)
+            self.assertEqual((counters["matchMemoHits"], counters["matchMemoMisses"]), (6, 0))
+            
+            # A new run loads the memo, including sets with no candidates
+            warm = newIndex()
+            matches, counters = match(warm)
+            self.assertEqual(counters["matchMemoHits"], 6)
+            self.assertEqual(matches[(3, 0)].ys.tolist(), expected[(3, 0)].ys.tolist())
+            match(index, scoreThreshold=-1.0)
+            warm = newIndex()
+            matches, counters = match(warm, scoreThreshold=-1.0)
+            self.assertEqual(counters["matchMemoHits"], 6)
+            self.assertEqual([len(m) for m in matches.values()], [0] * 6)
+
+
+class TestParallelMatching(unittest.TestCase):
+    """Test process-pool template matching."""
+    
+    def test_workers_match_serial(self):
+        """Test that parallel matching gives the same matches as serial."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.functions_numpy import findRectangleMatches
+        
+        rng = np.random.default_rng(2)
+        search = LoadedImage.fromArray(rng.integers(0, 256, (40, 60, 3), dtype=np.uint8))
+        pixelated = LoadedImage.fromArray(
+            rng.integers(0, 256, (4, 6, 3), dtype=np.uint8).repeat(2, 0).repeat(2, 1)
+        )
+        xs, ys = np.meshgrid(np.arange(0, 12, 2), np.arange(0, 8, 2))
+        blocks = BlockTable.fromArrays(
+            xs.ravel(), ys.ravel(), np.full(24, 2), np.full(24, 2),
+            pixelated.array[ys.ravel(), xs.ravel()]
+        )
+        sizes = blocks.sizeCounts()
+        
+        serial = findRectangleMatches(sizes, blocks, search, pixelated, "gammacorrected")
+        parallel = findRectangleMatches(
+            sizes, blocks, search, pixelated, "gammacorrected", workers=2
+        )
+        
+        self.assertEqual(list(serial), list(parallel))
+        self.assertEqual(
+            [(m[0].x, m[0].y) for m in serial.values()],
+            [(m[0].x, m[0].y) for m in parallel.values()]
+        )
+    
+    def test_workers_match_serial_in_text_bands(self):
+        """Test that parallel matching restricted to text bands matches serial."""
+        import numpy as np
+        from depixlib.BlockTable import BlockTable
+        from depixlib.functions_numpy import findRectangleMatches
+        
+        rng = np.random.default_rng(3)
+        searchArray = np.full((40, 60, 3), 255, dtype=np.uint8)
+        searchArray[5:12, 4:50] = rng.integers(0, 128, (7, 46, 3), dtype=np.uint8)
+        searchArray[22:30, 8:40] = rng.integers(0, 128, (8, 32, 3), dtype=np.uint8)
+        search = LoadedImage.fromArray(searchArray)
+        pixelated = LoadedImage.fromArray(
+            rng.integers(0, 128, (4, 6, 3), dtype=np.uint8).repeat(2, 0).repeat(2, 1)
+        )
+        xs, ys = np.meshgrid(np.arange(0, 12, 2), np.arange(0, 8, 2))
+        blocks = BlockTable.fromArrays(
+            xs.ravel(), ys.ravel(), np.full(24, 2), np.full(24, 2),
+            pixelated.array[ys.ravel(), xs.ravel()]
+        )
+        sizes = blocks.sizeCounts()
+        
+        serial = findRectangleMatches(
+            sizes, blocks, search, pixelated, "gammacorrected",
+            textBands=True, matchMemo=False
+        )
+        parallel = findRectangleMatches(
+            sizes, blocks, search, pixelated, "gammacorrected",
+            workers=2, textBands=True, matchMemo=False
+        )
+        
+        self.assertEqual(list(serial), list(parallel))
+        self.assertEqual(
+            [(m[0].x, m[0].y) for m in serial.values()],
+            [(m[0].x, m[0].y) for m in parallel.values()]
+        )
+
+
+class TestTiling(unittest.TestCase):
+    """Test tiled processing with streamed PNG output."""
+    
+    def test_png_stream_writer(self):
+        """Test a PNG written in bands decodes to the same pixels."""
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.tiling import PngStreamWriter
+        
+        image = np.random.default_rng(5).integers(0, 256, (37, 23, 3), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / "out.png")
+            with PngStreamWriter(path, 23, 37, chunkBytes=100) as writer:
+                for start in range(0, 37, 10):
+                    writer.writeRows(image[start:start + 10])
+            np.testing.assert_array_equal(np.asarray(Image.open(path)), image)
+    
+    def test_tile_boundaries_follow_block_rows(self):
+        """Test tiles are cut between rows of blocks."""
+        import numpy as np
+        from depixlib.tiling import tileBoundaries
+        
+        blocks = np.random.default_rng(6).integers(0, 256, (10, 6, 3), dtype=np.uint8)
+        image = blocks.repeat(4, 0).repeat(4, 1)
+        tiles = tileBoundaries(image, 10)
+        
+        self.assertEqual(tiles[0][0], 0)
+        self.assertEqual(tiles[-1][1], 40)
+        for (_, end), (start, _) in zip(tiles, tiles[1:]):
+            self.assertEqual(end, start)
+        for start, end in tiles:
+            self.assertLessEqual(end - start, 10)
+            self.assertEqual(start % 4, 0)
+    
+    def test_tiled_matches_whole_image(self):
+        """Test tiled output equals whole-image output when cuts fall between blocks."""
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.pipeline import depixelize
+        from depixlib.tiling import depixelizeTiled
+        
+        rng = np.random.default_rng(7)
+        search = LoadedImage.fromArray(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8))
+        pixelated = LoadedImage.fromArray(
+            rng.integers(0, 256, (6, 5, 3), dtype=np.uint8).repeat(3, 0).repeat(3, 1)
+        )
+        expected, _ = depixelize(pixelated, search, matcher="sqdiff")
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / "out.png")
+            stats = depixelizeTiled(pixelated, search, path, 0, tileRows=7, matcher="sqdiff")
+            self.assertGreater(stats["tiles"], 1)
+            np.testing.assert_array_equal(np.asarray(Image.open(path)), expected)
+            
+            # A memory-mapped input is tiled without being read whole
+            from depixlib.IndexCache import IndexCache
+            Image.fromarray(pixelated.array).save(Path(directory) / "pixelated.png")
+            mapped = LoadedImage(
+                str(Path(directory) / "pixelated.png"), IndexCache(str(Path(directory) / "cache"))
+            )
+            self.assertIsInstance(mapped.array, np.memmap)
+            depixelizeTiled(mapped, search, path, 0, tileRows=7, matcher="sqdiff")
+            np.testing.assert_array_equal(np.asarray(Image.open(path)), expected)
+
+
+class TestBatch(unittest.TestCase):
+    """Test batch processing against a warm search image."""
+    
+    def test_manifest_batch(self):
+        """Test manifest options, warm search images and the result log."""
+        import json
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.batch import SearchImagePool, collectJobs, runBatch
+        
+        rng = np.random.default_rng(3)
+        with tempfile.TemporaryDirectory() as directory:
+            root = Path(directory)
+            Image.fromarray(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)).save(root / "search.png")
+            pixels = rng.integers(0, 256, (3, 4, 3), dtype=np.uint8).repeat(3, 0).repeat(3, 1)
+            Image.fromarray(pixels).save(root / "a.png")
+            Image.fromarray(pixels).save(root / "b.png")
+            (root / "jobs.jsonl").write_text(
+                '{"pixelimage": "a.png", "searchimage": "search.png"}\n'
+                '{"pixelimage": "b.png", "searchimage": "search.png", "matcher": "index", "tolerance": 255}\n'
+                '{"pixelimage": "missing.png", "searchimage": "search.png"}\n'
+            )
+            defaults = {
+                "searchimage": None, "outputimage": None, "averagetype": "gammacorrected",
+                "backgroundcolor": None, "matcher": "sqdiff", "tolerance": 1.0, "topk": 1,
+                "scorethreshold": None, "noneighbourpass": False, "weightedaverage": False,
+                "grid": False, "textbands": False, "nomatchmemo": False,
+            }
+            jobs = list(collectJobs(str(root / "jobs.jsonl"), defaults, str(root / "out")))
+            self.assertEqual([job["matcher"] for job in jobs], ["sqdiff", "index", "sqdiff"])
+            self.assertEqual(jobs[1]["tolerance"], 255.0)
+            self.assertEqual(jobs[0]["outputimage"], str(root / "out" / "a.png"))
+            
+            pool = SearchImagePool()
+            succeeded, failed = runBatch(jobs, pool, str(root / "log.jsonl"), concurrency=2)
+            
+            self.assertEqual((succeeded, failed), (2, 1))
+            self.assertEqual(len(pool._images), 1)
+            self.assertTrue((root / "out" / "b.png").exists())
+            records = [json.loads(line) for line in (root / "log.jsonl").read_text().splitlines()]
+            self.assertEqual(sorted(r["status"] for r in records), ["error", "ok", "ok"])
+
+    
+    def test_pool_eviction(self):
+        """Test least recently used search indexes are evicted over the cap."""
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.batch import SearchImagePool
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / "search.png")
+            Image.fromarray(np.zeros((20, 20, 3), dtype=np.uint8)).save(path)
+            pool = SearchImagePool(maxBytes=1)
+            
+            _, linear = pool.get(path, "linear", 1.0)
+            linear.windowSums(2, 2)
+            pool.get(path, "gammacorrected", 1.0)
+            self.assertEqual(pool.trim(), 1)
+            self.assertEqual(len(pool), 1)
+            self.assertIsNot(pool.get(path, "linear", 1.0)[1], linear)
+
+
+class TestService(unittest.TestCase):
+    """Test the depixelization service request handling."""
+    
+    def test_depixelize_request(self):
+        """Test a request returns a PNG and statistics, and bad input is refused."""
+        import asyncio
+        import io
+        import json
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.batch import SearchImagePool
+        from depixlib.service import DepixService
+        
+        rng = np.random.default_rng(4)
+        with tempfile.TemporaryDirectory() as directory:
+            searchPath = str(Path(directory) / "search.png")
+            Image.fromarray(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)).save(searchPath)
+            upload = io.BytesIO()
+            Image.fromarray(
+                rng.integers(0, 256, (3, 4, 3), dtype=np.uint8).repeat(3, 0).repeat(3, 1)
+            ).save(upload, format="PNG")
+            
+            defaults = {
+                "searchimage": searchPath, "averagetype": "gammacorrected",
+                "backgroundcolor": None, "matcher": "sqdiff", "tolerance": 1.0, "topk": 1,
+                "scorethreshold": None, "noneighbourpass": False, "weightedaverage": False,
+                "grid": False, "textbands": False, "nomatchmemo": False,
+            }
+            service = DepixService(SearchImagePool(), defaults)
+            try:
+                status, headers, body = asyncio.run(
+                    service.handle("POST", "/depixelize?topk=2", upload.getvalue())
+                )
+                self.assertEqual(status, 200)
+                self.assertEqual(Image.open(io.BytesIO(body)).size, (12, 9))
+                self.assertEqual(json.loads(headers["X-Depix-Stats"])["blocks"], 12)
+                
+                status, _, _ = asyncio.run(service.handle("POST", "/depixelize?bogus=1", b""))
+                self.assertEqual(status, 400)
+                status, _, _ = asyncio.run(service.handle("POST", "/depixelize", b"not an image"))
+                self.assertEqual(status, 500)
+                self.assertEqual((service.served, service.failed), (1, 1))
+            finally:
+                service.close()
+    
+    def test_search_images_and_full_queue(self):
+        """Test only configured search images are opened and a full queue skips the body."""
+        import asyncio
+        import tempfile
+        from depixlib.batch import SearchImagePool
+        from depixlib.service import DepixService
+        
+        with tempfile.TemporaryDirectory() as directory:
+            served = Path(directory) / "served"
+            served.mkdir()
+            (served / "search.png").write_bytes(b"")
+            (Path(directory) / "secret.png").write_bytes(b"")
+            defaults = {"searchimage": None, "matcher": "sqdiff", "averagetype": "gammacorrected"}
+            service = DepixService(
+                SearchImagePool(), defaults, maxQueue=0, searchDirectory=str(served)
+            )
+            try:
+                job = service._jobOptions([("searchimage", "search.png")])
+                self.assertEqual(job["searchimage"], str((served / "search.png").resolve()))
+                for name in ("../secret.png", str(Path(directory) / "secret.png"), "/etc/passwd"):
+                    status, _, _ = asyncio.run(
+                        service.handle("POST", f"/depixelize?searchimage={name}", b"")
+                    )
+                    self.assertEqual(status, 403)
+                
+                async def request():
+                    reader = asyncio.StreamReader()
+                    # The body never arrives, so reading it would wait forever
+                    reader.feed_data(
+                        b"POST /depixelize HTTP/1.1\r\nContent-Length: 1000\r\n\r\n"
+                    )
+                    service.active = service.workers
+                    return await asyncio.wait_for(service._readAndHandle(reader), 5)
+                
+                keepAlive, (status, headers, _) = asyncio.run(request())
+                self.assertEqual((keepAlive, status, headers["Retry-After"]), (False, 503, "1"))
+                self.assertEqual(service.rejected, 1)
+                
+                async def negativeLength():
+                    reader = asyncio.StreamReader()
+                    reader.feed_data(b"GET /health HTTP/1.1\r\nContent-Length: -5\r\n\r\n")
+                    return await asyncio.wait_for(service._readAndHandle(reader), 5)
+                
+                keepAlive, (status, _, _) = asyncio.run(negativeLength())
+                self.assertEqual((keepAlive, status), (False, 400))
+            finally:
+                service.active = 0
+                service.close()
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test the benchmark harness."""
+    
+    def test_run_case_against_original(self):
+        """Test a case is timed per stage and scored against its original."""
+        import tempfile
+        import numpy as np
+        from PIL import Image
+        from depixlib.benchmark import collectCases, runCase
+        
+        rng = np.random.default_rng(5)
+        original = rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)
+        crop = original[2:17, 3:23].astype(np.float64)
+        pixelated = crop.reshape(3, 5, 4, 5, 3).mean(axis=(1, 3)).round().astype(np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            root = Path(directory)
+            (root / "tests").mkdir()
+            (root / "search").mkdir()
+            Image.fromarray(original).save(root / "tests" / "text.png")
+            Image.fromarray(pixelated.repeat(5, 0).repeat(5, 1)).save(root / "tests" / "text_pixels.png")
+            Image.fromarray(original).save(root / "search" / "search.png")
+            
+            cases = collectCases(str(root / "tests"), str(root / "search"))
+            self.assertEqual(len(cases), 1)
+            self.assertTrue(cases[0]["reference"].endswith("text.png"))
+            
+            result = runCase(cases[0], {"matcher": "sqdiff"})
+        
+        self.assertEqual(result["referenceStatus"], "ok")
+        self.assertEqual(result["referenceOffset"], [3, 2])
+        self.assertTrue(0.0 <= result["accuracy"] <= 1.0)
+        self.assertTrue(0.0 <= result["inputAccuracy"] < 1.0)
+        self.assertEqual(result["blocks"]["blocks"], 12)
+        self.assertTrue({"load", "detect", "match", "write"} <= set(result["stages"]))
+    
+    def test_compare_reports(self):
+        """Test slower and less accurate cases are reported as regressions."""
+        from depixlib.benchmark import compareReports
+        
+        def report(total, accuracy):
+            return {"results": [{
+                "pixelimage": "a_pixels.png", "searchimage": "s.png",
+                "total": total, "peakRssMB": 100.0, "accuracy": accuracy,
+            }]}
+        
+        self.assertEqual(compareReports(report(1.05, 0.9), report(1.0, 0.9), 0.1), [])
+        self.assertEqual(len(compareReports(report(2.0, 0.9), report(1.0, 0.9), 0.1)), 1)
+        self.assertEqual(len(compareReports(report(1.0, 0.8), report(1.0, 0.9), 0.1)), 1)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test pipeline instrumentation."""
+    
+    def test_merge_and_disabled(self):
+        """Test metrics add up across jobs and the disabled instance records nothing."""
+        from depixlib.metrics import DISABLED, Metrics
+        
+        total = Metrics()
+        for _ in range(2):
+            job = Metrics()
+            with job.stage("match"):
+                job.count("matcherCalls", 3)
+                job.observe("blocksPerSize", "5x5", 2)
+            total.merge(job)
+        
+        result = total.toDict()
+        self.assertEqual(result["stageCalls"], {"match": 2})
+        self.assertEqual(result["counters"], {"matcherCalls": 6})
+        self.assertEqual(result["histograms"], {"blocksPerSize": {"5x5": 4}})
+        
+        with DISABLED.stage("match"):
+            DISABLED.count("matcherCalls")
+        DISABLED.merge(total)
+        self.assertEqual(DISABLED.toDict()["counters"], {})
+    
+    def test_pipeline_metrics(self):
+        """Test depixelize() reports every stage and its block counts."""
+        import numpy as np
+        from depixlib.metrics import Metrics
+        from depixlib.pipeline import depixelize
+        
+        rng = np.random.default_rng(6)
+        search = LoadedImage.fromArray(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8))
+        pixelated = LoadedImage.fromArray(
+            rng.integers(1, 255, (3, 4, 3), dtype=np.uint8).repeat(3, 0).repeat(2, 1)
+        )
+        metrics = Metrics()
+        _, stats = depixelize(pixelated, search, matcher="sqdiff", topK=2, metrics=metrics)
+        
+        result = metrics.toDict()
+        self.assertEqual(
+            set(result["stages"]), {"detect", "filter", "match", "split", "neighbours", "write"}
+        )
+        self.assertEqual(result["counters"]["matcherCalls"], 12)
+        self.assertEqual(result["counters"]["blocks.blocks"], stats["blocks"])
+        self.assertEqual(result["histograms"]["blocksPerSize"], {"2x3": 12})
+        self.assertEqual(sum(result["histograms"]["matchesPerBlock"].values()), 12)
+
+
+class TestGenPixelated(unittest.TestCase):
+    """Test the pixelated test image generator."""
+    
+    def test_gamma_matches_block_loop(self):
+        """Test block means with a grid offset and partial edge blocks."""
+        import numpy as np
+        from tool_gen_pixelated import pixelate_gamma_corrected
+        
+        rng = np.random.default_rng(7)
+        array = rng.integers(0, 256, (11, 13, 3), dtype=np.uint8)
+        output = pixelate_gamma_corrected(LoadedImage.fromArray(array), 4, (2, 1))
+        
+        expected = np.empty_like(array)
+        for y0, y1 in ((0, 1), (1, 5), (5, 9), (9, 11)):
+            for x0, x1 in ((0, 2), (2, 6), (6, 10), (10, 13)):
+                block = array[y0:y1, x0:x1].reshape(-1, 3).astype(int)
+                expected[y0:y1, x0:x1] = block.sum(axis=0) // len(block)
+        self.assertTrue(np.array_equal(output, expected))
+    
+    def test_linear_keeps_uniform_blocks(self):
+        """Test linear averaging maps every flat colour back to itself."""
+        import numpy as np
+        from tool_gen_pixelated import pixelate_linear
+        
+        array = np.arange(256, dtype=np.uint8).repeat(3).reshape(16, 16, 3).repeat(3, 0).repeat(3, 1)
+        output = pixelate_linear(LoadedImage.fromArray(array), 3)
+        self.assertTrue(np.array_equal(output, array))
+    
+    def test_variants(self):
+        """Test every combination of settings is produced from one image."""
+        import numpy as np
+        from tool_gen_pixelated import pixelate_variants
+        
+        image = LoadedImage.fromArray(np.zeros((8, 8, 3), dtype=np.uint8))
+        variants = pixelate_variants(image, [2, 4], ["gamma", "linear"], [(0, 0), (1, 1)])
+        self.assertEqual(len(variants), 8)
+        self.assertEqual({v[3].shape for v in variants}, {(8, 8, 3)})
+
+
+class TestColorSpace(unittest.TestCase):
+    """Test the shared colour-space tables."""
+    
+    def test_tables_match_direct_conversion(self):
+        """Test lookups equal the float32 power and invert back to the levels."""
+        import numpy as np
+        from depixlib.colorspace import AVERAGE_TYPES, fromWorkingSpace, toWorkingSpace
+        
+        levels = np.arange(256, dtype=np.uint8).reshape(16, 16)
+        direct = np.power(levels.astype(np.float32) / 255.0, 2.2)
+        self.assertTrue(np.array_equal(toWorkingSpace(levels, "linear"), direct))
+        for averageType in AVERAGE_TYPES:
+            working = toWorkingSpace(levels, averageType)
+            self.assertEqual(working.shape, levels.shape)
+            np.testing.assert_allclose(
+                fromWorkingSpace(working, averageType), levels, atol=1e-3
+            )
+        with self.assertRaises(ValueError):
+            toWorkingSpace(levels, "cmyk")
+    
+    def test_fixed_point_inverse(self):
+        """Test fixed-point means of flat blocks map back to their level."""
+        import numpy as np
+        from depixlib.colorspace import fixedPointTable, fixedPointToSrgb8
+        
+        for averageType in ("linear", "srgb"):
+            table = fixedPointTable(averageType)
+            levels = np.arange(256)
+            self.assertTrue(np.array_equal(fixedPointToSrgb8(table, table), levels))
+            self.assertTrue(np.array_equal(fixedPointToSrgb8(table[1:] - 1, table), levels[:-1]))
+    
+    def test_loaded_image_working_cache(self):
+        """Test an image is converted once per average type."""
+        import numpy as np
+        
+        image = LoadedImage.fromArray(np.full((2, 3, 3), 128, dtype=np.uint8))
+        working = image.working("srgb")
+        self.assertIs(image.working("srgb"), working)
+        self.assertFalse(working.flags.writeable)
+        self.assertAlmostEqual(float(working[0, 0, 0]), 0.2158605, places=6)
+
+
+class TestSequenceDecoder(unittest.TestCase):
+    """Test decoding text against a render of a known sequence."""
+    
+    def _render(self, glyphs, text, charsPerLine):
+        import numpy as np
+        
+        lines = [text[i:i + charsPerLine] for i in range(0, len(text), charsPerLine)]
+        array = np.full((4 + 14 * len(lines), 8 * charsPerLine + 6, 3), 255, dtype=np.uint8)
+        for row, line in enumerate(lines):
+            for column, c in enumerate(line):
+                y, x = 4 + 14 * row, 3 + 8 * column
+                array[y:y + 10, x:x + 7][glyphs[c]] = 0
+        return array
+    
+    def test_layout_and_decode(self):
+        """Test the layout is found and a pixelated line reads back."""
+        import numpy as np
+        from depixlib.sequence import SequenceLayout, decodeText
+        from tool_gen_pixelated import pixelate_gamma_corrected
+        
+        rng = np.random.default_rng(3)
+        glyphs = {c: rng.random((10, 7)) < 0.4 for c in "abcd"}
+        for glyph in glyphs.values():
+            glyph[0] = glyph[-1] = glyph[:, 0] = glyph[:, -1] = True
+        glyphs[" "] = np.zeros((10, 7), dtype=bool)
+        # De Bruijn sequence of order 2, every pair of letters once
+        sequence = "aabacadbbcbdccdda"
+        search = self._render(glyphs, sequence, 6)
+        
+        layout = SequenceLayout.detect(search, sequence)
+        self.assertEqual(
+            (layout.charsPerLine, layout.cellWidth, layout.lineHeight, layout.originX),
+            (6, 8, 14, 2)
+        )
+        self.assertEqual(layout.position(7), (10, 2 + 14))
+        self.assertEqual(layout.offsetAt(12, 20), 7)
+        self.assertIsNone(layout.offsetAt(0, 20))
+        
+        text = self._render(glyphs, " cab dab", 8)
+        pixelated = pixelate_gamma_corrected(LoadedImage.fromArray(text), 4, (1, 2))
+        results = decodeText(
+            LoadedImage.fromArray(pixelated), LoadedImage.fromArray(search), sequence,
+            candidates=3, grid=(4, 4, 1, 2)
+        )
+        self.assertEqual(results[0][0], "cab dab")
+        self.assertEqual(len(results), 3)
+        self.assertEqual([error for _, error in results], sorted(error for _, error in results))
+        
+        # Rows of background far below the line predict background only
+        tall = np.concatenate([text, np.full((40,) + text.shape[1:], 255, dtype=np.uint8)])
+        pixelated = pixelate_gamma_corrected(LoadedImage.fromArray(tall), 4, (1, 2))
+        results = decodeText(
+            LoadedImage.fromArray(pixelated), LoadedImage.fromArray(search), sequence,
+            candidates=1, grid=(4, 4, 1, 2)
+        )
+        self.assertEqual(results[0][0], "cab dab")
+        
+        with self.assertRaises(ValueError):
+            SequenceLayout.detect(search[:16], sequence)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,9 +4,16 @@ Tool to generate pixelated images for testing.
 from __future__ import annotations
 
 import argparse
+import itertools
 import logging
 from pathlib import Path
+from typing import List, Tuple
 
+import numpy as np
+from PIL import Image
+
+from depixlib.colorspace import fixedPointTable, fixedPointToSrgb8
+from depixlib.functions import gridStarts
 from depixlib.helpers import check_file
 from depixlib.LoadedImage import LoadedImage
 
@@ -16,6 +23,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Methods that average light; each is also a depixlib average type
+LIGHT_METHODS = ("linear", "srgb")
+
+
+def check_offset(value: str) -> Tuple[int, int]:
+    """Parse an x,y grid offset."""
+    try:
+        x, y = (int(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not an offset in x,y format")
+    return x, y
+
 
 def parse_args() -> argparse.Namespace:
     """Parse command line arguments."""
@@ -27,6 +46,10 @@ Example usage:
     python3 tool_gen_pixelated.py -i input.png -o pixelated.png
     python3 tool_gen_pixelated.py -i input.png -o output.png --blocksize 10
     python3 tool_gen_pixelated.py -i input.png --method linear
+    python3 tool_gen_pixelated.py -i input.png -o variants/ -b 4 5 6 -m gamma linear --offset 0,0 --offset 2,3
+
+With more than one block size, method or offset, every combination is
+written to the OUTPUTIMAGE directory as NAME_b<size>_<method>_o<x>-<y>.png.
         """
     )
     parser.add_argument(
@@ -38,190 +61,220 @@ Example usage:
     )
     parser.add_argument(
         "-o", "--outputimage",
-        help="Path to output image (default: output_pixelated.png)",
+        help="Path to output image, or directory for variants (default: output_pixelated.png)",
         default="output_pixelated.png",
         metavar="PATH"
     )
     parser.add_argument(
         "-b", "--blocksize",
-        help="Size of pixelation blocks (default: 5)",
-        default=5,
+        help="Size of pixelation blocks, several for variants (default: 5)",
+        default=[5],
+        nargs="+",
         type=int,
         metavar="N"
     )
     parser.add_argument(
         "-m", "--method",
-        help="Averaging method (default: gamma)",
-        default="gamma",
-        choices=["gamma", "linear"],
+        help="Averaging method, several for variants (default: gamma)",
+        default=["gamma"],
+        nargs="+",
+        choices=["gamma", "linear", "srgb"],
         metavar="METHOD"
     )
+    parser.add_argument(
+        "--offset",
+        help="Grid offset, repeat for variants (default: 0,0)",
+        default=None,
+        action="append",
+        type=check_offset,
+        metavar="X,Y"
+    )
     return parser.parse_args()
 
 
+def _block_grid(
+    shape: Tuple[int, ...],
+    block_size: int,
+    offset: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Block starts and sizes along y and x; partial blocks at the edges."""
+    height, width = shape[:2]
+    y_starts = gridStarts(height, block_size, offset[1])
+    x_starts = gridStarts(width, block_size, offset[0])
+    heights = np.diff(np.append(y_starts, height))
+    widths = np.diff(np.append(x_starts, width))
+    return y_starts, x_starts, heights, widths
+
+
+def _block_sums(
+    values: np.ndarray,
+    y_starts: np.ndarray,
+    x_starts: np.ndarray
+) -> np.ndarray:
+    """Per-block channel sums of an (H, W, 3) integer array."""
+    row_sums = np.add.reduceat(values, y_starts, axis=0, dtype=np.int64)
+    return np.add.reduceat(row_sums, x_starts, axis=1)
+
+
+def _expand_blocks(
+    colors: np.ndarray,
+    heights: np.ndarray,
+    widths: np.ndarray
+) -> np.ndarray:
+    """Paint per-block colours back to full image size."""
+    return np.repeat(np.repeat(colors, heights, axis=0), widths, axis=1)
+
+
 def pixelate_gamma_corrected(
     image: LoadedImage,
-    block_size: int
-) -> list[list[tuple[int, int, int]]]:
+    block_size: int,
+    offset: Tuple[int, int] = (0, 0)
+) -> np.ndarray:
     """
     Pixelate using gamma-corrected averaging (mimics most screenshot tools).
-    
+
     Args:
         image: Input image
         block_size: Size of pixelation blocks
-        
+        offset: A point the block grid passes through
+
     Returns:
-        2D array of RGB tuples
+        Pixelated (H, W, 3) uint8 array
     """
-    output_data = [[None for _ in range(image.height)] for _ in range(image.width)]
-    
-    for x in range(0, image.width, block_size):
-        for y in range(0, image.height, block_size):
-            # Calculate block boundaries
-            max_x = min(x + block_size, image.width)
-            max_y = min(y + block_size, image.height)
-            
-            # Accumulate RGB values
-            r_sum = g_sum = b_sum = 0
-            pixel_count = 0
-            
-            for xx in range(x, max_x):
-                for yy in range(y, max_y):
-                    pixel = image.imageData[xx][yy]
-                    r_sum += pixel[0]
-                    g_sum += pixel[1]
-                    b_sum += pixel[2]
-                    pixel_count += 1
-            
-            # Calculate average
-            avg_r = int(r_sum / pixel_count)
-            avg_g = int(g_sum / pixel_count)
-            avg_b = int(b_sum / pixel_count)
-            avg_color = (avg_r, avg_g, avg_b)
-            
-            # Apply average to all pixels in block
-            for xx in range(x, max_x):
-                for yy in range(y, max_y):
-                    output_data[xx][yy] = avg_color
-    
-    return output_data
+    y_starts, x_starts, heights, widths = _block_grid(image.array.shape, block_size, offset)
+    areas = heights[:, None, None] * widths[None, :, None]
+    # Truncating mean, like int(sum / count)
+    colors = (_block_sums(image.array, y_starts, x_starts) // areas).astype(np.uint8)
+    return _expand_blocks(colors, heights, widths)
 
 
 def pixelate_linear(
     image: LoadedImage,
-    block_size: int
-) -> list[list[tuple[int, int, int]]]:
+    block_size: int,
+    offset: Tuple[int, int] = (0, 0),
+    linear: np.ndarray | None = None,
+    curve: str = "linear"
+) -> np.ndarray:
     """
     Pixelate using linear RGB averaging (mimics GIMP).
-    
+
+    Light is summed in fixed point, so the sums are exact and the mean maps
+    back to sRGB by exact table lookup.
+
     Args:
         image: Input image
         block_size: Size of pixelation blocks
-        
+        offset: A point the block grid passes through
+        linear: fixedPointTable(curve)[image.array], to reuse across variants
+        curve: 'linear' for the 2.2 power approximation, 'srgb' for the
+            exact sRGB transfer curve
+
     Returns:
-        2D array of RGB tuples
+        Pixelated (H, W, 3) uint8 array
     """
-    output_data = [[None for _ in range(image.height)] for _ in range(image.width)]
-    
-    for x in range(0, image.width, block_size):
-        for y in range(0, image.height, block_size):
-            # Calculate block boundaries
-            max_x = min(x + block_size, image.width)
-            max_y = min(y + block_size, image.height)
-            
-            # Accumulate linear RGB values
-            r_sum = g_sum = b_sum = 0
-            pixel_count = 0
-            
-            for xx in range(x, max_x):
-                for yy in range(y, max_y):
-                    pixel = image.imageData[xx][yy]
-                    # Convert to linear space (gamma = 2.2)
-                    r_linear = (pixel[0] / 255.0) ** 2.2
-                    g_linear = (pixel[1] / 255.0) ** 2.2
-                    b_linear = (pixel[2] / 255.0) ** 2.2
-                    
-                    r_sum += r_linear
-                    g_sum += g_linear
-                    b_sum += b_linear
-                    pixel_count += 1
-            
-            # Calculate average in linear space
-            avg_r_linear = r_sum / pixel_count
-            avg_g_linear = g_sum / pixel_count
-            avg_b_linear = b_sum / pixel_count
-            
-            # Convert back to sRGB
-            avg_r = int((avg_r_linear ** (1/2.2)) * 255)
-            avg_g = int((avg_g_linear ** (1/2.2)) * 255)
-            avg_b = int((avg_b_linear ** (1/2.2)) * 255)
-            avg_color = (avg_r, avg_g, avg_b)
-            
-            # Apply average to all pixels in block
-            for xx in range(x, max_x):
-                for yy in range(y, max_y):
-                    output_data[xx][yy] = avg_color
-    
-    return output_data
+    table = fixedPointTable(curve)
+    if linear is None:
+        linear = table[image.array]
+    y_starts, x_starts, heights, widths = _block_grid(image.array.shape, block_size, offset)
+    areas = heights[:, None, None] * widths[None, :, None]
+    means = _block_sums(linear, y_starts, x_starts) // areas
+    colors = fixedPointToSrgb8(means, table)
+    return _expand_blocks(colors, heights, widths)
+
+
+def pixelate_variants(
+    image: LoadedImage,
+    block_sizes: List[int],
+    methods: List[str],
+    offsets: List[Tuple[int, int]]
+) -> List[Tuple[int, str, Tuple[int, int], np.ndarray]]:
+    """
+    Pixelate one decoded image with every combination of settings.
+
+    Args:
+        image: Input image
+        block_sizes: Block sizes
+        methods: Averaging methods ('gamma', 'linear' or 'srgb')
+        offsets: Grid offsets
+
+    Returns:
+        List of (block size, method, offset, pixelated array)
+    """
+    # Each light-averaging curve converts the image once for all variants
+    linear = {
+        method: fixedPointTable(method)[image.array]
+        for method in set(methods) & set(LIGHT_METHODS)
+    }
+    variants = []
+    for block_size, method, offset in itertools.product(block_sizes, methods, offsets):
+        if method in LIGHT_METHODS:
+            output = pixelate_linear(
+                image, block_size, offset, linear[method], method
+            )
+        else:
+            output = pixelate_gamma_corrected(image, block_size, offset)
+        variants.append((block_size, method, offset, output))
+    return variants
 
 
 def main() -> None:
     """Main pixelation function."""
     args = parse_args()
+    offsets = args.offset or [(0, 0)]
 
     try:
         # Validate block size
-        if args.blocksize < 1:
-            raise ValueError("Block size must be at least 1")
-        if args.blocksize > 100:
-            logger.warning(
-                "Block size %d is very large. Consider using smaller value.",
-                args.blocksize
-            )
+        for block_size in args.blocksize:
+            if block_size < 1:
+                raise ValueError("Block size must be at least 1")
+            if block_size > 100:
+                logger.warning(
+                    "Block size %d is very large. Consider using smaller value.",
+                    block_size
+                )
 
         # Load image
         logger.info("Loading image from %s", args.image)
         image = LoadedImage(args.image)
         logger.info("Image size: %dx%d", image.width, image.height)
 
-        # Create output image
-        output_image = image.getCopyOfLoadedPILImage()
-
         # Pixelate based on method
         logger.info(
-            "Pixelating with block size %d using %s method",
-            args.blocksize,
-            args.method
+            "Pixelating with block size %s using %s method",
+            ", ".join(map(str, args.blocksize)),
+            ", ".join(args.method)
         )
-        
-        if args.method == "linear":
-            output_data = pixelate_linear(image, args.blocksize)
-        else:
-            output_data = pixelate_gamma_corrected(image, args.blocksize)
-
-        # Apply pixelated data to output image
-        for x in range(image.width):
-            for y in range(image.height):
-                if output_data[x][y] is not None:
-                    output_image.putpixel((x, y), output_data[x][y])
+        variants = pixelate_variants(image, args.blocksize, args.method, offsets)
 
         # Save output
         output_path = Path(args.outputimage)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        output_image.save(str(output_path))
-        logger.info("Successfully saved pixelated image to: %s", args.outputimage)
+        if len(variants) == 1:
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            Image.fromarray(variants[0][3]).save(str(output_path))
+            logger.info("Successfully saved pixelated image to: %s", args.outputimage)
+        else:
+            output_path.mkdir(parents=True, exist_ok=True)
+            stem = Path(args.image).stem
+            for block_size, method, (x, y), output in variants:
+                name = f"{stem}_b{block_size}_{method}_o{x}-{y}.png"
+                Image.fromarray(output).save(str(output_path / name))
+            logger.info(
+                "Successfully saved %d pixelated variants to: %s",
+                len(variants), args.outputimage
+            )
 
         # Calculate statistics
         total_pixels = image.width * image.height
-        blocks_x = (image.width + args.blocksize - 1) // args.blocksize
-        blocks_y = (image.height + args.blocksize - 1) // args.blocksize
-        total_blocks = blocks_x * blocks_y
-        compression_ratio = total_pixels / total_blocks
-
-        logger.info("\n=== Statistics ===")
-        logger.info("Original pixels: %d", total_pixels)
-        logger.info("Pixelated blocks: %d (%dx%d)", total_blocks, blocks_x, blocks_y)
-        logger.info("Compression ratio: %.2fx", compression_ratio)
+        for block_size in args.blocksize:
+            blocks_x = (image.width + block_size - 1) // block_size
+            blocks_y = (image.height + block_size - 1) // block_size
+            total_blocks = blocks_x * blocks_y
+            compression_ratio = total_pixels / total_blocks
+
+            logger.info("\n=== Statistics (block size %d) ===", block_size)
+            logger.info("Original pixels: %d", total_pixels)
+            logger.info("Pixelated blocks: %d (%dx%d)", total_blocks, blocks_x, blocks_y)
+            logger.info("Compression ratio: %.2fx", compression_ratio)
 
     except Exception as e:
         logger.error("Error during pixelation: %s", str(e), exc_info=True)
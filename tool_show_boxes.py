@@ -8,6 +8,7 @@ from PIL import Image, ImageDraw
 
 from depixlib.helpers import check_file, check_color
 from depixlib.functions import (
+    findGridSubRectangles,
     findRectangleSizeOccurences,
     findSameColorSubRectangles,
     removeMootColorRectangles
@@ -63,6 +64,11 @@ def parse_args() -> argparse.Namespace:
         type=int,
         metavar="N"
     )
+    parser.add_argument(
+        "--grid",
+        help="detect the block grid instead of following exact colour runs",
+        action="store_true"
+    )
     parser.add_argument(
         "-o",
         "--outputimage",
@@ -91,9 +97,14 @@ def main() -> None:
         (0, 0), (pixelatedImage.width - 1, pixelatedImage.height - 1)
     )
 
-    pixelatedSubRectangles = findSameColorSubRectangles(
-        pixelatedImage, pixelatedRectangle
-    )
+    if args.grid:
+        pixelatedSubRectangles = findGridSubRectangles(
+            pixelatedImage, pixelatedRectangle
+        )
+    else:
+        pixelatedSubRectangles = findSameColorSubRectangles(
+            pixelatedImage, pixelatedRectangle
+        )
     logger.info("Found %d same color rectangles", len(pixelatedSubRectangles))
 
     pixelatedSubRectangles = removeMootColorRectangles(
@@ -108,7 +119,7 @@ def main() -> None:
         10, pixelatedRectangle.width * pixelatedRectangle.height * 0.01
     ):
         logger.warning(
-            "Too many variants on block size. Re-cropping the image might help."
+            "Too many variants on block size. Re-cropping the image or --grid might help."
         )
 
     # Enhance image